@@ -4,37 +4,122 @@ matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import io
 import base64
-from collections import Counter
+import threading
+from collections import Counter, OrderedDict
+from datetime import datetime
 
-def generate_plots(chain):
-    if len(chain) <= 1:
-        return {'plots': None, 'stats': None}
+import metrics
+from telemetry import is_anchor
 
-    transactions = []
-    for block in chain:
-        transactions.extend(block['transactions'])
+# Rendered chart sets kept, keyed by chain height
+MAX_CACHED_CHARTS = 4
 
-    if not transactions:
-        return {'plots': None, 'stats': None}
+RENDER_SECONDS = metrics.histogram('chart_render_duration_seconds', 'Time spent rendering the analytics charts.')
+CHART_CACHE_HITS = metrics.counter('chart_cache_hits_total', 'Chart requests served from the chart cache.')
 
-    df = pd.DataFrame(transactions)
-    df['timestamp'] = pd.to_datetime(df['timestamp'])
 
-    plots = {}
-    stats = {}
+def parse_timestamp(value):
+    """
+    Parses a transaction timestamp the way pd.to_datetime would, trying the fast ISO path first
+    :param value: Timestamp as stored in the transaction
+    :return: <datetime> or None if it cannot be parsed
+    """
+    if value is None or value == '':
+        return None
+    if isinstance(value, str):
+        try:
+            return datetime.fromisoformat(value)
+        except ValueError:
+            pass
+    parsed = pd.to_datetime(value, errors='coerce')
+    return None if pd.isna(parsed) else parsed.to_pydatetime()
+
+
+class LedgerAggregates:
+    """
+    Running counts over every transaction in the chain, updated one block at a time
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.height = 0
+        self.total_transactions = 0
+        self.product_counts = Counter()
+        self.location_counts = Counter()
+        self.daily_counts = Counter()
+        self.latest_timestamp = None
+
+    def sync(self, chain):
+        """
+        Folds in the blocks appended since the last call
+        :param chain: <list> The full chain
+        :return: <bool> True if anything changed
+        """
+        if len(chain) < self.height:
+            # The chain was replaced by a shorter one; start over
+            self.reset()
+        if len(chain) == self.height:
+            return False
+        for block in chain[self.height:]:
+            self.add_block(block)
+        return True
+
+    def add_block(self, block):
+        for tx in block['transactions']:
+            if is_anchor(tx):
+                # Telemetry bookkeeping, not a product or a transfer
+                continue
+            self.total_transactions += 1
+            if tx.get('product_name') is not None:
+                self.product_counts[tx['product_name']] += 1
+            if tx.get('location') is not None:
+                self.location_counts[tx['location']] += 1
+            timestamp = parse_timestamp(tx.get('timestamp'))
+            if timestamp is not None:
+                self.daily_counts[timestamp.date()] += 1
+                if self.latest_timestamp is None or timestamp > self.latest_timestamp:
+                    self.latest_timestamp = timestamp
+        self.height += 1
+
+    def stats(self):
+        if self.product_counts:
+            # Same tie-break as Series.mode(): the lowest value wins
+            top = max(self.product_counts.values())
+            most_common_product = min(name for name, count in self.product_counts.items() if count == top)
+        else:
+            most_common_product = 'N/A'
+        return {
+            'total_products': self.total_transactions,
+            'unique_products': len(self.product_counts),
+            'most_common_product': most_common_product,
+            'latest_transaction': self.latest_timestamp.strftime('%Y-%m-%d %H:%M:%S') if self.latest_timestamp else 'N/A',
+        }
+
+    def daily_series(self):
+        """
+        :return: <pd.Series> Transactions per day, including days without any
+        """
+        if not self.daily_counts:
+            return pd.Series(dtype='int64')
+        days = pd.date_range(min(self.daily_counts), max(self.daily_counts), freq='D')
+        return pd.Series([self.daily_counts.get(day.date(), 0) for day in days], index=days)
+
 
-    # --- STATS ---
-    stats['total_products'] = len(df)
-    stats['unique_products'] = df['product_name'].nunique()
-    stats['most_common_product'] = df['product_name'].mode()[0] if not df['product_name'].empty else 'N/A'
-    stats['latest_transaction'] = df['timestamp'].max().strftime('%Y-%m-%d %H:%M:%S') if not df['timestamp'].empty else 'N/A'
+aggregates = LedgerAggregates()
+_chart_cache = OrderedDict()
+# pyplot keeps global state, so renders and aggregate updates are serialized
+_lock = threading.Lock()
 
-    # --- PLOTS ---
+
+def _render():
     plt.style.use('seaborn-v0_8-darkgrid')
+    plots = {}
 
     # Plot 1: Product Distribution by Name (Pie Chart)
     plt.figure(figsize=(8, 8))
-    product_counts = df['product_name'].value_counts()
+    product_counts = pd.Series(aggregates.product_counts).sort_values(ascending=False, kind='stable')
     plt.pie(product_counts, labels=product_counts.index, autopct='%1.1f%%', startangle=140, colors=plt.cm.Paired.colors)
     plt.title('Product Distribution by Name', fontsize=16, fontweight='bold')
     plt.ylabel('')
@@ -46,8 +131,7 @@ def generate_plots(chain):
 
     # Plot 2: Number of Transactions per Product (Bar Chart)
     plt.figure(figsize=(10, 6))
-    transactions_per_product = df['product_name'].value_counts()
-    transactions_per_product.plot(kind='bar', color='skyblue')
+    product_counts.plot(kind='bar', color='skyblue')
     plt.title('Number of Transactions per Product', fontsize=16, fontweight='bold')
     plt.xlabel('Product Name', fontsize=12)
     plt.ylabel('Number of Transactions', fontsize=12)
@@ -61,8 +145,9 @@ def generate_plots(chain):
 
     # Plot 3: Transactions Over Time (Line Chart)
     plt.figure(figsize=(12, 6))
-    transactions_over_time = df.set_index('timestamp').resample('D').size()
-    transactions_over_time.plot(kind='line', marker='o', linestyle='-', color='green')
+    transactions_over_time = aggregates.daily_series()
+    if not transactions_over_time.empty:
+        transactions_over_time.plot(kind='line', marker='o', linestyle='-', color='green')
     plt.title('Transactions Over Time', fontsize=16, fontweight='bold')
     plt.xlabel('Date', fontsize=12)
     plt.ylabel('Number of Transactions', fontsize=12)
@@ -76,8 +161,9 @@ def generate_plots(chain):
 
     # Plot 4: Products by Location (Bar Chart)
     plt.figure(figsize=(10, 6))
-    location_counts = df['location'].value_counts()
-    location_counts.plot(kind='bar', color='coral')
+    location_counts = pd.Series(aggregates.location_counts, dtype='int64').sort_values(ascending=False, kind='stable')
+    if not location_counts.empty:
+        location_counts.plot(kind='bar', color='coral')
     plt.title('Products by Location', fontsize=16, fontweight='bold')
     plt.xlabel('Location', fontsize=12)
     plt.ylabel('Number of Products', fontsize=12)
@@ -89,4 +175,45 @@ def generate_plots(chain):
     plots['products_by_location'] = base64.b64encode(img.getvalue()).decode()
     plt.close()
 
-    return {'plots': plots, 'stats': stats}
+    return plots
+
+
+def reset():
+    """
+    Drops all aggregates and cached charts, e.g. after the chain was replaced
+    """
+    with _lock:
+        aggregates.reset()
+        _chart_cache.clear()
+
+
+def generate_plots(chain):
+    """
+    Returns the dashboard stats and charts for the chain.
+
+    Aggregates are only advanced by the blocks added since the previous call,
+    and charts are re-rendered only when the chain height has changed.
+    """
+    if len(chain) <= 1:
+        return {'plots': None, 'stats': None}
+
+    with _lock:
+        if len(chain) < aggregates.height:
+            _chart_cache.clear()
+        aggregates.sync(chain)
+        if not aggregates.total_transactions:
+            return {'plots': None, 'stats': None}
+
+        height = aggregates.height
+        plots = _chart_cache.get(height)
+        if plots is None:
+            with RENDER_SECONDS.time():
+                plots = _render()
+            _chart_cache[height] = plots
+            while len(_chart_cache) > MAX_CACHED_CHARTS:
+                _chart_cache.popitem(last=False)
+        else:
+            CHART_CACHE_HITS.inc()
+            _chart_cache.move_to_end(height)
+
+        return {'plots': plots, 'stats': aggregates.stats()}
@@ -1,35 +1,139 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, Response
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
-from wallet import Wallet
-from blockchain import Blockchain
+from wallet import KeyPool, load_wallet
+from blockchain import Blockchain, NotWriterError
+from consensus import ConsensusError, from_env as consensus_from_env
+from encoding import TRANSACTION_VERSION
+from mempool import Mempool, BackgroundMiner, Inbox, INBOX_DB, OPTIONAL_FIELDS, REQUIRED_FIELDS
+from follower import LogFollower
 from analytics import generate_plots
+import analytics
+import columnar
+from sync import NodeSync, HttpTransport
+from userstore import UserStore
+from bulk_import import BulkImporter, parse_manifest, detect_format
+from ledger import Record, to_json
+from txindex import EQUALITY_FIELDS, numeric_value, parse_time
+from telemetry import (TelemetryLog, TelemetryAnchorer, TelemetryLogError, TELEMETRY_DIR, TELEMETRY_PAGE_SIZE,
+                       ANCHOR_INTERVAL, ANCHOR_PRODUCT_ID, anchor_windows, parse_readings)
+import metrics
 import json
 import os
 import hashlib
+import hmac
 from uuid import uuid4
 
+class LedgerJSONProvider(DefaultJSONProvider):
+    # Blocks and transactions on the chain are compact records, not dicts
+    @staticmethod
+    def default(o):
+        if isinstance(o, Record):
+            return o.to_dict()
+        return DefaultJSONProvider.default(o)
+
 app = Flask(__name__)
+app.json = LedgerJSONProvider(app)
 app.secret_key = 'supersecretkey'
+# Per-route latency histograms, plus sampled profiles of slow requests when PROFILE_SAMPLE_RATE is set
+metrics.instrument(app)
 
 # ... (rest of imports and setup)
 
-# Instantiate the Blockchain
-blockchain = Blockchain()
+# Instantiate the Blockchain. Under a multi-process server the first worker to
+# take the writer lock forges blocks and the others follow the block log.
+DATA_DIR = os.environ.get('CHAIN_DATA_DIR', 'chain_data')
+# CHAIN_TRUNCATE_INVALID=1 drops an invalid tail of the block log instead of refusing to start
+blockchain = Blockchain(data_dir=DATA_DIR, consensus=consensus_from_env(),
+                        truncate_invalid=os.environ.get('CHAIN_TRUNCATE_INVALID') == '1')
 node_identifier = str(uuid4()).replace('-', '')
 
-USERS_FILE = 'users.json'
+CHAIN_PAGE_SIZE = 100
+CHAIN_MAX_PAGE_SIZE = 1000
+DASHBOARD_BLOCKS = 10  # latest blocks rendered on the dashboard; older ones load on demand
+PRODUCT_LIST_SIZE = 100  # products listed on the registration page
+SEARCH_PAGE_SIZE = 50
+SEARCH_MAX_PAGE_SIZE = 500
+TELEMETRY_MAX_PAGE_SIZE = 10000
+
+# Keys accepted in the body of /transactions/new
+TRANSACTION_REQUEST_FIELDS = REQUIRED_FIELDS + OPTIONAL_FIELDS + ('signature', 'public_key')
+
+# Query parameters of /transactions/search -> (indexed field, bound)
+SEARCH_RANGES = {
+    'since': ('timestamp', 0),
+    'until': ('timestamp', 1),
+    'min_temperature': ('storage_temperature', 0),
+    'max_temperature': ('storage_temperature', 1),
+    'min_humidity': ('humidity', 0),
+    'max_humidity': ('humidity', 1),
+    'min_quantity': ('quantity', 0),
+    'max_quantity': ('quantity', 1),
+}
+
+# Writes are queued in the mempool and forged into blocks in the background; the
+# inbox carries transactions submitted to any worker to the one that writes
+mempool = Mempool(blockchain, inbox=Inbox(os.path.join(DATA_DIR, INBOX_DB)))
+background_miner = BackgroundMiner(blockchain, mempool)
+
+def reset_aggregates():
+    # Blocks we had were swapped out, so the running aggregates no longer apply
+    analytics.reset()
+    columnar.reset()
+
+log_follower = LogFollower(blockchain, on_reload=reset_aggregates)
+
+# Sensor readings are kept off-chain, and the writer anchors each new window of them into the ledger
+telemetry_log = TelemetryLog(os.path.join(DATA_DIR, TELEMETRY_DIR))
+telemetry_anchorer = TelemetryAnchorer(blockchain, mempool, telemetry_log,
+                                       interval=float(os.environ.get('TELEMETRY_ANCHOR_SECONDS', ANCHOR_INTERVAL)))
+TELEMETRY_VIEW_ROWS = 200  # readings listed on the tracking page
+# Sensors without a login session send this in an X-API-Key header; unset, only logged-in users may post readings
+TELEMETRY_API_KEY = os.environ.get('TELEMETRY_API_KEY')
+
+@app.before_request
+def start_ledger_threads():
+    # All idle unless needed: the miner and anchorer only work in the writer, and the follower stops once this process is one
+    background_miner.ensure_started()
+    telemetry_anchorer.ensure_started()
+    if not blockchain.writer:
+        log_follower.ensure_started()
+
+@app.errorhandler(NotWriterError)
+def not_writer(error):
+    # Only reached for requests that forge blocks directly; transactions go through the inbox
+    response = jsonify({'message': 'This worker does not write blocks, try again', 'error': str(error)})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.errorhandler(ConsensusError)
+def cannot_seal(error):
+    return jsonify({'message': 'This node does not seal blocks', 'error': str(error)}), 403
+
+@app.errorhandler(TelemetryLogError)
+def telemetry_log_damaged(error):
+    return jsonify({'message': 'The telemetry log is damaged; readings are not being stored', 'error': str(error)}), 503
+
+# Read when /metrics is scraped, so they cost nothing in between
+metrics.gauge('chain_height', 'Number of blocks in the chain.', function=lambda: len(blockchain.chain))
+metrics.gauge('mempool_pending_transactions', 'Transactions waiting to be mined.', function=lambda: len(mempool))
+metrics.gauge('ledger_writer', 'Whether this process holds the writer lock.', function=lambda: int(blockchain.writer))
+
+def submit_transaction(**fields):
+    """
+    Queues a transaction for the background miner
+    :return: <tuple> (tx id, None) if accepted, (None, <str> reason) if not
+    """
+    return mempool.submit(**fields)
 
-def load_users():
-    if not os.path.exists(USERS_FILE):
-        return {}
-    with open(USERS_FILE, 'r') as f:
-        return json.load(f)
+USERS_FILE = 'users.json'
+USERS_DB = os.environ.get('USERS_DB', 'users.db')
 
-def save_users(users):
-    with open(USERS_FILE, 'w') as f:
-        json.dump(users, f, indent=4)
+# New accounts take a pre-generated key pair instead of generating one in the request
+key_pool = KeyPool(size=int(os.environ.get('KEY_POOL_SIZE', 8)))
 
-users = load_users()
+# Existing users.json accounts are imported into the database on first start
+users = UserStore(USERS_DB, legacy_file=USERS_FILE)
 
 @app.route('/')
 def index():
@@ -50,17 +154,20 @@ def register():
 
         password_hash = generate_password_hash(password)
 
-        new_wallet = Wallet()
+        new_wallet = key_pool.take()
         
-        users[email] = {
+        added = users.add(email, {
             'fullname': fullname,
             'password_hash': password_hash,
             'role': role,
             'phone': phone,
             'public_key': new_wallet.public_key,
             'private_key': new_wallet.private_key
-        }
-        save_users(users)
+        })
+        if not added:
+            # Another worker registered the same email in the meantime
+            flash('Email already registered!', 'danger')
+            return redirect(url_for('register'))
         flash('Registration successful! Please login.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -86,22 +193,56 @@ def login():
 def dashboard():
     if 'email' in session:
         chain = blockchain.chain
-        chain_length = len(chain)
-        total_transactions = sum(len(block['transactions']) for block in chain)
-        latest_block = blockchain.last_block
+        blocks, older_than = latest_blocks(len(chain) + 1, DASHBOARD_BLOCKS)
         
         analytics_data = generate_plots(chain)
 
         return render_template('dashboard.html', 
                                role=session['role'],
-                               chain_length=chain_length,
-                               total_transactions=total_transactions,
-                               latest_block=latest_block,
+                               chain_length=len(chain),
+                               total_transactions=blockchain.transaction_count,
+                               latest_block=blockchain.last_block,
                                plot_url=analytics_data['plots'],
                                stats=analytics_data['stats'],
-                               chain=chain)
+                               blocks=blocks,
+                               older_than=older_than)
     return redirect(url_for('login'))
 
+@app.route('/dashboard/blocks', methods=['GET'])
+def dashboard_blocks():
+    """
+    The next page of older blocks for the dashboard, as an HTML fragment.
+
+    Query parameters:
+     - before: return the blocks below this index (the older_than of the previous page)
+     - limit: blocks per page (default DASHBOARD_BLOCKS, at most CHAIN_MAX_PAGE_SIZE)
+    """
+    if 'email' not in session:
+        return jsonify({'message': 'Login required'}), 401
+    try:
+        before = int(request.args.get('before', len(blockchain.chain) + 1))
+        limit = min(int(request.args.get('limit', DASHBOARD_BLOCKS)), CHAIN_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'before and limit must be integers'}), 400
+    blocks, older_than = latest_blocks(before, max(limit, 1))
+    response = {
+        'html': render_template('_blocks.html', blocks=blocks),
+        'count': len(blocks),
+        'older_than': older_than,
+    }
+    return jsonify(response), 200
+
+def latest_blocks(before, limit):
+    """
+    :param before: <int> Index of the block just above the page
+    :param limit: <int> Maximum number of blocks
+    :return: <tuple> (<list> blocks, newest first, <int> index to pass as before for the next page, or None)
+    """
+    end = min(before - 1, len(blockchain.chain))
+    start = max(end - limit, 0)
+    blocks = blockchain.chain[start:end][::-1] if end > 0 else []
+    return blocks, start + 1 if start > 0 else None
+
 @app.route('/register_product', methods=['GET', 'POST'])
 def register_product():
     if 'email' not in session:
@@ -116,6 +257,10 @@ def register_product():
         storage_temperature = request.form['storage_temperature']
         humidity = request.form['humidity']
         location = request.form['location']
+
+        if product_batch_id == ANCHOR_PRODUCT_ID:
+            flash(f'{ANCHOR_PRODUCT_ID} is a reserved product batch ID', 'danger')
+            return redirect(url_for('register_product'))
         
         user_email = session['email']
         user = users.get(user_email)
@@ -136,19 +281,16 @@ def register_product():
                 'timestamp': timestamp,
                 'storage_temperature': storage_temperature,
                 'humidity': humidity,
-                'location': location
+                'location': location,
+                'version': TRANSACTION_VERSION,
             })
             
             # Sign the transaction
-            user_wallet = Wallet(user['private_key'])
+            user_wallet = load_wallet(user['private_key'])
             signature = user_wallet.sign_transaction(transaction_data)
             
-            # Mine a new block to include the new product transaction
-            last_block = blockchain.last_block
-            last_proof = last_block['proof']
-            proof = blockchain.proof_of_work(last_proof)
-            
-            blockchain.new_transaction(
+            # Queue the transaction; the background miner puts it in a block
+            tx_id, error = submit_transaction(
                 sender=sender,
                 recipient=product_owner,
                 product_id=product_batch_id,
@@ -159,25 +301,72 @@ def register_product():
                 timestamp=timestamp,
                 storage_temperature=storage_temperature,
                 humidity=humidity,
-                location=location
+                location=location,
+                version=TRANSACTION_VERSION,
             )
             
-            previous_hash = blockchain.hash(last_block)
-            blockchain.new_block(proof, previous_hash)
-            
-            flash('Product details saved successfully!', 'success')
+            if error:
+                flash(error, 'danger')
+                return redirect(url_for('register_product'))
+
+            flash(f'Product details saved successfully! Transaction {tx_id[:12]} is pending confirmation.', 'success')
             return redirect(url_for('dashboard'))
         else:
             flash('User not found!', 'danger')
             return redirect(url_for('login'))
     
+    return render_template('product.html', role=session['role'], products=registered_products())
+
+def product_transactions(product_id):
+    """
+    :param product_id: <str> ID of the product
+    :return: <list> Its transactions, oldest first; telemetry anchors share a product_id but are no product
+    """
+    if product_id == ANCHOR_PRODUCT_ID:
+        return []
+    return blockchain.product_transactions(product_id)
+
+def registered_products(limit=PRODUCT_LIST_SIZE):
+    """
+    Served from the product index, so the page costs the same however long the chain is
+    :param limit: <int> Maximum number of products
+    :return: <list> Latest transaction of each of the most recently registered products, newest first
+    """
     products = []
-    for block in blockchain.chain:
-        for tx in block['transactions']:
-            if tx['sender'] == '0': # Registered products
-                products.append(tx)
-            
-    return render_template('product.html', role=session['role'], products=products)
+    # Copy the keys first; the miner or log follower may add products meanwhile
+    for product_id in reversed(list(blockchain.product_latest)):
+        if product_id in ('0', ANCHOR_PRODUCT_ID):
+            # Mining rewards and telemetry anchors, not products
+            continue
+        products.append(blockchain.product_latest[product_id])
+        if len(products) >= limit:
+            break
+    return products
+
+@app.route('/products/bulk', methods=['POST'])
+def bulk_register_products():
+    """
+    Registers many product batches from an uploaded CSV or JSON lines manifest
+    (form field 'manifest'), or from the raw request body.
+    """
+    if 'email' not in session:
+        return jsonify({'message': 'Login required'}), 401
+    user = users.get(session['email'])
+    if not user:
+        return jsonify({'message': 'User not found'}), 401
+
+    upload = request.files.get('manifest')
+    if upload:
+        text = upload.read().decode('utf-8-sig')
+        fmt = request.args.get('format') or detect_format(upload.filename, upload.mimetype)
+    else:
+        text = request.get_data(as_text=True)
+        fmt = request.args.get('format') or detect_format(None, request.mimetype)
+    if not text.strip():
+        return jsonify({'message': 'Empty manifest'}), 400
+
+    report = BulkImporter(blockchain, mempool).run(user, parse_manifest(text, fmt))
+    return jsonify(report), 201 if report['accepted'] else 400
 
 @app.route('/product_history', methods=['GET', 'POST'])
 def product_history():
@@ -186,12 +375,10 @@ def product_history():
 
     if request.method == 'POST':
         product_id = request.form['product_id']
-        product_history = []
-        for block in blockchain.chain:
-            for tx in block['transactions']:
-                if tx['product_id'] == product_id:
-                    product_history.append(tx)
-        return render_template('product_history.html', role=session['role'], product_history=product_history, product_id=product_id)
+        product_history = product_transactions(product_id)
+        owner_names = users.display_names(tx['recipient'] for tx in product_history)
+        return render_template('product_history.html', role=session['role'], product_history=product_history, product_id=product_id,
+                               owner_names=owner_names, **telemetry_view(product_id, request.form))
 
     return render_template('product_history.html', role=session['role'])
 
@@ -202,12 +389,10 @@ def track_product():
 
     if request.method == 'POST':
         product_id = request.form['product_id']
-        product_history = []
-        for block in blockchain.chain:
-            for tx in block['transactions']:
-                if tx['product_id'] == product_id:
-                    product_history.append(tx)
-        return render_template('track_product.html', role=session['role'], product_history=product_history, product_id=product_id)
+        product_history = product_transactions(product_id)
+        owner_names = users.display_names(tx['recipient'] for tx in product_history)
+        return render_template('track_product.html', role=session['role'], product_history=product_history, product_id=product_id,
+                               owner_names=owner_names, **telemetry_view(product_id, request.form))
 
     return render_template('track_product.html', role=session['role'])
 
@@ -227,36 +412,32 @@ def transfer_ownership():
             sender = user['public_key']
             
             # Find the latest transaction for the product
-            latest_transaction = None
-            for block in reversed(blockchain.chain):
-                for tx in reversed(block['transactions']):
-                    if tx['product_id'] == product_id:
-                        latest_transaction = tx
-                        break
-                if latest_transaction:
-                    break
+            latest_transaction = blockchain.latest_transaction(product_id)
             
             if latest_transaction and latest_transaction['recipient'] == sender:
-                last_block = blockchain.last_block
-                last_proof = last_block['proof']
-                proof = blockchain.proof_of_work(last_proof)
-                
-                blockchain.new_transaction(
-                    sender=sender,
-                    recipient=new_owner,
-                    product_id=product_id,
-                    product_name=latest_transaction['product_name'],
-                    quantity=latest_transaction['quantity'],
-                    timestamp=latest_transaction['timestamp'],
-                    storage_temperature=latest_transaction['storage_temperature'],
-                    humidity=latest_transaction['humidity'],
-                    location=latest_transaction['location']
-                )
-                
-                previous_hash = blockchain.hash(last_block)
-                blockchain.new_block(proof, previous_hash)
-                
-                flash('Ownership transferred successfully!', 'success')
+                transaction_data = {
+                    'sender': sender,
+                    'recipient': new_owner,
+                    'product_id': product_id,
+                    'product_name': latest_transaction['product_name'],
+                    'quantity': latest_transaction['quantity'],
+                    'timestamp': latest_transaction['timestamp'],
+                    'storage_temperature': latest_transaction['storage_temperature'],
+                    'humidity': latest_transaction['humidity'],
+                    'location': latest_transaction['location'],
+                    'version': TRANSACTION_VERSION,
+                }
+
+                # Transfers must be signed by the current owner like any other transaction
+                user_wallet = load_wallet(user['private_key'])
+                signature = user_wallet.sign_transaction(transaction_data)
+
+                tx_id, error = submit_transaction(signature=signature.hex(), public_key=sender, **transaction_data)
+                if error:
+                    flash(error, 'danger')
+                    return redirect(url_for('transfer_ownership'))
+
+                flash(f'Ownership transferred successfully! Transaction {tx_id[:12]} is pending confirmation.', 'success')
                 return redirect(url_for('dashboard'))
             else:
                 flash('You do not own this product or product does not exist!', 'danger')
@@ -281,32 +462,42 @@ def analytics_page():
     
     chain = blockchain.chain
     analytics_data = generate_plots(chain)
+    cold_chain = columnar.report(chain)
+    owner_names = users.display_names(row['owner'] for row in cold_chain['owner_throughput'])
     
     return render_template('analytics.html',
                            role=session['role'],
                            plot_url=analytics_data['plots'],
-                           stats=analytics_data['stats'])
+                           stats=analytics_data['stats'],
+                           cold_chain=cold_chain,
+                           owner_names=owner_names)
+
+@app.route('/analytics/cold_chain', methods=['GET'])
+def cold_chain_report():
+    """
+    Temperature/humidity excursions per batch, dwell time per location and throughput per owner
+    """
+    report = columnar.report(blockchain.chain)
+    owner_names = users.display_names(row['owner'] for row in report['owner_throughput'])
+    owners = [dict(row, name=owner_names.get(row['owner'])) for row in report['owner_throughput']]
+    return jsonify(dict(report, owner_throughput=owners)), 200
 
 @app.route('/mine', methods=['GET'])
 def mine():
-    # We run the proof of work algorithm to get the next proof...
-    last_block = blockchain.last_block
-    last_proof = last_block['proof']
-    proof = blockchain.proof_of_work(last_proof)
-
-    # We must receive a reward for finding the proof.
-    # The sender is "0" to signify that this node has mined a new coin.
-    blockchain.new_transaction(
-        sender="0",
-        recipient=node_identifier,
-        product_id="0",
-        product_name="Mined Coin",
-        quantity=1,
-    )
-
-    # Forge the new Block by adding it to the chain
-    previous_hash = blockchain.hash(last_block)
-    block = blockchain.new_block(proof, previous_hash)
+    blockchain.require_sealer()
+    with blockchain.lock:
+        # We must receive a reward for finding the proof.
+        # The sender is "0" to signify that this node has mined a new coin.
+        blockchain.new_transaction(
+            sender="0",
+            recipient=node_identifier,
+            product_id="0",
+            product_name="Mined Coin",
+            quantity=1,
+        )
+
+        # Forge the new Block from the reward and everything pending in the mempool
+        block = background_miner.mine_once()
 
     response = {
         'message': "New Block Forged",
@@ -314,31 +505,307 @@ def mine():
         'transactions': block['transactions'],
         'proof': block['proof'],
         'previous_hash': block['previous_hash'],
+        'consensus': blockchain.consensus.name,
     }
+    if 'difficulty' in block:
+        response['difficulty'] = block['difficulty']
+        response['hashrate'] = blockchain.miner.last_result.hashrate
+    else:
+        response['signer'] = block['signer']
     return jsonify(response), 200
 
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
-    values = request.get_json()
+    values = request.get_json(silent=True)
 
     # Check that the required fields are in the POST'ed data
-    required = ['sender', 'recipient', 'product_id', 'product_name', 'quantity']
-    if not all(k in values for k in required):
+    if not isinstance(values, dict) or not all(k in values for k in REQUIRED_FIELDS):
         return 'Missing values', 400
+    unknown = sorted(k for k in values if k not in TRANSACTION_REQUEST_FIELDS)
+    if unknown:
+        return jsonify({'message': f"Unknown fields: {', '.join(unknown)}"}), 400
+    if values['product_id'] == ANCHOR_PRODUCT_ID:
+        # Only this node's anchorer writes telemetry anchors
+        return jsonify({'message': f'{ANCHOR_PRODUCT_ID} is a reserved product_id'}), 400
+
+    # Queue the new Transaction
+    tx_id, error = submit_transaction(**{k: values[k] for k in TRANSACTION_REQUEST_FIELDS if k in values})
+    if error:
+        return jsonify({'message': error}), 400
 
-    # Create a new Transaction
-    index = blockchain.new_transaction(values['sender'], values['recipient'], values['product_id'], values['product_name'], values['quantity'])
+    response = {
+        'message': 'Transaction will be added to the next Block',
+        'tx_id': tx_id,
+        'receipt': url_for('transaction_receipt', tx_id=tx_id),
+    }
+    return jsonify(response), 201
 
-    response = {'message': f'Transaction will be added to Block {index}'}
+@app.route('/transactions/search', methods=['GET'])
+def search_transactions():
+    """
+    Finds transactions through the secondary indexes, oldest first.
+
+    Query parameters, all optional and combined with AND:
+     - sender, recipient, location, product_id: exact value
+     - since / until: ISO 8601 date or time (or seconds since the epoch) of the transaction, inclusive
+     - min_temperature / max_temperature, min_humidity / max_humidity, min_quantity / max_quantity: inclusive
+     - cursor: next_cursor from a previous page
+     - limit: transactions per page (default SEARCH_PAGE_SIZE, at most SEARCH_MAX_PAGE_SIZE)
+    """
+    equals = {field: request.args[field] for field in EQUALITY_FIELDS if request.args.get(field)}
+    ranges = {}
+    for name, (field, bound) in SEARCH_RANGES.items():
+        value = request.args.get(name)
+        if not value:
+            continue
+        number = numeric_value(field, value)
+        if number != number:
+            return jsonify({'message': f'{name} must be a number, or a date or time for since/until'}), 400
+        ranges.setdefault(field, [None, None])[bound] = number
+    try:
+        cursor = int(request.args.get('cursor', 0))
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'cursor and limit must be integers'}), 400
+
+    entries, next_cursor = blockchain.find_transactions(equals, ranges, cursor=max(cursor, 0), limit=max(limit, 1))
+    response = {
+        'transactions': entries,
+        'count': len(entries),
+        'next_cursor': next_cursor,
+        'height': len(blockchain.chain),
+    }
+    return jsonify(response), 200
+
+def telemetry_range(values):
+    """
+    :param values: <dict> Request arguments or form, with optional since and until
+    :return: <tuple> (<float> since, <float> until, <str> error or None); bounds in seconds since the epoch
+    """
+    bounds = []
+    for name in ('since', 'until'):
+        value = values.get(name)
+        bound = parse_time(value) if value else None
+        if value and bound is None:
+            return None, None, f'{name} must be a date or time'
+        bounds.append(bound)
+    return bounds[0], bounds[1], None
+
+def telemetry_report(product_id, since, until, limit):
+    """
+    A product's readings in a time range, with the anchors covering them checked against the ledger
+    """
+    telemetry_log.refresh()
+    report = telemetry_log.query(product_id, since, until, limit)
+    report['anchors'], report['unanchored_frames'] = anchor_windows(telemetry_log, blockchain.telemetry_anchors, report['frames'])
+    return report
+
+def telemetry_view(product_id, form):
+    """
+    Template variables for the telemetry section of the tracking pages
+    """
+    since, until, error = telemetry_range(form)
+    if error:
+        flash(error, 'danger')
+        telemetry = None
+    else:
+        telemetry = telemetry_report(product_id, since, until, TELEMETRY_VIEW_ROWS)
+    return {'telemetry': telemetry, 'since': form.get('since', ''), 'until': form.get('until', '')}
+
+def telemetry_key_valid(key):
+    """
+    :param key: <str> API key sent with the request, or None
+    :return: <bool> True if it is the configured TELEMETRY_API_KEY
+    """
+    if not TELEMETRY_API_KEY or not key:
+        return False
+    return hmac.compare_digest(key.encode(), TELEMETRY_API_KEY.encode())
+
+@app.route('/telemetry', methods=['POST'])
+def ingest_telemetry():
+    """
+    Stores batches of sensor readings off-chain; they are anchored into the ledger every few minutes.
+
+    The body is one batch or a list of them:
+    {"product_id": "B1", "readings": [{"timestamp": "2024-05-01T10:00:00", "storage_temperature": 4.2, "humidity": 55}, ...]}
+
+    Needs a logged-in session, or the TELEMETRY_API_KEY in an X-API-Key header.
+    """
+    if 'email' not in session and not telemetry_key_valid(request.headers.get('X-API-Key')):
+        return jsonify({'message': 'Login required'}), 401
+    values = request.get_json(silent=True)
+    batches = values if isinstance(values, list) else [values]
+    if not values or not all(isinstance(batch, dict) for batch in batches):
+        return jsonify({'message': 'Expected a batch of readings or a list of batches'}), 400
+
+    parsed = []
+    for position, batch in enumerate(batches):
+        product_id = batch.get('product_id')
+        if not product_id or product_id == ANCHOR_PRODUCT_ID or blockchain.latest_transaction(product_id) is None:
+            return jsonify({'message': f'batch {position}: unknown product_id {product_id}'}), 404
+        readings, errors = parse_readings(batch.get('readings'))
+        if errors:
+            return jsonify({'message': f'batch {position}: invalid readings', 'errors': errors[:20]}), 400
+        parsed.append((product_id, readings))
+
+    # Batches are checked first, so a request is stored whole or not at all
+    frames = [telemetry_log.append(product_id, readings) for product_id, readings in parsed]
+    response = {
+        'message': 'Readings stored; they will be anchored into the next telemetry window',
+        'readings': sum(len(readings) for _, readings in parsed),
+        'frames': frames,
+    }
     return jsonify(response), 201
 
+@app.route('/telemetry/<product_id>', methods=['GET'])
+def product_telemetry(product_id):
+    """
+    A product's sensor readings, oldest first, with the anchors covering them.
+    Query parameters: since / until (ISO 8601 date or time, or seconds since the epoch, inclusive)
+    and limit (readings returned, default TELEMETRY_PAGE_SIZE; count and extremes cover the whole range).
+    """
+    since, until, error = telemetry_range(request.args)
+    if error:
+        return jsonify({'message': error}), 400
+    try:
+        limit = min(max(int(request.args.get('limit', TELEMETRY_PAGE_SIZE)), 0), TELEMETRY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'limit must be an integer'}), 400
+    return jsonify(telemetry_report(product_id, since, until, limit)), 200
+
+@app.route('/transactions/<tx_id>', methods=['GET'])
+def transaction_receipt(tx_id):
+    receipt = mempool.receipt(tx_id)
+    if receipt is None:
+        return jsonify({'message': 'Unknown transaction'}), 404
+    return jsonify(receipt), 200
+
+@app.route('/products/<product_id>/proof', methods=['GET'])
+def product_proof(product_id):
+    # Lets a retailer or auditor check provenance with blockchain.verify_inclusion
+    # instead of downloading the whole chain
+    entries = blockchain.product_proofs(product_id)
+    if not entries:
+        return jsonify({'message': 'Unknown product'}), 404
+
+    response = {
+        'product_id': product_id,
+        'transactions': entries,
+        'height': len(blockchain.chain),
+        'tip_hash': blockchain.block_hash(len(blockchain.chain)),
+    }
+    return jsonify(response), 200
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
+    """
+    Returns a page of the chain.
+
+    Query parameters:
+     - start / end: block indexes to return, inclusive (default: the whole chain)
+     - cursor: next_cursor from a previous page, takes precedence over start
+     - limit: blocks per page (default CHAIN_PAGE_SIZE, at most CHAIN_MAX_PAGE_SIZE)
+     - headers_only: leave out transactions
+     - format=ndjson: stream every block in the range, one JSON document per line
+    """
+    height = len(blockchain.chain)
+    try:
+        start = int(request.args.get('cursor') or request.args.get('start', 1))
+        end = min(int(request.args.get('end', height)), height)
+        limit = min(int(request.args.get('limit', CHAIN_PAGE_SIZE)), CHAIN_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({'message': 'start, end, cursor and limit must be integers'}), 400
+    start = max(start, 1)
+    end = max(end, start - 1)
+    headers_only = request.args.get('headers_only', '').lower() in ('1', 'true', 'yes')
+    stream = request.args.get('format') == 'ndjson'
+
+    # The response only changes when the chain does, so pollers that are up to
+    # date get a 304 without anything being serialized
+    etag = hashlib.sha256(f"{height}:{blockchain.block_hash(height)}:{request.query_string.decode()}".encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+
+    view = blockchain.header_view if headers_only else (lambda block: block)
+
+    if stream:
+        def generate():
+            # Read the log block by block as the response is sent, rather than the whole range up front
+            for block in blockchain.chain.iter_range(start - 1, end):
+                yield json.dumps(view(block), separators=(',', ':'), default=to_json) + '\n'
+
+        response = Response(generate(), mimetype='application/x-ndjson')
+    else:
+        page_end = min(end, start + max(limit, 1) - 1)
+        response = jsonify({
+            'chain': [view(block) for block in blockchain.chain[start - 1:page_end]],
+            'length': height,
+            'start': start,
+            'end': page_end,
+            'next_cursor': page_end + 1 if page_end < end else None,
+        })
+    response.set_etag(etag)
+    return response
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.registry.render(), content_type=metrics.CONTENT_TYPE)
+
+@app.route('/nodes/register', methods=['POST'])
+def register_nodes():
+    values = request.get_json()
+
+    nodes = values.get('nodes') if values else None
+    if not nodes:
+        return "Error: Please supply a valid list of nodes", 400
+
+    try:
+        for node in nodes:
+            blockchain.register_node(node)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    response = {
+        'message': 'New nodes have been added',
+        'total_nodes': list(blockchain.nodes),
+    }
+    return jsonify(response), 201
+
+@app.route('/nodes/resolve', methods=['GET'])
+def consensus():
+    blockchain.require_writer()
+    old_tip = blockchain.block_hash(len(blockchain.chain))
+    old_height = len(blockchain.chain)
+    results = NodeSync(blockchain).resolve_conflicts([HttpTransport(node) for node in sorted(blockchain.nodes)])
+    replaced = any(r.replaced for r in results)
+    if replaced and any(r.ancestor is not None and r.ancestor < old_height for r in results):
+        reset_aggregates()
+
     response = {
-        'chain': blockchain.chain,
+        'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
         'length': len(blockchain.chain),
+        'previous_tip': old_tip,
+        'peers': [
+            {
+                'node': r.node,
+                'replaced': r.replaced,
+                'common_ancestor': r.ancestor,
+                'blocks_downloaded': r.blocks,
+                'bytes_downloaded': r.bytes,
+                'seconds': round(r.elapsed, 3),
+                'blocks_per_second': round(r.blocks / r.elapsed, 1) if r.elapsed > 0 else None,
+                'error': r.error,
+            }
+            for r in results
+        ],
     }
     return jsonify(response), 200
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    args = parser.parse_args()
+    app.run(debug=True, port=args.port)
@@ -0,0 +1,400 @@
+"""
+Benchmarks for the hot paths: mining, persistence, hashing, product lookups,
+analytics and signatures, run against synthetic ledgers of increasing size.
+
+    python benchmark.py --sizes 1000,10000,100000 --output bench.json
+    python benchmark.py --baseline benchmark_baseline.json    # compare
+    python benchmark.py --save-baseline benchmark_baseline.json
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import tempfile
+from datetime import datetime, timedelta
+from time import perf_counter, time
+
+DEFAULT_SIZES = (1000, 10000, 100000)
+TRANSACTIONS_PER_BLOCK = 100
+REGRESSION_TOLERANCE = 1.25  # flag anything this much slower than the baseline
+
+PRODUCT_NAMES = ('Milk', 'Tea', 'Rice', 'Cinnamon', 'Coconut', 'Pepper', 'Cashew', 'Banana')
+LOCATIONS = ('Colombo', 'Kandy', 'Galle', 'Jaffna', 'Negombo', 'Matara')
+
+
+def fake_pem(rng):
+    body = base64.b64encode(rng.getrandbits(294 * 8).to_bytes(294, 'big')).decode()
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return '-----BEGIN PUBLIC KEY-----\n' + '\n'.join(lines) + '\n-----END PUBLIC KEY-----\n'
+
+
+def generate_ledger(transactions, per_block=TRANSACTIONS_PER_BLOCK, products=None, seed=42, pem_keys=False):
+    """
+    Builds a synthetic, hash-linked ledger. Proofs and signatures are placeholders,
+    so the ledger is for timing only and does not pass validation.
+    :param transactions: <int> Number of transactions
+    :param per_block: <int> Transactions per block
+    :param products: <int> Distinct product batches (default: a tenth of the transactions)
+    :param pem_keys: <bool> Use ~450 byte RSA-style PEM keys for senders and owners instead of ed25519 ones
+    :return: <list> Blocks
+    """
+    from blockchain import Blockchain
+    from encoding import BLOCK_VERSION, TRANSACTION_VERSION, transactions_root
+
+    rng = random.Random(seed)
+    products = products or max(transactions // 10, 1)
+    if pem_keys:
+        owners = [fake_pem(rng) for _ in range(50)]
+    else:
+        owners = [f'ed25519:{rng.getrandbits(256):064x}' for _ in range(50)]
+    start = datetime(2024, 1, 1)
+
+    chain = [{'index': 1, 'timestamp': time(), 'transactions': [], 'proof': 100, 'previous_hash': '1',
+              'version': BLOCK_VERSION, 'merkle_root': transactions_root([])}]
+    made = 0
+    while made < transactions:
+        batch = []
+        for _ in range(min(per_block, transactions - made)):
+            product = rng.randrange(products)
+            batch.append({
+                'sender': rng.choice(owners),
+                'recipient': rng.choice(owners),
+                'product_id': f'BATCH-{product:07d}',
+                'product_name': PRODUCT_NAMES[product % len(PRODUCT_NAMES)],
+                'quantity': str(rng.randint(1, 500)),
+                'timestamp': (start + timedelta(minutes=37 * made)).strftime('%Y-%m-%dT%H:%M'),
+                'storage_temperature': f'{rng.gauss(4, 2):.1f}',
+                'humidity': f'{rng.uniform(40, 90):.0f}',
+                'location': rng.choice(LOCATIONS),
+                'version': TRANSACTION_VERSION,
+                'signature': f'{rng.getrandbits(512):0128x}',
+            })
+            made += 1
+        previous = chain[-1]
+        block = {
+            'index': previous['index'] + 1,
+            'timestamp': time(),
+            'transactions': batch,
+            'proof': rng.randrange(1 << 20),
+            'previous_hash': Blockchain.hash(previous),
+            'version': BLOCK_VERSION,
+        }
+        block['merkle_root'] = transactions_root(batch)
+        chain.append(block)
+    return chain
+
+
+def measure(fn, repeat=5, number=1, setup=None):
+    """
+    :return: <float> Median seconds per call of fn
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        started = perf_counter()
+        for _ in range(number):
+            fn()
+        timings.append((perf_counter() - started) / number)
+    return statistics.median(timings)
+
+
+class BenchmarkRun:
+    def __init__(self, sizes, quick=False):
+        self.sizes = sizes
+        self.quick = quick
+        self.results = []
+        self.workdir = tempfile.mkdtemp(prefix='scm-bench-')
+
+    def record(self, benchmark, size, seconds, **extra):
+        entry = {'benchmark': benchmark, 'size': size, 'seconds': seconds}
+        entry.update(extra)
+        self.results.append(entry)
+        note = ''
+        if 'ops_per_second' in extra:
+            note = f" ({extra['ops_per_second']:.0f} ops/s)"
+        elif 'bytes_per_transaction' in extra:
+            note = f" ({extra['bytes_per_transaction']:.0f} bytes/tx)"
+        print(f"  {benchmark:<40} n={size:<9} {seconds * 1000:10.3f} ms{note}")
+
+    def run(self):
+        try:
+            self.bench_mining()
+            self.bench_consensus()
+            self.bench_signatures()
+            for size in self.sizes:
+                print(f"Ledger with {size} transactions")
+                chain = generate_ledger(size)
+                self.bench_hashing(chain, size)
+                self.bench_persistence(chain, size)
+                self.bench_lookups(chain, size)
+                self.bench_analytics(chain, size)
+                self.bench_telemetry(size)
+                self.bench_memory(size)
+        finally:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+        return self.results
+
+    def bench_mining(self):
+        from miner import Miner
+        print("Proof of work")
+        last_proofs = list(range(100, 103 if self.quick else 110))
+        for workers in sorted({1, os.cpu_count() or 1}):
+            miner = Miner(workers=workers)
+            miner.mine(1)  # start the pool outside the timing
+            attempts = 0
+            started = perf_counter()
+            for last_proof in last_proofs:
+                attempts += miner.mine(last_proof).attempts
+            elapsed = perf_counter() - started
+            miner.shutdown()
+            self.record(f'proof_of_work.workers_{workers}', len(last_proofs), elapsed / len(last_proofs),
+                        hashrate=attempts / elapsed)
+
+    def bench_consensus(self):
+        from blockchain import Blockchain
+        from consensus import ProofOfAuthority, ProofOfWork
+        from storage import DURABILITY_NONE
+        from wallet import Wallet
+        print("Block creation")
+        authority = Wallet()
+        engines = {
+            'pow': ProofOfWork(),
+            'poa': ProofOfAuthority([authority.public_key], wallet=authority),
+        }
+        blocks = 3 if self.quick else 10
+        for name, engine in engines.items():
+            directory = os.path.join(self.workdir, f'consensus-{name}')
+            blockchain = Blockchain(data_dir=directory, durability=DURABILITY_NONE, mining_workers=1,
+                                    verify_on_load=False, consensus=engine)
+            seconds = measure(blockchain.mine_pending, repeat=blocks)
+            blockchain.log.close()
+            blockchain.miner.shutdown()
+            self.record(f'consensus.new_block.{name}', 1, seconds, ops_per_second=1 / seconds)
+
+    def bench_signatures(self):
+        from wallet import Wallet, ALGORITHMS
+        print("Signatures")
+        transaction = generate_ledger(1)[1]['transactions'][0]
+        for algorithm in ALGORITHMS:
+            self.record(f'wallet.generate.{algorithm}', 1, measure(lambda: Wallet(algorithm=algorithm), repeat=3))
+            wallet = Wallet(algorithm=algorithm)
+            signature = wallet.sign_transaction(transaction)
+            sign = measure(lambda: wallet.sign_transaction(transaction), number=20)
+            self.record(f'wallet.sign.{algorithm}', 1, sign, ops_per_second=1 / sign)
+            verify = measure(lambda: Wallet.verify_signature(transaction, signature, wallet.public_key), number=20)
+            self.record(f'wallet.verify.{algorithm}', 1, verify, ops_per_second=1 / verify)
+
+    def bench_hashing(self, chain, size):
+        from blockchain import Blockchain
+        block = chain[-1]
+        legacy = {k: v for k, v in block.items() if k not in ('version', 'merkle_root')}
+        self.record('hash.header', size, measure(lambda: Blockchain.hash(block), number=100))
+        self.record('hash.legacy_full_block', size, measure(lambda: Blockchain.hash(legacy), number=100))
+
+    def bench_persistence(self, chain, size):
+        from storage import BlockLog, DURABILITY_NONE
+        directory = os.path.join(self.workdir, f'log-{size}')
+
+        def write_all():
+            shutil.rmtree(directory, ignore_errors=True)
+            log = BlockLog(directory, durability=DURABILITY_NONE)
+            for block in chain:
+                log.append(block)
+            log.close()
+
+        write = measure(write_all, repeat=1 if size > 100000 else 3)
+        self.record('save_chain.append_per_block', size, write / len(chain))
+        self.record('load_chain.recover', size, measure(lambda: BlockLog(directory).recover(), repeat=3))
+        self.record('load_chain.attach', size, measure(lambda: BlockLog(directory).attach(), repeat=3))
+        self.bench_startup(directory, size)
+
+        # For comparison: the whole-file rewrite new_block used to do for every block
+        path = os.path.join(self.workdir, 'chain.json')
+
+        def rewrite():
+            with open(path, 'w') as f:
+                json.dump(chain, f, indent=4)
+
+        self.record('save_chain.legacy_full_rewrite', size, measure(rewrite, repeat=1 if size > 100000 else 3))
+
+    def bench_startup(self, directory, size):
+        from blockchain import Blockchain
+
+        def boot(**kwargs):
+            blockchain = Blockchain(data_dir=directory, mining_workers=1, verify_on_load=False, **kwargs)
+            blockchain.wait_for_snapshot()
+            blockchain.log.close()
+
+        self.record('startup.full_replay', size, measure(lambda: boot(snapshot_interval=0), repeat=1))
+        boot(snapshot_interval=1)  # leaves a world state snapshot at the tip
+        self.record('startup.from_snapshot', size, measure(lambda: boot(snapshot_interval=0), repeat=3))
+
+    def bench_lookups(self, chain, size):
+        from blockchain import Blockchain
+        directory = os.path.join(self.workdir, f'lookup-{size}')
+        blockchain = Blockchain(data_dir=directory, mining_workers=1, verify_on_load=False)
+        blockchain.chain = chain
+        blockchain._block_hashes.clear()
+        self.record('product_index.rebuild', size, measure(blockchain.rebuild_product_index, repeat=3))
+        self.record('product_postings.build', size,
+                    measure(lambda: blockchain.postings.catch_up(chain, blockchain.block_hash), repeat=1,
+                            setup=lambda: blockchain.postings.truncate(0)))
+
+        rng = random.Random(7)
+        product_ids = [rng.choice(list(blockchain.product_latest)) for _ in range(200)]
+        ids = iter(product_ids * 1000)
+        history = measure(lambda: blockchain.product_transactions(next(ids)), number=len(product_ids))
+        self.record('lookup.product_history', size, history, ops_per_second=1 / history)
+        latest = measure(lambda: blockchain.latest_transaction(next(ids)), number=len(product_ids))
+        self.record('lookup.transfer_latest_transaction', size, latest, ops_per_second=1 / latest)
+
+        def scan(product_id):
+            return [tx for block in chain for tx in block['transactions'] if tx['product_id'] == product_id]
+
+        self.record('lookup.legacy_full_scan', size, measure(lambda: scan(next(ids)), repeat=3))
+
+        index = blockchain.transaction_index
+        self.record('transaction_index.build', size,
+                    measure(lambda: (index.sync(chain), index.query(limit=1)), repeat=1, setup=index.reset))
+        locations = sorted(index.postings['location'])
+        query = measure(lambda: blockchain.find_transactions({'location': rng.choice(locations)},
+                                                             {'storage_temperature': (8.0, None)}),
+                        number=len(product_ids))
+        self.record('lookup.location_and_temperature_query', size, query, ops_per_second=1 / query)
+
+    def bench_analytics(self, chain, size):
+        import analytics
+        if size > 100000 and self.quick:
+            return
+        self.record('analytics.generate_plots.cold', size,
+                    measure(lambda: analytics.generate_plots(chain), repeat=1, setup=analytics.reset))
+        self.record('analytics.generate_plots.cached', size, measure(lambda: analytics.generate_plots(chain), number=10))
+        grown = chain + [dict(chain[-1], index=chain[-1]['index'] + 1)]
+        self.record('analytics.generate_plots.one_new_block', size, measure(lambda: analytics.generate_plots(grown), repeat=1))
+
+        import columnar
+        store = columnar.TransactionColumns()
+        self.record('columnar.sync', size, measure(lambda: store.sync(chain), repeat=1, setup=store.reset))
+        store.columns()
+        self.record('columnar.cold_chain_report', size, measure(lambda: columnar.cold_chain_report(store)))
+
+    def bench_telemetry(self, size, batch=1000):
+        from telemetry import TelemetryLog
+        rng = random.Random(11)
+        start = 1714550400.0
+        # One reading a second from each of 10 batches, sent in batches of `batch` readings
+        batches = [
+            (f'B{n % 10}', [(start + n * batch + i, rng.uniform(2, 8), rng.uniform(40, 60)) for i in range(batch)])
+            for n in range(max(size // batch, 1))
+        ]
+        readings = sum(len(batch_readings) for _, batch_readings in batches)
+        directory = os.path.join(self.workdir, f'telemetry-{size}')
+
+        def ingest():
+            shutil.rmtree(directory, ignore_errors=True)
+            log = TelemetryLog(directory)
+            for product_id, batch_readings in batches:
+                log.append(product_id, batch_readings)
+            log.close()
+
+        seconds = measure(ingest, repeat=3)
+        self.record('telemetry.ingest_per_reading', readings, seconds / readings, ops_per_second=readings / seconds,
+                    bytes_per_reading=os.path.getsize(os.path.join(directory, 'readings.log')) / readings)
+        log = TelemetryLog(directory)
+        self.record('telemetry.open', readings, measure(lambda: TelemetryLog(directory).close(), repeat=3))
+        middle = start + readings / 2
+        self.record('telemetry.query_one_hour', readings, measure(lambda: log.query('B0', middle, middle + 3600)))
+        self.record('telemetry.anchor_root', readings, measure(lambda: log.root(0, len(log) - 1), repeat=3))
+        log.close()
+
+    def bench_memory(self, size):
+        import tracemalloc
+        import ledger
+        # As stored in the block log: every block is decoded on its own, so
+        # nothing is shared between blocks unless the loader shares it
+        records = [json.dumps(block) for block in generate_ledger(size, pem_keys=True)]
+
+        def load(decode):
+            tracemalloc.start()
+            started = perf_counter()
+            blocks = [decode(json.loads(record)) for record in records]
+            elapsed = perf_counter() - started
+            allocated, _ = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del blocks
+            return elapsed, allocated
+
+        elapsed, as_dicts = load(lambda block: block)
+        self.record('memory.dict_ledger', size, elapsed, bytes=as_dicts, bytes_per_transaction=as_dicts / size)
+        elapsed, compact = load(ledger.compact_block)
+        self.record('memory.compact_ledger', size, elapsed, bytes=compact, bytes_per_transaction=compact / size,
+                    saved_per_million_transactions=(as_dicts - compact) / size * 1000000)
+
+
+def compare(results, baseline, tolerance=REGRESSION_TOLERANCE):
+    """
+    Prints each result against the baseline
+    :return: <list> Names of benchmarks that regressed
+    """
+    previous = {(entry['benchmark'], entry['size']): entry for entry in baseline['results']}
+    regressions = []
+    print(f"\nCompared with baseline from {baseline['meta']['timestamp']}")
+    for entry in results:
+        key = (entry['benchmark'], entry['size'])
+        if key not in previous:
+            continue
+        # Memory benchmarks are compared on bytes, everything else on time
+        measure_key = 'bytes' if 'bytes' in entry else 'seconds'
+        if not previous[key].get(measure_key):
+            continue
+        ratio = entry[measure_key] / previous[key][measure_key]
+        flag = ''
+        if ratio > tolerance:
+            flag = '  REGRESSION'
+            regressions.append(f'{key[0]}@{key[1]}')
+        print(f"  {key[0]:<40} n={key[1]:<9} {ratio:6.2f}x {measure_key}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the supply chain hot paths.')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated ledger sizes in transactions, e.g. 1000,10000,1000000')
+    parser.add_argument('--quick', action='store_true', help='fewer mining rounds, skip cold analytics on big ledgers')
+    parser.add_argument('--output', default='bench.json', help='where to write the results')
+    parser.add_argument('--baseline', help='baseline results to compare against')
+    parser.add_argument('--save-baseline', help='also write the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=REGRESSION_TOLERANCE)
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(',') if size]
+    results = BenchmarkRun(sizes, quick=args.quick).run()
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'sizes': sizes,
+        },
+        'results': results,
+    }
+    for path in filter(None, (args.output, args.save_baseline)):
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {path}")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} benchmark(s) regressed: {', '.join(regressions)}")
+
+
+if __name__ == '__main__':
+    main()
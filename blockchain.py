@@ -1,55 +1,329 @@
 import hashlib
 import json
 import os
-from time import time
+import threading
+from time import perf_counter, sleep, time
+from urllib.parse import urlparse
 from uuid import uuid4
 
+import metrics
+from consensus import ConsensusError, ProofOfWork
+from ledger import compact_block, compact_transaction, to_json
+from encoding import (BLOCK_VERSION, block_header, header_hash, transaction_hash, transactions_root,
+                      unique_transactions)
+from merkle import merkle_proof, verify_merkle_proof
+from miner import DEFAULT_DIFFICULTY, Miner, valid_proof
+from postings import POSTINGS_DB, ProductPostings
+from snapshot import SNAPSHOT_INTERVAL, drop_snapshots, load_snapshot, save_snapshot
+from storage import BlockLog, LazyChain, WriterLock, DURABILITY_ALWAYS
+from telemetry import AnchorIndex, is_anchor
+from txindex import QUERY_PAGE_SIZE, TransactionIndex
+from validator import ChainValidator, checkpoint_start, load_checkpoint, save_checkpoint
+
+CHAIN_FILE = 'chain.json'
+DATA_DIR = 'chain_data'
+
+# How long a reader started alongside a brand new ledger waits for the writer's genesis block
+GENESIS_WAIT_SECONDS = 10
+
+SAVE_SECONDS = metrics.histogram('chain_save_duration_seconds', 'Time spent appending new blocks to the block log.')
+SAVE_BYTES = metrics.counter('chain_save_bytes_total', 'Bytes appended to the block log.')
+
+class NotWriterError(RuntimeError):
+    """
+    Raised when a process that does not hold the writer lock tries to add or replace blocks
+    """
+
+
+class InvalidChainError(ValueError):
+    """
+    Raised when the block log holds an invalid block and this process would become its writer
+    """
+
+
 class Blockchain:
-    def __init__(self):
+    """
+    The ledger of one node. Several processes may open the same data directory:
+    the first one to take the writer lock appends blocks, and the others are
+    readers that follow the block log with follow_log().
+    """
+
+    def __init__(self, data_dir=DATA_DIR, durability=DURABILITY_ALWAYS, mining_workers=None, verify_on_load=True,
+                 snapshot_interval=SNAPSHOT_INTERVAL, consensus=None, truncate_invalid=False):
         self.chain = []
         self.current_transactions = []
         self.nodes = set()
+        self.data_dir = data_dir
+        self.verify_on_load = verify_on_load
+        # On an invalid block: drop it and everything after it, or refuse to write (the default)
+        self.truncate_invalid = truncate_invalid
+        self.snapshot_interval = snapshot_interval
+        self.log = BlockLog(data_dir, durability=durability)
+        self.writer_lock = WriterLock(data_dir)
+        self.writer = self.writer_lock.acquire()
+        self.miner = Miner(workers=mining_workers)
+        # Seals new blocks and checks the seals of loaded and synced ones; see consensus.py
+        self.consensus = consensus or ProofOfWork()
+        # Guards current_transactions and block creation against concurrent writers
+        self.lock = threading.RLock()
+
+        # product_id -> ordered list of (block index, position in block), kept on disk by the writer
+        self.postings = ProductPostings(os.path.join(data_dir, POSTINGS_DB))
+        # product_id -> latest transaction for that product
+        self.product_latest = {}
+        # product_id -> number of transactions for that product on the whole chain
+        self.product_counts = {}
+        self.transaction_count = 0
+        # Telemetry anchors by the frames they cover
+        self.telemetry_anchors = AnchorIndex()
+        # Secondary indexes by sender, recipient, location, time and readings, built on first query
+        self.transaction_index = TransactionIndex()
+        # Height of the newest world state snapshot on disk, or being written by _snapshot_writer
+        self.snapshot_height = 0
+        self._snapshot_writer = None
+        # Block index -> hash; blocks never change once they are on the chain
+        self._block_hashes = {}
+        # Blocks a reader has indexed so far; see follow_log
+        self._followed = 0
         
         # Load chain if exists, else create genesis block
-        if os.path.exists('chain.json'):
-            self.load_chain()
-        else:
+        self.load_chain()
+        if not self.chain and not self.writer:
+            self.wait_for_genesis()
+        if not self.chain and self.writer:
             # Create the genesis block
             self.new_block(previous_hash='1', proof=100)
 
     def load_chain(self):
-        try:
-            with open('chain.json', 'r') as f:
-                self.chain = json.load(f)
-        except (ValueError, json.JSONDecodeError):
-             self.new_block(previous_hash='1', proof=100)
+        """
+        Opens the block log without reading it back, then restores the world state
+        from the newest snapshot and replays only the blocks after it
+        """
+        if not self.writer:
+            # Recovery, migration and checkpoints are left to the writer
+            self.log.follow()
+            self.chain = LazyChain(self.log, decode=compact_block)
+            self.restore_world_state()
+            self._followed = len(self.chain)
+            return
+        if not self.log.attach() and os.path.exists(CHAIN_FILE):
+            # Existing installs keep their ledger in a single chain.json
+            self.log.migrate_from_json(CHAIN_FILE)
+        # Blocks are read on demand and kept compact in memory; see ledger.Record
+        self.chain = LazyChain(self.log, decode=compact_block)
+        if self.verify_on_load:
+            self.verify_loaded_chain()
+        self.restore_world_state()
+        self.postings.catch_up(self.chain, self.block_hash)
+        self.maybe_snapshot()
+
+    def verify_loaded_chain(self):
+        """
+        Validates the blocks beyond the last checkpoint and moves the checkpoint up.
+        An invalid block is dropped along with every block after it if truncate_invalid
+        is set; otherwise this process gives up the writer lock.
+        :return: <ValidationResult>
+        :raises InvalidChainError: if the chain is invalid and truncate_invalid is not set
+        """
+        start = checkpoint_start(self.chain, load_checkpoint(self.data_dir))
+        result = ChainValidator(consensus=self.consensus).validate(self.chain, start=start)
+        if not result.valid:
+            if not self.truncate_invalid:
+                self.writer = False
+                self.writer_lock.release()
+                raise InvalidChainError(
+                    f"Chain validation failed: {result.error}. Refusing to write to {self.data_dir}; restore it "
+                    f"from a backup or a peer, or start with truncate_invalid to drop the blocks after {result.height}")
+            print(f"Chain validation failed: {result.error}; dropping blocks {result.height + 1} to {len(self.chain)}")
+            self.wait_for_snapshot()
+            del self.chain[result.height:]
+            drop_snapshots(self.data_dir, above=result.height)
+        if result.height:
+            save_checkpoint(self.data_dir, result.height, self.block_hash(result.height))
+        return result
+
+    def follow_log(self):
+        """
+        Brings a reader up to date with the blocks the writer appended since the last call.
+        If the writer has exited, this process takes the writer lock and becomes the writer.
+        :return: <tuple> (<int> blocks added, <bool> True if the chain was reloaded from scratch
+                 because blocks were rewritten or this process became the writer)
+        """
+        with self.lock:
+            if self.writer:
+                return 0, False
+            height = self._followed or 0
+            if self.writer_lock.acquire():
+                self.writer = True
+                self.log.attach()
+                if self.verify_on_load:
+                    # Readers only trust the writer; check what it left behind before appending to it
+                    self.verify_loaded_chain()
+                print(f"Took over as the writer of {self.data_dir}")
+                self._reload()
+                self.postings.catch_up(self.chain, self.block_hash)
+                self.maybe_snapshot()
+                return len(self.chain) - height, True
+            if not self.log.follow() or self._followed is None:
+                self._reload()
+                return len(self.chain) - height, True
+            for position in range(height, len(self.chain)):
+                block = self.chain[position]
+                self._index_block(block)
+                self.transaction_index.follow(block)
+                self._followed = position + 1
+            return self._followed - height, False
+
+    def _reload(self):
+        # Left as None if restoring fails, so the next follow_log starts over
+        self._followed = None
+        self.chain.forget()
+        self._block_hashes.clear()
+        self.transaction_index.reset()
+        self.restore_world_state()
+        self._followed = len(self.chain)
+
+    def wait_for_genesis(self, timeout=GENESIS_WAIT_SECONDS):
+        """
+        Waits for the writer of a brand new ledger to append its first block
+        """
+        deadline = time() + timeout
+        while not self.chain and not self.writer and time() < deadline:
+            sleep(0.1)
+            self.follow_log()
+        if not self.chain and not self.writer:
+            print(f"No blocks in {self.data_dir} yet; waiting for the writer")
+
+    def require_writer(self):
+        """
+        :raises NotWriterError: if this process only reads the ledger
+        """
+        if not self.writer:
+            raise NotWriterError(f"Another process holds the writer lock on {self.data_dir}")
+
+    def require_sealer(self):
+        """
+        :raises NotWriterError: if this process only reads the ledger
+        :raises ConsensusError: if the consensus engine does not let this node seal blocks
+        """
+        self.require_writer()
+        if not self.consensus.can_seal():
+            raise ConsensusError(f"This node cannot seal blocks under {self.consensus.name} consensus")
+
+    def valid_chain(self, chain):
+        """
+        Determine if a given blockchain is valid: hash links, seals and transaction signatures
+        :param chain: <list> A blockchain
+        :return: <bool> True if valid, False if not
+        """
+        return ChainValidator(consensus=self.consensus).validate(chain).valid
 
     def save_chain(self):
-        with open('chain.json', 'w') as f:
-            json.dump(self.chain, f, indent=4)
+        """
+        Persists the blocks that are not yet in the block log
+        """
+        started = perf_counter()
+        written = self.chain.flush()
+        if written:
+            SAVE_SECONDS.observe(perf_counter() - started)
+            SAVE_BYTES.inc(written)
 
     def new_block(self, proof, previous_hash=None):
         """
         Create a new Block in the Blockchain
-        :param proof: <int> The proof given by the Proof of Work algorithm
+        :param proof: <int> The proof given by the Proof of Work algorithm, or None to have the
+                      consensus engine seal the block
         :param previous_hash: (Optional) <str> Hash of previous Block
         :return: <dict> New Block
         """
-        block = {
-            'index': len(self.chain) + 1,
-            'timestamp': time(),
-            'transactions': self.current_transactions,
-            'proof': proof,
-            'previous_hash': previous_hash or self.hash(self.chain[-1]),
-        }
-        # Reset the current list of transactions
-        self.current_transactions = []
-        self.chain.append(block)
-        
-        self.save_chain()
-        
+        self.require_writer()
+        with self.lock:
+            block = {
+                'index': len(self.chain) + 1,
+                'timestamp': time(),
+                'transactions': unique_transactions(self.current_transactions),
+                'proof': proof,
+                'previous_hash': previous_hash or self.block_hash(len(self.chain)),
+                'version': BLOCK_VERSION,
+            }
+            block['merkle_root'] = transactions_root(block['transactions'])
+            if proof is None:
+                self.consensus.seal(self, block)
+            block = compact_block(block)
+            # Reset the current list of transactions
+            transactions, self.current_transactions = self.current_transactions, []
+            self.chain.append(block)
+            try:
+                self.save_chain()
+            except Exception:
+                # Drop the block from memory and from the log, so the chain is as before and can be retried
+                del self.chain[block['index'] - 1:]
+                self._block_hashes.pop(block['index'], None)
+                self.current_transactions = transactions
+                raise
+            # Index only blocks that made it into the log
+            self._index_block(block)
+            self.transaction_index.follow(block)
+            self.postings.add([block], [self.block_hash(block['index'])])
+            self.maybe_snapshot()
+
         return block
 
+    def replace_tail(self, ancestor, blocks):
+        """
+        Switches to another chain that shares our first `ancestor` blocks
+        :param ancestor: <int> Height of the last block both chains have in common
+        :param blocks: <list> The other chain's blocks after the common ancestor, already validated
+        """
+        self.require_writer()
+        blocks = [compact_block(block) for block in blocks]
+        with self.lock:
+            if ancestor < len(self.chain):
+                # A snapshot still being written may be of a block that is about to go
+                self.wait_for_snapshot()
+                del self.chain[ancestor:]
+                for index in [i for i in self._block_hashes if i > ancestor]:
+                    del self._block_hashes[index]
+                drop_snapshots(self.data_dir, above=ancestor)
+                self.postings.truncate(ancestor)
+                self.transaction_index.reset()
+                self.chain.extend(blocks)
+                self.save_chain()
+                self.restore_world_state()
+            else:
+                self.chain.extend(blocks)
+                for block in blocks:
+                    self._index_block(block)
+                    self.transaction_index.follow(block)
+                self.save_chain()
+            self.postings.add(blocks, [self.block_hash(block['index']) for block in blocks])
+            save_checkpoint(self.data_dir, len(self.chain), self.block_hash(len(self.chain)))
+            self.maybe_snapshot()
+
+    def register_node(self, address):
+        """
+        Add a new node to the list of nodes
+        :param address: <str> Address of node. Eg. 'http://192.168.0.5:5000'
+        """
+        parsed_url = urlparse(address)
+        if parsed_url.netloc:
+            self.nodes.add(parsed_url.netloc)
+        elif parsed_url.path:
+            # Accepts an URL without scheme like '192.168.0.5:5000'.
+            self.nodes.add(parsed_url.path)
+        else:
+            raise ValueError('Invalid URL')
+
+    def mine_pending(self):
+        """
+        Forges the next block from current_transactions, sealed by the consensus engine:
+        mined under proof of work, signed under proof of authority
+        :return: <dict> New Block
+        """
+        self.require_sealer()
+        with self.lock:
+            return self.new_block(None, self.block_hash(self.last_block['index']))
+
     def new_transaction(self, sender, recipient, product_id, product_name, quantity, signature=None, public_key=None, **kwargs):
         """
         Creates a new transaction to go into the next mined Block
@@ -63,6 +337,21 @@ class Blockchain:
         :param kwargs: <dict> Additional transaction data
         :return: <int> The index of the Block that will hold this transaction
         """
+        transaction = self.make_transaction(sender, recipient, product_id, product_name, quantity,
+                                            signature=signature, public_key=public_key, **kwargs)
+        if not transaction:
+            return False
+
+        with self.lock:
+            self.current_transactions.append(transaction)
+            return self.last_block['index'] + 1
+
+    @staticmethod
+    def make_transaction(sender, recipient, product_id, product_name, quantity, signature=None, public_key=None, **kwargs):
+        """
+        Builds a transaction and verifies its signature, without queueing it
+        :return: <dict> The transaction, or False if it is not validly signed
+        """
         transaction = {
             'sender': sender,
             'recipient': recipient,
@@ -93,13 +382,204 @@ class Blockchain:
                 return False
         
         transaction['signature'] = signature
-        self.current_transactions.append(transaction)
-        return self.last_block['index'] + 1
+        return transaction
+
+    def rebuild_product_index(self):
+        self.product_latest = {}
+        self.product_counts = {}
+        self.transaction_count = 0
+        self.telemetry_anchors = AnchorIndex()
+        for block in self.chain:
+            self._index_block(block)
+
+    def _index_block(self, block):
+        for tx in block['transactions']:
+            product_id = tx.get('product_id')
+            self.product_latest[product_id] = tx
+            self.product_counts[product_id] = self.product_counts.get(product_id, 0) + 1
+            if is_anchor(tx):
+                self.telemetry_anchors.add(dict(tx, block_index=block['index']))
+        self.transaction_count += len(block['transactions'])
+
+    def world_state(self):
+        """
+        State derived from replaying the chain: each product's latest transaction (and so
+        its current owner) and number of transactions, the total, and the telemetry anchors.
+        Where the transactions are is left out, as it grows with the chain; it is kept
+        in self.postings instead.
+        :return: <dict> A copy, safe to serialize while new blocks are indexed
+        """
+        return {
+            'latest': dict(self.product_latest),
+            'counts': dict(self.product_counts),
+            'transactions': self.transaction_count,
+            'anchors': self.telemetry_anchors.state(),
+        }
+
+    def restore_world_state(self):
+        """
+        Loads the newest snapshot still on the chain and replays the blocks after it,
+        or replays the whole chain if there is none
+        :return: <int> Number of blocks replayed
+        """
+        height, state = load_snapshot(self.data_dir, len(self.chain), self.block_hash)
+        if state is None or 'anchors' not in state:
+            # No snapshot, or one from before anchors were kept in it
+            self.rebuild_product_index()
+            self.snapshot_height = 0
+            return len(self.chain)
+        self.product_counts = dict(state['counts'])
+        self.telemetry_anchors = AnchorIndex(state['anchors'])
+        self.product_latest = {product_id: compact_transaction(tx) for product_id, tx in state['latest'].items()}
+        self.transaction_count = state['transactions']
+        self.snapshot_height = height
+        for position in range(height, len(self.chain)):
+            self._index_block(self.chain[position])
+        return len(self.chain) - height
+
+    def maybe_snapshot(self):
+        """
+        Snapshots the world state once snapshot_interval blocks were added since the last one.
+        The state is copied here and written to disk by a background thread, so mining does not wait for it.
+        """
+        height = len(self.chain)
+        if not self.writer or not self.snapshot_interval or height - self.snapshot_height < self.snapshot_interval:
+            return
+        if self._snapshot_writer is not None and self._snapshot_writer.is_alive():
+            # Still writing the previous one; try again after the next block
+            return
+        block_hash = self.block_hash(height)
+        self._snapshot_writer = threading.Thread(target=self._write_snapshot, args=(height, block_hash, self.world_state()),
+                                                 name='snapshot-writer', daemon=True)
+        self.snapshot_height = height
+        self._snapshot_writer.start()
+
+    def _write_snapshot(self, height, block_hash, state):
+        try:
+            save_snapshot(self.data_dir, height, block_hash, state)
+            # Every block up to here was mined here or validated on arrival, so the next
+            # start does not need to check them again either
+            save_checkpoint(self.data_dir, height, block_hash)
+        except OSError as e:
+            print(f"Could not write the snapshot of block {height}: {e}")
+
+    def wait_for_snapshot(self):
+        """
+        Waits until the snapshot being written in the background, if any, is on disk
+        """
+        if self._snapshot_writer is not None:
+            self._snapshot_writer.join()
+
+    def product_positions(self, product_id):
+        """
+        Where a product's transactions are on the chain
+        :param product_id: <str> ID of the product
+        :return: <list> of (block index, position in block), oldest first
+        """
+        return self.postings.positions(product_id, len(self.chain))
+
+    def product_transactions(self, product_id):
+        """
+        Returns every transaction for a product, oldest first
+        :param product_id: <str> ID of the product
+        :return: <list>
+        """
+        return [
+            self.chain[block_index - 1]['transactions'][position]
+            for block_index, position in self.product_positions(product_id)
+        ]
+
+    def latest_transaction(self, product_id):
+        """
+        :param product_id: <str> ID of the product
+        :return: <dict> The most recent transaction for the product, or None
+        """
+        return self.product_latest.get(product_id)
+
+    def current_owner(self, product_id):
+        """
+        :param product_id: <str> ID of the product
+        :return: <str> Recipient of the most recent transaction, or None
+        """
+        latest = self.product_latest.get(product_id)
+        return latest['recipient'] if latest else None
+
+    def find_transactions(self, equals=None, ranges=None, cursor=0, limit=QUERY_PAGE_SIZE):
+        """
+        Looks up transactions through the secondary indexes
+        :param equals: <dict> Field -> value, for sender, recipient, location and product_id
+        :param ranges: <dict> Field -> (low, high), inclusive, for timestamp, storage_temperature,
+                       humidity and quantity; timestamps in seconds since the epoch
+        :param cursor: <int> next_cursor of a previous page
+        :param limit: <int> Maximum number of transactions
+        :return: <tuple> (<list> entries with the transaction, block_index and position, <int> next_cursor or None)
+        """
+        with self.lock:
+            self.transaction_index.sync(self.chain)
+            rows, next_cursor = self.transaction_index.query(equals, ranges, cursor, limit)
+            located = [self.transaction_index.locate(row) for row in rows]
+        entries = [
+            {
+                'transaction': self.chain[block_index - 1]['transactions'][position],
+                'block_index': block_index,
+                'position': position,
+            }
+            for block_index, position in located
+        ]
+        return entries, next_cursor
+
+    def product_proofs(self, product_id):
+        """
+        Returns a product's transactions with Merkle inclusion proofs and the headers of their blocks
+        :param product_id: <str> ID of the product
+        :return: <list> One entry per transaction, oldest first; version 1 blocks have no
+                 Merkle root, so their entries carry the whole block instead of a proof
+        """
+        entries = []
+        for block_index, position in self.product_positions(product_id):
+            block = self.chain[block_index - 1]
+            transaction = block['transactions'][position]
+            entry = {
+                'transaction': transaction,
+                'block_index': block_index,
+                'position': position,
+                'block_hash': self.block_hash(block_index),
+            }
+            if block.get('version', 1) >= 2:
+                leaves = [transaction_hash(tx) for tx in block['transactions']]
+                entry['proof'] = merkle_proof(leaves, position)
+                entry['header'] = block_header(block)
+            else:
+                entry['block'] = block
+            entries.append(entry)
+        return entries
+
+    def header_view(self, block):
+        """
+        A block without its transactions, for headers-only sync and listings
+        :param block: <dict> Block on this chain
+        :return: <dict>
+        """
+        header = {k: v for k, v in block.items() if k != 'transactions'}
+        header['transaction_count'] = len(block['transactions'])
+        header['hash'] = self.block_hash(block['index'])
+        return header
 
     @property
     def last_block(self):
         return self.chain[-1]
 
+    def block_hash(self, index):
+        """
+        Memoized hash of a Block on this chain
+        :param index: <int> Index of the Block
+        :return: <str>
+        """
+        block_hash = self._block_hashes.get(index)
+        if block_hash is None:
+            block_hash = self._block_hashes[index] = self.hash(self.chain[index - 1])
+        return block_hash
+
     @staticmethod
     def hash(block):
         """
@@ -107,31 +587,47 @@ class Blockchain:
         :param block: <dict> Block
         :return: <str>
         """
-        # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-        block_string = json.dumps(block, sort_keys=True).encode()
+        if block.get('version', 1) >= 2:
+            # Only the header is hashed; it commits to the transactions via the Merkle root
+            return header_hash(block_header(block))
+        # Version 1 blocks hash everything. We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
+        block_string = json.dumps(block, sort_keys=True, default=to_json).encode()
         return hashlib.sha256(block_string).hexdigest()
 
-    def proof_of_work(self, last_proof):
+    def proof_of_work(self, last_proof, difficulty=DEFAULT_DIFFICULTY):
         """
         Simple Proof of Work Algorithm:
-         - Find a number 'p' such that hash(pp') contains leading 4 zeroes, where p is the previous p'
+         - Find a number 'p' such that hash(pp') contains `difficulty` leading zeroes, where p is the previous p'
          - p is the previous proof, and p' is the new proof
+         The search is spread over the miner's worker processes; the attempts,
+         duration and hashrate of the last search are kept in self.miner.last_result.
          :param last_proof: <int>
+         :param difficulty: <int> Number of leading zero hex digits required
          :return: <int>
         """
-        proof = 0
-        while self.valid_proof(last_proof, proof) is False:
-            proof += 1
-        return proof
+        return self.miner.mine(last_proof, difficulty).proof
 
     @staticmethod
-    def valid_proof(last_proof, proof):
+    def valid_proof(last_proof, proof, difficulty=DEFAULT_DIFFICULTY):
         """
-        Validates the proof: Does hash(last_proof, proof) contain 4 leading zeroes?
+        Validates the proof: Does hash(last_proof, proof) contain `difficulty` leading zeroes?
         :param last_proof: <int> Previous Proof
         :param proof: <int> Current Proof
+        :param difficulty: <int> Number of leading zero hex digits required
         :return: <bool> True if correct, False if not.
         """
-        guess = f'{last_proof}{proof}'.encode()
-        guess_hash = hashlib.sha256(guess).hexdigest()
-        return guess_hash[:4] == "0000"
+        return valid_proof(last_proof, proof, difficulty)
+
+
+def verify_inclusion(transaction, proof, header, block_hash=None):
+    """
+    Checks that a transaction is in a block using only its Merkle proof and the block header
+    :param transaction: <dict> The transaction, including its signature
+    :param proof: <list> Merkle proof, as returned by Blockchain.product_proofs
+    :param header: <dict> Header of the block holding the transaction
+    :param block_hash: (Optional) <str> Trusted hash of that block, e.g. from a headers-only sync
+    :return: <bool> True if the transaction is included, False if not
+    """
+    if block_hash is not None and header_hash(header) != block_hash:
+        return False
+    return verify_merkle_proof(transaction_hash(transaction), proof, header['merkle_root'])
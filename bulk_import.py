@@ -0,0 +1,207 @@
+import argparse
+import csv
+import io
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from encoding import TRANSACTION_VERSION
+from telemetry import ANCHOR_PRODUCT_ID
+
+BULK_BLOCK_TRANSACTIONS = 1000  # transactions packed into each block
+SIGN_CHUNK_ROWS = 200           # rows signed per worker task
+
+REQUIRED_COLUMNS = ('product_batch_id', 'product_name', 'quantity', 'product_owner')
+OPTIONAL_COLUMNS = ('timestamp', 'storage_temperature', 'humidity', 'location')
+
+
+def parse_manifest(text, fmt):
+    """
+    Parses a warehouse manifest
+    :param text: <str> CSV with a header row, or one JSON object per line
+    :param fmt: <str> 'csv' or 'jsonl'
+    :return: <list> of (<int> row number, <dict> row or None, <str> parse error or None)
+    """
+    rows = []
+    if fmt == 'csv':
+        for number, row in enumerate(csv.DictReader(io.StringIO(text)), start=1):
+            rows.append((number, row, None))
+        return rows
+    for number, line in enumerate(text.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            rows.append((number, None, 'Invalid JSON'))
+            continue
+        if not isinstance(row, dict):
+            rows.append((number, None, 'Expected a JSON object'))
+            continue
+        rows.append((number, row, None))
+    return rows
+
+
+def sign_rows(private_key, sender, rows):
+    """
+    Builds and signs product registration transactions; runs in a worker process
+    :param private_key: <str> PEM private key of the registering user
+    :param sender: <str> PEM public key of the registering user
+    :param rows: <list> Validated manifest rows
+    :return: <list> Signed transactions, in the same order
+    """
+    from wallet import load_wallet
+    wallet = load_wallet(private_key)
+    transactions = []
+    for row in rows:
+        transaction = {
+            'sender': sender,
+            'recipient': row['product_owner'],
+            'product_id': row['product_batch_id'],
+            'product_name': row['product_name'],
+            'quantity': row['quantity'],
+        }
+        transaction.update({column: row.get(column, '') for column in OPTIONAL_COLUMNS})
+        transaction['version'] = TRANSACTION_VERSION
+        transaction['signature'] = wallet.sign_transaction(transaction).hex()
+        transactions.append(transaction)
+    return transactions
+
+
+class BulkImporter:
+    """
+    Registers many product batches at once: rows are validated, signed on a
+    pool of worker processes and packed into as few blocks as possible.
+    """
+
+    def __init__(self, blockchain, mempool=None, workers=None, block_transactions=BULK_BLOCK_TRANSACTIONS):
+        self.blockchain = blockchain
+        self.mempool = mempool
+        self.workers = workers or os.cpu_count() or 1
+        self.block_transactions = block_transactions
+
+    def validate(self, rows):
+        """
+        :return: <tuple> (<list> accepted (number, row), <list> per-row results for rejected rows)
+        """
+        accepted = []
+        rejected = []
+        seen = set()
+        rows = [
+            (number, {k.strip(): '' if v is None else str(v).strip() for k, v in row.items() if k}, None)
+            if error is None else (number, row, error)
+            for number, row, error in rows
+        ]
+        pending = self.mempool.pending_product_ids() if self.mempool else set()
+        if self.mempool is not None and self.mempool.inbox is not None:
+            # Queued by other workers and not yet taken by the writer
+            pending |= self.mempool.inbox.pending_products(
+                row.get('product_batch_id') for _, row, error in rows if error is None)
+        for number, row, error in rows:
+            if error is None:
+                missing = [column for column in REQUIRED_COLUMNS if not row.get(column)]
+                product_id = row.get('product_batch_id')
+                if missing:
+                    error = f"Missing {', '.join(missing)}"
+                elif product_id == ANCHOR_PRODUCT_ID:
+                    error = 'product_batch_id is reserved for telemetry anchors'
+                elif product_id in seen:
+                    error = 'Duplicate product_batch_id in this manifest'
+                elif product_id in self.blockchain.product_latest or product_id in pending:
+                    error = 'Product is already registered'
+            if error:
+                rejected.append({'row': number, 'product_id': row.get('product_batch_id') if row else None,
+                                 'status': 'error', 'error': error})
+                continue
+            seen.add(product_id)
+            accepted.append((number, row))
+        return accepted, rejected
+
+    def sign(self, user, rows):
+        chunks = [rows[i:i + SIGN_CHUNK_ROWS] for i in range(0, len(rows), SIGN_CHUNK_ROWS)]
+        if self.workers <= 1 or len(chunks) <= 1:
+            signed = [sign_rows(user['private_key'], user['public_key'], chunk) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                signed = pool.map(sign_rows, [user['private_key']] * len(chunks),
+                                  [user['public_key']] * len(chunks), chunks)
+        return [transaction for chunk in signed for transaction in chunk]
+
+    def run(self, user, rows):
+        """
+        :param user: <dict> The registering user, with public_key and private_key
+        :param rows: <list> Output of parse_manifest()
+        :return: <dict> Per-row results, the blocks forged and timings
+        """
+        # Blocks are forged here, so fail before signing anything
+        self.blockchain.require_sealer()
+        started = perf_counter()
+        accepted, results = self.validate(rows)
+        transactions = self.sign(user, [row for _, row in accepted])
+        signed = perf_counter()
+
+        blocks = []
+        for first in range(0, len(transactions), self.block_transactions):
+            batch = transactions[first:first + self.block_transactions]
+            with self.blockchain.lock:
+                self.blockchain.current_transactions.extend(batch)
+                block = self.blockchain.mine_pending()
+            blocks.append(block['index'])
+            for offset, transaction in enumerate(batch):
+                number, _ = accepted[first + offset]
+                results.append({'row': number, 'product_id': transaction['product_id'],
+                                'status': 'ok', 'block': block['index']})
+
+        results.sort(key=lambda result: result['row'])
+        finished = perf_counter()
+        return {
+            'accepted': len(transactions),
+            'rejected': len(results) - len(transactions),
+            'blocks': blocks,
+            'results': results,
+            'sign_seconds': round(signed - started, 3),
+            'total_seconds': round(finished - started, 3),
+        }
+
+
+def detect_format(filename, content_type=None):
+    """
+    :return: <str> 'csv' or 'jsonl', from the file extension or content type
+    """
+    name = (filename or '').lower()
+    if name.endswith(('.jsonl', '.ndjson', '.json')) or (content_type or '').endswith(('json', 'ndjson', 'jsonl')):
+        return 'jsonl'
+    return 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Register product batches from a CSV or JSON lines manifest.')
+    parser.add_argument('manifest', help='CSV file with a header row, or a .jsonl file')
+    parser.add_argument('--email', required=True, help='registered user who signs the transactions')
+    parser.add_argument('--format', choices=('csv', 'jsonl'), help='manifest format (default: from the file extension)')
+    parser.add_argument('--workers', type=int, default=None, help='signing processes (default: all cores)')
+    parser.add_argument('--data-dir', default=os.environ.get('CHAIN_DATA_DIR', 'chain_data'))
+    parser.add_argument('--users-db', default=os.environ.get('USERS_DB', 'users.db'))
+    args = parser.parse_args()
+
+    from blockchain import Blockchain
+    from consensus import from_env as consensus_from_env
+    from userstore import UserStore
+
+    user = UserStore(args.users_db).get(args.email)
+    if not user:
+        raise SystemExit(f"No registered user {args.email}")
+    with open(args.manifest, 'r', newline='') as f:
+        rows = parse_manifest(f.read(), args.format or detect_format(args.manifest))
+
+    report = BulkImporter(Blockchain(data_dir=args.data_dir, consensus=consensus_from_env()), workers=args.workers).run(user, rows)
+    for result in report['results']:
+        if result['status'] != 'ok':
+            print(f"row {result['row']}: {result['error']}")
+    print(f"Registered {report['accepted']} batches in {len(report['blocks'])} blocks, "
+          f"rejected {report['rejected']} ({report['total_seconds']}s, signing {report['sign_seconds']}s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,364 @@
+import argparse
+import os
+import threading
+from array import array
+
+import numpy as np
+import pandas as pd
+
+from analytics import parse_timestamp
+from telemetry import is_anchor
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:  # optional, only needed for Parquet and Arrow export
+    pyarrow = None
+
+# Cold chain limits; readings outside them are excursions
+TEMPERATURE_RANGE = (2.0, 8.0)  # degrees Celsius
+HUMIDITY_RANGE = (30.0, 70.0)   # percent relative humidity
+
+MAX_REPORT_ROWS = 20  # batches, locations and owners listed in a report
+
+MISSING = -1  # code of a missing categorical value
+
+CATEGORICAL_COLUMNS = ('product_id', 'product_name', 'location', 'sender', 'recipient')
+
+
+def _number(value):
+    """
+    :return: <float> The reading as a number, or NaN if it is missing or not numeric
+    """
+    if value is None or value == '':
+        return float('nan')
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class Dictionary:
+    """
+    Maps the distinct values of a categorical column to small integer codes
+    """
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def code(self, value):
+        if value is None or value == '':
+            return MISSING
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class TransactionColumns:
+    """
+    Every transaction on the chain, stored column by column.
+
+    Numeric fields are packed into typed arrays and text fields are
+    dictionary-encoded as int32 codes, so a column can be handed to NumPy
+    or pandas as one contiguous array. Like the chart aggregates, the
+    columns are only extended by the blocks added since the last sync.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.height = 0
+        self.dictionaries = {name: Dictionary() for name in CATEGORICAL_COLUMNS}
+        self._arrays = {
+            'block': array('i'),
+            'position': array('i'),
+            'recorded_at': array('d'),   # timestamp of the block, seconds since the epoch
+            'timestamp': array('d'),     # timestamp entered with the transaction, NaN if missing
+            'quantity': array('d'),
+            'storage_temperature': array('f'),
+            'humidity': array('f'),
+        }
+        self._arrays.update({name: array('i') for name in CATEGORICAL_COLUMNS})
+        self._numpy = None
+
+    def __len__(self):
+        return len(self._arrays['block'])
+
+    def sync(self, chain):
+        """
+        Appends the transactions of the blocks added since the last call
+        :param chain: <list> The full chain
+        :return: <bool> True if anything changed
+        """
+        if len(chain) < self.height:
+            self.reset()
+        if len(chain) == self.height:
+            return False
+        for position in range(self.height, len(chain)):
+            self.add_block(chain[position])
+        self._numpy = None
+        return True
+
+    def add_block(self, block):
+        arrays = self._arrays
+        dictionaries = self.dictionaries
+        for position, tx in enumerate(block['transactions']):
+            if is_anchor(tx):
+                # Telemetry bookkeeping, not a product or a transfer
+                continue
+            arrays['block'].append(block['index'])
+            arrays['position'].append(position)
+            arrays['recorded_at'].append(float(block['timestamp']))
+            parsed = parse_timestamp(tx.get('timestamp'))
+            arrays['timestamp'].append(parsed.timestamp() if parsed is not None else float('nan'))
+            arrays['quantity'].append(_number(tx.get('quantity')))
+            arrays['storage_temperature'].append(_number(tx.get('storage_temperature')))
+            arrays['humidity'].append(_number(tx.get('humidity')))
+            for name in CATEGORICAL_COLUMNS:
+                arrays[name].append(dictionaries[name].code(tx.get(name)))
+        self.height += 1
+
+    def columns(self):
+        """
+        :return: <dict> Column name -> NumPy array, copied once per sync
+        """
+        if self._numpy is None:
+            self._numpy = {
+                name: np.frombuffer(values, dtype=values.typecode).copy() for name, values in self._arrays.items()
+            }
+        return self._numpy
+
+    def to_frame(self):
+        """
+        :return: <pd.DataFrame> One row per transaction, text columns as pandas Categoricals
+        """
+        columns = self.columns()
+        data = {name: values for name, values in columns.items() if name not in CATEGORICAL_COLUMNS}
+        for name in CATEGORICAL_COLUMNS:
+            data[name] = pd.Categorical.from_codes(columns[name], categories=self.dictionaries[name].values)
+        frame = pd.DataFrame(data)
+        frame['recorded_at'] = pd.to_datetime(frame['recorded_at'], unit='s')
+        frame['timestamp'] = pd.to_datetime(frame['timestamp'], unit='s')
+        return frame
+
+    def to_arrow(self):
+        """
+        :return: <pyarrow.Table> Text columns dictionary-encoded
+        """
+        if pyarrow is None:
+            raise RuntimeError('Arrow export needs pyarrow: pip install pyarrow')
+        return pyarrow.Table.from_pandas(self.to_frame(), preserve_index=False)
+
+    def export(self, path):
+        """
+        Writes the columns to a file, in a format chosen by its extension:
+        .parquet, .arrow/.feather (both need pyarrow) or .npz (NumPy only)
+        :param path: <str> Output file
+        """
+        extension = os.path.splitext(path)[1].lower()
+        if extension == '.parquet':
+            table = self.to_arrow()
+            pyarrow.parquet.write_table(table, path)
+        elif extension in ('.arrow', '.feather'):
+            table = self.to_arrow()
+            pyarrow.feather.write_feather(table, path)
+        elif extension == '.npz':
+            dictionaries = {f'{name}_values': np.array(self.dictionaries[name].values, dtype=object)
+                            for name in CATEGORICAL_COLUMNS}
+            np.savez_compressed(path, **self.columns(), **dictionaries)
+        else:
+            raise ValueError(f"Unsupported export format {extension or path}; use .parquet, .arrow, .feather or .npz")
+
+
+def _decode(dictionary, code):
+    return dictionary.values[code] if code != MISSING else None
+
+
+def excursions(store, temperature_range=TEMPERATURE_RANGE, humidity_range=HUMIDITY_RANGE, limit=MAX_REPORT_ROWS):
+    """
+    Finds the batches with temperature or humidity readings outside the cold chain limits
+    :return: <dict> Totals and the batches with the most excursions
+    """
+    columns = store.columns()
+    temperature = columns['storage_temperature']
+    humidity = columns['humidity']
+    products = columns['product_id']
+    # NaN compares false, so missing readings never count as excursions
+    hot_or_cold = (temperature < temperature_range[0]) | (temperature > temperature_range[1])
+    too_dry_or_damp = (humidity < humidity_range[0]) | (humidity > humidity_range[1])
+    flagged = (hot_or_cold | too_dry_or_damp) & (products != MISSING)
+
+    count = len(store.dictionaries['product_id'])
+    per_product = np.bincount(products[flagged], minlength=count)
+    readings = np.bincount(products[products != MISSING], minlength=count)
+    worst = np.argsort(-per_product, kind='stable')[:limit]
+    worst = worst[per_product[worst] > 0]
+
+    min_temperature = np.full(count, np.inf, dtype='f')
+    max_temperature = np.full(count, -np.inf, dtype='f')
+    has_product = products != MISSING
+    np.fmin.at(min_temperature, products[has_product], temperature[has_product])
+    np.fmax.at(max_temperature, products[has_product], temperature[has_product])
+
+    batches = []
+    for code in worst:
+        low, high = float(min_temperature[code]), float(max_temperature[code])
+        batches.append({
+            'product_id': store.dictionaries['product_id'].values[code],
+            'readings': int(readings[code]),
+            'excursions': int(per_product[code]),
+            'min_temperature': low if np.isfinite(low) else None,
+            'max_temperature': high if np.isfinite(high) else None,
+        })
+    return {
+        'temperature_range': list(temperature_range),
+        'humidity_range': list(humidity_range),
+        'temperature_excursions': int(np.count_nonzero(hot_or_cold)),
+        'humidity_excursions': int(np.count_nonzero(too_dry_or_damp)),
+        'batches_affected': int(np.count_nonzero(per_product)),
+        'batches': batches,
+    }
+
+
+def _holding_periods(columns):
+    """
+    Pairs every transaction with the next one for the same batch
+    :return: <tuple> (<np.ndarray> row of each holding transaction, <np.ndarray> seconds until the next transfer)
+    """
+    products = columns['product_id']
+    order = np.lexsort((columns['position'], columns['block'], products))
+    ordered = products[order]
+    follows = (ordered[1:] == ordered[:-1]) & (ordered[1:] != MISSING)
+    held = order[:-1][follows]
+    recorded_at = columns['recorded_at']
+    # Transfers copy the event timestamp of the previous transaction, so
+    # holding time is measured by when each transfer was recorded on the chain
+    seconds = recorded_at[order[1:][follows]] - recorded_at[held]
+    return held, seconds
+
+
+def dwell_times(store, limit=MAX_REPORT_ROWS):
+    """
+    Time batches spend at each location before their next ownership transfer
+    :return: <list> One entry per location, longest average dwell first
+    """
+    columns = store.columns()
+    held, seconds = _holding_periods(columns)
+    locations = columns['location'][held]
+    known = locations != MISSING
+    count = len(store.dictionaries['location'])
+    transfers = np.bincount(locations[known], minlength=count)
+    total = np.bincount(locations[known], weights=seconds[known], minlength=count)
+    longest = np.zeros(count)
+    np.maximum.at(longest, locations[known], seconds[known])
+    average = np.divide(total, transfers, out=np.zeros(count), where=transfers > 0)
+
+    rows = []
+    for code in np.argsort(-average, kind='stable')[:limit]:
+        if not transfers[code]:
+            continue
+        rows.append({
+            'location': store.dictionaries['location'].values[code],
+            'transfers': int(transfers[code]),
+            'average_hours': round(float(average[code]) / 3600, 2),
+            'longest_hours': round(float(longest[code]) / 3600, 2),
+        })
+    return rows
+
+
+def owner_throughput(store, limit=MAX_REPORT_ROWS):
+    """
+    How many batches and how much quantity passed through each owner, and how long they held them
+    :return: <list> One entry per owner, most batches received first
+    """
+    columns = store.columns()
+    recipients = columns['recipient']
+    known = recipients != MISSING
+    count = len(store.dictionaries['recipient'])
+    received = np.bincount(recipients[known], minlength=count)
+    quantity = np.bincount(recipients[known], weights=np.nan_to_num(columns['quantity'][known]), minlength=count)
+
+    held, seconds = _holding_periods(columns)
+    holders = recipients[held]
+    forwarded = np.bincount(holders[holders != MISSING], minlength=count)
+    holding = np.bincount(holders[holders != MISSING], weights=seconds[holders != MISSING], minlength=count)
+    average = np.divide(holding, forwarded, out=np.zeros(count), where=forwarded > 0)
+
+    rows = []
+    for code in np.argsort(-received, kind='stable')[:limit]:
+        if not received[code]:
+            continue
+        rows.append({
+            'owner': store.dictionaries['recipient'].values[code],
+            'received': int(received[code]),
+            'forwarded': int(forwarded[code]),
+            'quantity': float(quantity[code]),
+            'average_holding_hours': round(float(average[code]) / 3600, 2) if forwarded[code] else None,
+        })
+    return rows
+
+
+def cold_chain_report(store):
+    return {
+        'transactions': len(store),
+        'height': store.height,
+        'excursions': excursions(store),
+        'dwell_times': dwell_times(store),
+        'owner_throughput': owner_throughput(store),
+    }
+
+
+store = TransactionColumns()
+_reports = {}
+_lock = threading.Lock()
+
+
+def reset():
+    """
+    Drops the columns, e.g. after the chain was replaced
+    """
+    with _lock:
+        store.reset()
+        _reports.clear()
+
+
+def report(chain):
+    """
+    Cold chain analyses for the chain, recomputed only when it has grown
+    :param chain: <list> The full chain
+    :return: <dict>
+    """
+    with _lock:
+        if len(chain) < store.height:
+            _reports.clear()
+        store.sync(chain)
+        cached = _reports.get(store.height)
+        if cached is None:
+            _reports.clear()
+            cached = _reports[store.height] = cold_chain_report(store)
+        return cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export the ledger as columns for pandas, Arrow or Parquet tools.')
+    parser.add_argument('output', help='output file: .parquet, .arrow, .feather (need pyarrow) or .npz')
+    parser.add_argument('--data-dir', default=os.environ.get('CHAIN_DATA_DIR', 'chain_data'))
+    args = parser.parse_args()
+
+    from blockchain import Blockchain
+    blockchain = Blockchain(data_dir=args.data_dir, verify_on_load=False)
+    store.sync(blockchain.chain)
+    store.export(args.output)
+    print(f"Exported {len(store)} transactions from {store.height} blocks to {args.output}")
+
+
+if __name__ == '__main__':
+    main()
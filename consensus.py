@@ -0,0 +1,275 @@
+import argparse
+import json
+import os
+
+from encoding import block_header
+from miner import DEFAULT_DIFFICULTY, valid_proof
+
+CONSENSUS_POW = 'pow'
+CONSENSUS_POA = 'poa'
+CONSENSUS_ENGINES = (CONSENSUS_POW, CONSENSUS_POA)
+
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 8
+# Difficulty moves one hex digit, 16 times the work, when a search takes this
+# many times longer or shorter than the target block time
+RETARGET_FACTOR = 4
+
+AUTHORITIES_FILE = 'authorities.json'
+
+
+class ConsensusError(RuntimeError):
+    """
+    Raised when this node cannot seal blocks under the configured engine, e.g. it holds no authority key
+    """
+
+
+class ProofOfWork:
+    """
+    Seals a block by searching for a proof whose hash with the previous proof
+    starts with `difficulty` zero hex digits, and records the difficulty in
+    the block header.
+
+    With a target block time, the difficulty of the next block is raised or
+    lowered by one digit whenever a search is far off the target. Blocks are
+    valid at any difficulty down to min_difficulty, which is the configured
+    difficulty unless set lower, so a peer cannot offer a long chain of cheap
+    blocks; blocks sealed before the difficulty was recorded count as
+    DEFAULT_DIFFICULTY. Raising the minimum on an existing chain needs a
+    min_difficulty_height, so the blocks mined before the change are held to
+    MIN_DIFFICULTY only.
+    """
+    name = CONSENSUS_POW
+
+    def __init__(self, difficulty=DEFAULT_DIFFICULTY, target_seconds=None, min_difficulty=None,
+                 max_difficulty=MAX_DIFFICULTY, min_difficulty_height=0):
+        """
+        :param difficulty: <int> Difficulty of the next block
+        :param target_seconds: <float> Block time to aim for, or None to keep the difficulty fixed
+        :param min_difficulty: <int> Lowest difficulty accepted from the blocks after min_difficulty_height,
+                               by default `difficulty`
+        :param max_difficulty: <int> Highest difficulty the target may raise it to
+        :param min_difficulty_height: <int> Last block mined before min_difficulty applied
+        """
+        self.difficulty = difficulty
+        self.target_seconds = target_seconds or None
+        self.min_difficulty = difficulty if min_difficulty is None else min_difficulty
+        self.min_difficulty_height = min_difficulty_height
+        self.max_difficulty = max(max_difficulty, difficulty)
+        self._next_difficulty = None
+
+    def can_seal(self):
+        return True
+
+    def next_difficulty(self, previous):
+        """
+        :param previous: <dict> The block the next one follows
+        :return: <int> Difficulty to mine the next block at
+        """
+        if not self.target_seconds:
+            return self.difficulty
+        if self._next_difficulty is None:
+            # After a restart, carry on from the last block rather than the configured start
+            self._next_difficulty = self._clamp(previous.get('difficulty', self.difficulty))
+        return self._next_difficulty
+
+    def _clamp(self, difficulty):
+        return min(max(difficulty, self.min_difficulty, MIN_DIFFICULTY), self.max_difficulty)
+
+    def seal(self, blockchain, block):
+        """
+        Mines the proof of a new block, filling in its proof and difficulty
+        :param blockchain: <Blockchain> The chain the block extends; its miner does the search
+        :param block: <dict> The new block, not yet on the chain
+        """
+        previous = blockchain.chain[block['index'] - 2]
+        difficulty = self.next_difficulty(previous)
+        result = blockchain.miner.mine(previous['proof'], difficulty)
+        block['proof'] = result.proof
+        block['difficulty'] = difficulty
+        if self.target_seconds:
+            if result.elapsed < self.target_seconds / RETARGET_FACTOR:
+                difficulty += 1
+            elif result.elapsed > self.target_seconds * RETARGET_FACTOR:
+                difficulty -= 1
+            self._next_difficulty = self._clamp(difficulty)
+
+    def check_seal(self, previous, block):
+        """
+        :param previous: <dict> The block before `block`
+        :param block: <dict> The block to check
+        :return: <str> Why the seal is invalid, or None if it is valid
+        """
+        difficulty = block.get('difficulty', DEFAULT_DIFFICULTY)
+        minimum = self.min_difficulty if block['index'] > self.min_difficulty_height else MIN_DIFFICULTY
+        if type(difficulty) is not int or difficulty < max(minimum, MIN_DIFFICULTY):
+            return 'Proof of work difficulty is below the minimum'
+        if not valid_proof(previous['proof'], block['proof'], difficulty):
+            return 'Invalid proof of work'
+        return None
+
+
+def block_work(block):
+    """
+    Work a block adds to its chain, for choosing between forks: each zero hex digit
+    of difficulty takes 16 times the hashes, and a signed block counts as one
+    :param block: <dict> Block or block header
+    :return: <int>
+    """
+    if 'signer' in block:
+        return 1
+    difficulty = block.get('difficulty', DEFAULT_DIFFICULTY)
+    return 16 ** difficulty if type(difficulty) is int and difficulty > 0 else 0
+
+
+def chain_work(blocks):
+    """
+    :param blocks: <iterable> Consecutive blocks or block headers
+    :return: <int> Total work of the blocks
+    """
+    return sum(block_work(block) for block in blocks)
+
+
+class ProofOfAuthority:
+    """
+    Seals a block by signing its header with the key of an authorized node, for
+    permissioned networks where every block producer is known in advance.
+
+    The signer's public key is part of the header, so the block hash commits
+    to who sealed it, and the signature over the header is stored next to it.
+    A node whose key is not in the authorities list follows and validates the
+    chain but cannot forge blocks. Blocks up to start_height are checked by
+    the legacy engine, so an existing proof of work chain can switch over.
+    """
+    name = CONSENSUS_POA
+
+    def __init__(self, authorities, wallet=None, start_height=0, legacy=None):
+        """
+        :param authorities: <list> Public keys allowed to sign blocks
+        :param wallet: (Optional) <Wallet> This node's authority key
+        :param start_height: <int> Last block sealed before the switch to proof of authority
+        :param legacy: (Optional) Engine for the blocks up to start_height, by default ProofOfWork()
+        """
+        self.authorities = frozenset(authorities)
+        self.wallet = wallet
+        self.start_height = start_height
+        self.legacy = legacy or ProofOfWork()
+
+    def __getstate__(self):
+        # Validator worker processes only check seals, so the private key stays here
+        state = self.__dict__.copy()
+        state['wallet'] = None
+        return state
+
+    def can_seal(self):
+        return self.wallet is not None and self.wallet.public_key in self.authorities
+
+    def seal(self, blockchain, block):
+        """
+        Signs the header of a new block, filling in its proof, signer and signature
+        :param blockchain: <Blockchain> The chain the block extends
+        :param block: <dict> The new block, not yet on the chain
+        """
+        if not self.can_seal():
+            raise ConsensusError('This node holds no authority key, so it cannot seal blocks')
+        block['proof'] = 0
+        block['signer'] = self.wallet.public_key
+        block['signature'] = self.wallet.sign_transaction(block_header(block)).hex()
+
+    def check_seal(self, previous, block):
+        """
+        :param previous: <dict> The block before `block`
+        :param block: <dict> The block to check
+        :return: <str> Why the seal is invalid, or None if it is valid
+        """
+        if block['index'] <= self.start_height:
+            return self.legacy.check_seal(previous, block)
+        from wallet import Wallet
+        signer = block.get('signer')
+        # Only version 2 blocks have a header to sign
+        if signer not in self.authorities or block.get('version', 1) < 2:
+            return 'Block is not signed by an authority'
+        try:
+            signature = bytes.fromhex(block.get('signature') or '')
+        except (TypeError, ValueError):
+            return 'Invalid authority signature'
+        if not Wallet.verify_signature(block_header(block), signature, signer):
+            return 'Invalid authority signature'
+        return None
+
+
+def load_authorities(path):
+    """
+    :param path: <str> JSON file holding a list of public keys
+    :return: <list> The public keys, or an empty list if the file does not exist
+    """
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def from_env(environ=None):
+    """
+    Builds the consensus engine configured by environment variables:
+    CONSENSUS ('pow' or 'poa'), POW_DIFFICULTY, POW_TARGET_SECONDS, POW_MIN_DIFFICULTY,
+    POW_MIN_DIFFICULTY_HEIGHT, POW_MAX_DIFFICULTY, POA_AUTHORITIES, POA_KEY_FILE and POA_START_HEIGHT
+    :param environ: (Optional) <dict> Variables to read instead of os.environ
+    :return: <ProofOfWork> or <ProofOfAuthority>
+    """
+    environ = os.environ if environ is None else environ
+    name = environ.get('CONSENSUS', CONSENSUS_POW).lower()
+    if name not in CONSENSUS_ENGINES:
+        raise ValueError(f"Unknown consensus engine {name}; use one of {', '.join(CONSENSUS_ENGINES)}")
+    min_difficulty = environ.get('POW_MIN_DIFFICULTY')
+    proof_of_work = ProofOfWork(
+        difficulty=int(environ.get('POW_DIFFICULTY', DEFAULT_DIFFICULTY)),
+        target_seconds=float(environ.get('POW_TARGET_SECONDS', 0)),
+        min_difficulty=int(min_difficulty) if min_difficulty else None,
+        max_difficulty=int(environ.get('POW_MAX_DIFFICULTY', MAX_DIFFICULTY)),
+        min_difficulty_height=int(environ.get('POW_MIN_DIFFICULTY_HEIGHT', 0)),
+    )
+    if name == CONSENSUS_POW:
+        return proof_of_work
+
+    authorities = load_authorities(environ.get('POA_AUTHORITIES', AUTHORITIES_FILE))
+    if not authorities:
+        raise ValueError('Proof of authority needs a list of authority public keys in POA_AUTHORITIES')
+    wallet = None
+    key_file = environ.get('POA_KEY_FILE')
+    if key_file:
+        from wallet import Wallet
+        with open(key_file, 'r') as f:
+            wallet = Wallet(f.read())
+    engine = ProofOfAuthority(authorities, wallet=wallet, start_height=int(environ.get('POA_START_HEIGHT', 0)),
+                              legacy=proof_of_work)
+    if not engine.can_seal():
+        print("This node holds no authority key; it will validate blocks but not forge them")
+    return engine
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Create an authority key for proof of authority consensus.')
+    parser.add_argument('key_file', help='where to write the new private key (PEM)')
+    parser.add_argument('--authorities', default=AUTHORITIES_FILE,
+                        help='authorities list to add the public key to, shared by every node')
+    args = parser.parse_args()
+
+    if os.path.exists(args.key_file):
+        parser.error(f'{args.key_file} already exists')
+    from wallet import Wallet
+    wallet = Wallet()
+    with open(args.key_file, 'w') as f:
+        f.write(wallet.private_key)
+    os.chmod(args.key_file, 0o600)
+
+    authorities = load_authorities(args.authorities)
+    authorities.append(wallet.public_key)
+    with open(args.authorities, 'w') as f:
+        json.dump(authorities, f, indent=2)
+    print(f"Wrote {args.key_file}; {args.authorities} now lists {len(authorities)} authorities")
+    print(wallet.public_key)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+import hashlib
+import json
+
+from ledger import to_json
+from merkle import merkle_root
+
+# Transactions and blocks without a 'version' field are version 1: transactions
+# are signed over str(transaction) and blocks are hashed as a whole. Version 2
+# signs a canonical encoding and hashes only the block header, which commits to
+# the transactions through a Merkle root.
+TRANSACTION_VERSION = 2
+BLOCK_VERSION = 2
+HEADER_FIELDS = ('index', 'timestamp', 'proof', 'previous_hash', 'merkle_root', 'version')
+# Written by the consensus engine that sealed the block, and hashed with the
+# header when present: the proof of work difficulty, or the authority that
+# signed the block. Blocks sealed before these existed hash as they always did.
+SEAL_FIELDS = ('difficulty', 'signer')
+
+
+def canonical_bytes(data):
+    """
+    Deterministic encoding: sorted keys, no whitespace, UTF-8
+    :param data: <dict>
+    :return: <bytes>
+    """
+    return json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=to_json).encode('utf-8')
+
+
+def signing_bytes(transaction):
+    """
+    The bytes a transaction's signature covers, according to its version
+    :param transaction: <dict> Transaction, with or without its signature
+    :return: <bytes>
+    """
+    unsigned = {k: v for k, v in transaction.items() if k != 'signature'}
+    if transaction.get('version', 1) >= 2:
+        return canonical_bytes(unsigned)
+    # Version 1 signed the repr of the dict, so key order matters
+    return str(unsigned).encode('utf-8')
+
+
+def transaction_hash(transaction):
+    """
+    Merkle leaf for a transaction, covering its signature as well
+    :param transaction: <dict> Transaction
+    :return: <str> Hex SHA-256
+    """
+    return hashlib.sha256(canonical_bytes(transaction)).hexdigest()
+
+
+def transactions_root(transactions):
+    """
+    :param transactions: <list> Transactions in block order
+    :return: <str> Hex Merkle root
+    """
+    return merkle_root([transaction_hash(tx) for tx in transactions])
+
+
+def unique_transactions(transactions):
+    """
+    Drops repeated transactions, which validators reject in version 2 blocks
+    :param transactions: <list> Transactions in block order
+    :return: <list> The transactions with later copies of a repeated one removed
+    """
+    seen = set()
+    unique = []
+    for tx in transactions:
+        digest = transaction_hash(tx)
+        if digest not in seen:
+            seen.add(digest)
+            unique.append(tx)
+    return unique
+
+
+def block_header(block):
+    """
+    :param block: <dict> Version 2 block
+    :return: <dict> The fields the block hash covers
+    """
+    header = {field: block[field] for field in HEADER_FIELDS}
+    for field in SEAL_FIELDS:
+        if field in block:
+            header[field] = block[field]
+    return header
+
+
+def header_hash(header):
+    """
+    :param header: <dict> Block header
+    :return: <str> Hex SHA-256 of the canonical header encoding
+    """
+    return hashlib.sha256(canonical_bytes(header)).hexdigest()
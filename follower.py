@@ -0,0 +1,46 @@
+import threading
+
+FOLLOW_INTERVAL = 0.5  # seconds between checks of the block log
+
+
+class LogFollower(threading.Thread):
+    """
+    Daemon thread that keeps a reader process's chain and indexes current by
+    tailing the block log the writer appends to, and lets the process take
+    over as the writer when the previous one exits
+    """
+
+    def __init__(self, blockchain, on_reload=None, interval=FOLLOW_INTERVAL):
+        """
+        :param blockchain: <Blockchain>
+        :param on_reload: (Optional) <function> Called when the chain was reloaded from scratch,
+                          so that caches derived from it can be dropped
+        :param interval: <float> Seconds between checks
+        """
+        super().__init__(name='log-follower', daemon=True)
+        self.blockchain = blockchain
+        self.on_reload = on_reload
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def ensure_started(self):
+        if not self.is_alive() and not self._stop_event.is_set():
+            try:
+                self.start()
+            except RuntimeError:
+                # Another request started it first
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self.blockchain.writer and not self._stop_event.wait(self.interval):
+            try:
+                _, reloaded = self.blockchain.follow_log()
+            except (OSError, ValueError) as e:
+                # E.g. a segment removed by a reorg between two reads; the next check starts over
+                print(f"Could not follow the block log: {e}")
+                continue
+            if reloaded and self.on_reload:
+                self.on_reload()
@@ -0,0 +1,152 @@
+from collections.abc import Mapping
+from sys import intern
+
+# Transaction fields whose values repeat across the ledger: public keys of
+# senders and owners, product names, locations and small readings. Each
+# distinct value is kept once and shared by every transaction holding it.
+# Timestamps and signatures are practically unique, so they are left alone.
+SHARED_FIELDS = frozenset((
+    'sender', 'recipient', 'product_id', 'product_name', 'quantity',
+    'storage_temperature', 'humidity', 'location', 'public_key',
+))
+
+
+class Layout:
+    """
+    The field names of a record, in order, shared by every record with the same fields
+    """
+    __slots__ = ('keys', 'positions', 'shared')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.positions = {key: position for position, key in enumerate(keys)}
+        # Which of the values are deduplicated, for transactions
+        self.shared = tuple(key in SHARED_FIELDS for key in keys)
+
+
+def share(value):
+    """
+    Deduplicates equal strings, so that a value stored in many records is held once.
+    Interned strings are dropped again once no record refers to them, so values
+    from blocks that are evicted or reorganized away do not pile up.
+    :param value: A field value
+    :return: The interned string, or the value itself if it is not a string
+    """
+    if type(value) is not str:
+        return value
+    return intern(value)
+
+
+_layouts = {}
+
+
+def layout(keys):
+    """
+    :param keys: <tuple> Field names in order
+    :return: <Layout> The shared layout for these fields
+    """
+    found = _layouts.get(keys)
+    if found is None:
+        keys = tuple(share(key) for key in keys)
+        found = _layouts.setdefault(keys, Layout(keys))
+    return found
+
+
+def _rebuild(cls, keys, values):
+    record = cls.__new__(cls)
+    record._layout = layout(keys)
+    record._values = values
+    return record
+
+
+class Record(Mapping):
+    """
+    Read-only, dict-shaped record stored as a shared field layout plus a tuple of values.
+
+    Blocks and transactions are written once and never change, so they do not
+    need a hash table each: the field names live in a Layout shared by every
+    record with the same fields, in the same order. Records behave like dicts
+    for reading (indexing, get, iteration, ==), in Jinja templates, and in
+    json.dumps with default=to_json.
+    """
+    __slots__ = ('_layout', '_values')
+
+    def __init__(self, data):
+        self._layout = layout(tuple(data))
+        self._values = tuple(data.values())
+
+    def __getitem__(self, key):
+        try:
+            return self._values[self._layout.positions[key]]
+        except KeyError:
+            raise KeyError(key) from None
+
+    def get(self, key, default=None):
+        position = self._layout.positions.get(key)
+        return default if position is None else self._values[position]
+
+    def __contains__(self, key):
+        return key in self._layout.positions
+
+    def __iter__(self):
+        return iter(self._layout.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def __reduce__(self):
+        # Worker processes get the same compact records, sharing this process's layouts on the way back
+        return _rebuild, (type(self), self._layout.keys, self._values)
+
+    def to_dict(self):
+        """
+        :return: <dict> A plain, shallow copy
+        """
+        return dict(zip(self._layout.keys, self._values))
+
+
+class Transaction(Record):
+    __slots__ = ()
+
+    def __init__(self, data):
+        self._layout = layout(tuple(data))
+        self._values = tuple([
+            share(value) if shared else value for value, shared in zip(data.values(), self._layout.shared)
+        ])
+
+
+class Block(Record):
+    __slots__ = ()
+
+    def __init__(self, data):
+        data = dict(data)
+        data['transactions'] = [compact_transaction(tx) for tx in data.get('transactions', [])]
+        super().__init__(data)
+
+
+def compact_transaction(transaction):
+    """
+    :param transaction: <dict> Transaction
+    :return: <Transaction>
+    """
+    return transaction if isinstance(transaction, Transaction) else Transaction(transaction)
+
+
+def compact_block(block):
+    """
+    :param block: <dict> Block, e.g. as read from the block log or received from a peer
+    :return: <Block>
+    """
+    return block if isinstance(block, Block) else Block(block)
+
+
+def to_json(obj):
+    """
+    json.dumps default= hook that encodes records as the dicts they stand for
+    """
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
@@ -0,0 +1,439 @@
+import hashlib
+import json
+import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from time import time
+
+MAX_PENDING = 10000           # transactions held before new submissions are refused
+MAX_BLOCK_TRANSACTIONS = 100  # cut a block as soon as this many are pending
+MAX_BLOCK_AGE = 2.0           # ... or once the oldest pending transaction is this many seconds old
+MAX_RECEIPTS = 100000         # confirmed receipts remembered for polling
+
+REQUIRED_FIELDS = ('sender', 'recipient', 'product_id', 'product_name', 'quantity')
+OPTIONAL_FIELDS = ('timestamp', 'storage_temperature', 'humidity', 'location', 'version')
+# Transactions are flat records; a nested value could not be indexed or hashed consistently
+SCALAR_TYPES = (str, int, float, bool, type(None))
+
+STATUS_PENDING = 'pending'
+STATUS_CONFIRMED = 'confirmed'
+
+INBOX_DB = 'inbox.db'
+# Product ids looked up per query; SQLite allows as few as 999 bound variables per statement
+LOOKUP_CHUNK = 500
+
+INBOX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS inbox (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    tx_id TEXT NOT NULL UNIQUE,
+    product_id TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    state TEXT NOT NULL,
+    block INTEGER
+);
+CREATE INDEX IF NOT EXISTS inbox_state ON inbox (state, seq);
+CREATE INDEX IF NOT EXISTS inbox_product ON inbox (product_id, state);
+"""
+
+# Inbox rows move from queued (waiting for the writer) to mining (taken into
+# the writer's mempool) to confirmed
+INBOX_QUEUED = 'queued'
+INBOX_MINING = 'mining'
+INBOX_CONFIRMED = 'confirmed'
+
+
+def transaction_id(transaction):
+    """
+    Creates a SHA-256 id for a transaction, used for de-duplication and receipts
+    :param transaction: <dict> Transaction
+    :return: <str>
+    """
+    return hashlib.sha256(json.dumps(transaction, sort_keys=True).encode()).hexdigest()
+
+
+class Inbox:
+    """
+    Transactions submitted to any worker process, waiting for the one that writes blocks.
+
+    A SQLite table next to the block log: every worker queues the transactions
+    it accepts and answers receipts from it, and the writer's background miner
+    takes them into its mempool. Admission checks run inside one write
+    transaction, so they hold across processes. If a writer exits while
+    mining, the transactions it had taken are queued again when the next one
+    starts, so each is mined at least once.
+    """
+
+    def __init__(self, path=INBOX_DB):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as db:
+            db.executescript(INBOX_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        # Take the write lock up front, so checks and updates see the same rows
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def __len__(self):
+        """
+        :return: <int> Transactions queued or being mined
+        """
+        db = self._connection()
+        return db.execute('SELECT COUNT(*) FROM inbox WHERE state != ?', (INBOX_CONFIRMED,)).fetchone()[0]
+
+    def put(self, tx_id, transaction, max_pending=MAX_PENDING):
+        """
+        Queues a transaction for the writer
+        :return: <str> Reason it was refused, or None
+        """
+        with self._transaction() as db:
+            if db.execute('SELECT 1 FROM inbox WHERE tx_id = ?', (tx_id,)).fetchone():
+                # Resubmitting the same transaction is idempotent
+                return None
+            conflict = db.execute('SELECT 1 FROM inbox WHERE product_id = ? AND state != ? LIMIT 1',
+                                  (transaction['product_id'], INBOX_CONFIRMED)).fetchone()
+            if conflict:
+                return 'Another transaction for this product is already pending'
+            pending = db.execute('SELECT COUNT(*) FROM inbox WHERE state != ?', (INBOX_CONFIRMED,)).fetchone()[0]
+            if pending >= max_pending:
+                return 'Too many pending transactions, try again later'
+            db.execute('INSERT INTO inbox (tx_id, product_id, payload, state) VALUES (?, ?, ?, ?)',
+                       (tx_id, transaction['product_id'], json.dumps(transaction), INBOX_QUEUED))
+        return None
+
+    def receipt(self, tx_id):
+        """
+        :return: <dict> Status of the transaction, or None if it is unknown
+        """
+        row = self._connection().execute('SELECT state, block FROM inbox WHERE tx_id = ?', (tx_id,)).fetchone()
+        if row is None:
+            return None
+        if row[0] == INBOX_CONFIRMED:
+            return {'tx_id': tx_id, 'status': STATUS_CONFIRMED, 'block': row[1]}
+        return {'tx_id': tx_id, 'status': STATUS_PENDING, 'block': None}
+
+    def take(self, limit):
+        """
+        Moves the oldest queued transactions to the mining state
+        :return: <list> of (tx id, transaction)
+        """
+        with self._transaction() as db:
+            rows = db.execute('SELECT seq, tx_id, payload FROM inbox WHERE state = ? ORDER BY seq LIMIT ?',
+                              (INBOX_QUEUED, limit)).fetchall()
+            db.executemany('UPDATE inbox SET state = ? WHERE seq = ?', [(INBOX_MINING, seq) for seq, _, _ in rows])
+        return [(tx_id, json.loads(payload)) for _, tx_id, payload in rows]
+
+    def confirm(self, tx_ids, block_index, keep=MAX_RECEIPTS):
+        with self._transaction() as db:
+            db.executemany('UPDATE inbox SET state = ?, block = ? WHERE tx_id = ?',
+                           [(INBOX_CONFIRMED, block_index, tx_id) for tx_id in tx_ids])
+            # Remember only the newest `keep` receipts
+            db.execute('DELETE FROM inbox WHERE state = ? AND seq <= (SELECT MAX(seq) FROM inbox) - ?',
+                       (INBOX_CONFIRMED, keep))
+
+    def requeue(self, mined_block=None):
+        """
+        Queues again the transactions a previous writer took but did not confirm. Those it
+        did put in a block before it exited are confirmed instead, so they are not mined twice.
+        :param mined_block: (Optional) <function> (tx id, transaction) -> index of the block holding it, or None
+        :return: <int> Number of transactions queued again
+        """
+        blocks = {}
+        if mined_block is not None:
+            rows = self._connection().execute('SELECT tx_id, payload FROM inbox WHERE state = ?',
+                                              (INBOX_MINING,)).fetchall()
+            for tx_id, payload in rows:
+                block_index = mined_block(tx_id, json.loads(payload))
+                if block_index is not None:
+                    blocks[tx_id] = block_index
+        with self._transaction() as db:
+            db.executemany('UPDATE inbox SET state = ?, block = ? WHERE tx_id = ? AND state = ?',
+                           [(INBOX_CONFIRMED, block_index, tx_id, INBOX_MINING) for tx_id, block_index in blocks.items()])
+            requeued = db.execute('UPDATE inbox SET state = ? WHERE state = ?', (INBOX_QUEUED, INBOX_MINING)).rowcount
+        return requeued
+
+    def pending_products(self, product_ids):
+        """
+        :param product_ids: <iterable> Product ids to check
+        :return: <set> Those with a transaction queued or being mined, by any worker
+        """
+        product_ids = list(set(product_ids))
+        pending = set()
+        db = self._connection()
+        for start in range(0, len(product_ids), LOOKUP_CHUNK):
+            chunk = product_ids[start:start + LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = db.execute(f'SELECT product_id FROM inbox WHERE state != ? AND product_id IN ({placeholders})',
+                              [INBOX_CONFIRMED] + chunk).fetchall()
+            pending.update(product_id for product_id, in rows)
+        return pending
+
+
+class Mempool:
+    """
+    Bounded pool of validated transactions waiting to be mined.
+
+    Submitting returns a transaction id straight away; the id can be polled
+    with receipt() until the background miner confirms it in a block. With an
+    Inbox, submissions from every worker process go through it, and the pool
+    holds what the writer has taken from it.
+    """
+
+    def __init__(self, blockchain, max_pending=MAX_PENDING, max_block_transactions=MAX_BLOCK_TRANSACTIONS,
+                 max_block_age=MAX_BLOCK_AGE, inbox=None):
+        self.blockchain = blockchain
+        self.max_pending = max_pending
+        self.max_block_transactions = max_block_transactions
+        self.max_block_age = max_block_age
+        self.inbox = inbox
+        self.pending = OrderedDict()   # tx id -> (transaction, received at)
+        self.pending_products = {}     # product_id -> tx id of its pending transaction
+        self.mining = {}               # tx id -> transaction, taken for a block being mined
+        self.receipts = OrderedDict()  # tx id -> confirmed block index
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        if self.inbox is not None:
+            return len(self.inbox)
+        return len(self.pending)
+
+    def submit(self, signature=None, public_key=None, **fields):
+        """
+        Validates a transaction and queues it for the next block
+        :param signature: <str> Hex digital signature of the transaction
+        :param public_key: <str> Public key of the sender
+        :param fields: <dict> Transaction fields, as for Blockchain.new_transaction
+        :return: <tuple> (tx id, None) if accepted, (None, <str> reason) if not
+        """
+        if not all(k in fields for k in REQUIRED_FIELDS):
+            return None, 'Missing values'
+        if not all(isinstance(value, SCALAR_TYPES) for value in fields.values()):
+            return None, 'Transaction values must be strings, numbers or null'
+        if not isinstance(signature, (str, type(None))) or not isinstance(public_key, (str, type(None))):
+            return None, 'Invalid transaction signature'
+
+        transaction = self.blockchain.make_transaction(signature=signature, public_key=public_key, **fields)
+        if not transaction:
+            return None, 'Invalid transaction signature'
+
+        tx_id = transaction_id(transaction)
+        if self.inbox is not None:
+            error = self.inbox.put(tx_id, transaction, self.max_pending)
+            if error:
+                return None, error
+            with self.condition:
+                self.condition.notify_all()
+            return tx_id, None
+
+        with self.condition:
+            if tx_id in self.pending or tx_id in self.mining or tx_id in self.receipts:
+                # Resubmitting the same transaction is idempotent
+                return tx_id, None
+            if transaction['product_id'] in self.pending_products:
+                return None, 'Another transaction for this product is already pending'
+            if len(self.pending) >= self.max_pending:
+                return None, 'Too many pending transactions, try again later'
+
+            self._add(tx_id, transaction)
+        return tx_id, None
+
+    def _add(self, tx_id, transaction):
+        self.pending[tx_id] = (transaction, time())
+        self.pending_products[transaction['product_id']] = tx_id
+        self.condition.notify_all()
+
+    def restore(self, batch):
+        """
+        Puts a batch taken for a block that could not be forged back at the front of the pool
+        :param batch: <list> of (tx id, transaction), as from take()
+        """
+        with self.condition:
+            for tx_id, transaction in reversed(batch):
+                self.mining.pop(tx_id, None)
+                self.pending[tx_id] = (transaction, time())
+                self.pending.move_to_end(tx_id, last=False)
+            self.condition.notify_all()
+
+    def receipt(self, tx_id):
+        """
+        :param tx_id: <str> Id returned by submit()
+        :return: <dict> Status of the transaction, or None if it is unknown
+        """
+        if self.inbox is not None:
+            return self.inbox.receipt(tx_id)
+        with self.condition:
+            if tx_id in self.pending or tx_id in self.mining:
+                return {'tx_id': tx_id, 'status': STATUS_PENDING, 'block': None}
+            if tx_id in self.receipts:
+                return {'tx_id': tx_id, 'status': STATUS_CONFIRMED, 'block': self.receipts[tx_id]}
+        return None
+
+    def pending_product_ids(self):
+        """
+        :return: <set> Ids of the products with a transaction in the pool
+        """
+        with self.condition:
+            return set(self.pending_products)
+
+    def collect(self):
+        """
+        Takes the transactions queued in the inbox into the pool, on the writer
+        :return: <int> Number of transactions taken
+        """
+        if self.inbox is None or not self.blockchain.writer:
+            return 0
+        with self.condition:
+            room = self.max_pending - len(self.pending)
+        if room <= 0:
+            return 0
+        taken = self.inbox.take(room)
+        with self.condition:
+            for tx_id, transaction in taken:
+                # The inbox already checked for duplicates and conflicting products
+                self._add(tx_id, transaction)
+        return len(taken)
+
+    def mined_block(self, tx_id, transaction):
+        """
+        Looks for a transaction on the chain, e.g. one a writer mined but exited before confirming
+        :param tx_id: <str> Id of the transaction
+        :param transaction: <dict> The transaction
+        :return: <int> Index of the block holding it, or None
+        """
+        # Newest first: an unconfirmed transaction can only be in the last blocks the previous writer forged
+        for block_index, position in reversed(self.blockchain.product_positions(transaction['product_id'])):
+            if transaction_id(dict(self.blockchain.chain[block_index - 1]['transactions'][position])) == tx_id:
+                return block_index
+        return None
+
+    def ready(self):
+        """
+        :return: <bool> True if enough transactions, or old enough ones, are pending to cut a block
+        """
+        if not self.pending:
+            return False
+        if len(self.pending) >= self.max_block_transactions:
+            return True
+        _, received = next(iter(self.pending.values()))
+        return time() - received >= self.max_block_age
+
+    def take(self, limit=None):
+        """
+        Removes up to `limit` of the oldest pending transactions
+        :return: <list> of (tx id, transaction)
+        """
+        limit = limit or self.max_block_transactions
+        batch = []
+        with self.condition:
+            while self.pending and len(batch) < limit:
+                tx_id, (transaction, _) = self.pending.popitem(last=False)
+                self.mining[tx_id] = transaction
+                batch.append((tx_id, transaction))
+        return batch
+
+    def confirm(self, batch, block_index):
+        if self.inbox is not None and batch:
+            self.inbox.confirm([tx_id for tx_id, _ in batch], block_index)
+        with self.condition:
+            for tx_id, transaction in batch:
+                self.mining.pop(tx_id, None)
+                self.pending_products.pop(transaction['product_id'], None)
+                self.receipts[tx_id] = block_index
+            while len(self.receipts) > MAX_RECEIPTS:
+                self.receipts.popitem(last=False)
+            self.condition.notify_all()
+
+
+class BackgroundMiner(threading.Thread):
+    """
+    Daemon thread that forges a block whenever the mempool is ready()
+    """
+
+    def __init__(self, blockchain, mempool, poll_interval=0.25):
+        super().__init__(name='background-miner', daemon=True)
+        self.blockchain = blockchain
+        self.mempool = mempool
+        self.poll_interval = poll_interval
+        self._stop_event = threading.Event()
+
+    def ensure_started(self):
+        if not self.is_alive() and not self._stop_event.is_set():
+            try:
+                self.start()
+            except RuntimeError:
+                # Another request started it first
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+        with self.mempool.condition:
+            self.mempool.condition.notify_all()
+
+    def run(self):
+        requeued = False
+        while not self._stop_event.is_set():
+            if not self.blockchain.writer:
+                # Another process writes the blocks; this one may take over later
+                self._stop_event.wait(self.poll_interval)
+                continue
+            if not self.blockchain.consensus.can_seal():
+                # A proof of authority node without an authority key only follows
+                self._stop_event.wait(self.poll_interval)
+                continue
+            if not requeued and self.mempool.inbox is not None:
+                requeued = True
+                count = self.mempool.inbox.requeue(self.mempool.mined_block)
+                if count:
+                    print(f"Queued {count} transactions again that the previous writer did not mine")
+            try:
+                self.mempool.collect()
+                with self.mempool.condition:
+                    if not self.mempool.ready():
+                        self.mempool.condition.wait(self.poll_interval)
+                        continue
+                self.mine_once()
+            except Exception as e:
+                # The batch is back in the pool; try again rather than let the thread die
+                print(f"Background mining failed, retrying: {e!r}")
+                self._stop_event.wait(self.poll_interval)
+
+    def mine_once(self):
+        """
+        Forges one block from the oldest pending transactions, plus anything
+        already in blockchain.current_transactions (such as a mining reward)
+        :return: <dict> New Block, or None if nothing was pending
+        """
+        self.mempool.collect()
+        with self.blockchain.lock:
+            batch = self.mempool.take()
+            if not batch and not self.blockchain.current_transactions:
+                return None
+            queued = len(self.blockchain.current_transactions)
+            self.blockchain.current_transactions.extend(transaction for _, transaction in batch)
+            try:
+                block = self.blockchain.mine_pending()
+            except Exception:
+                # new_block leaves the chain untouched on failure; hand the batch back to the pool
+                del self.blockchain.current_transactions[queued:]
+                self.mempool.restore(batch)
+                raise
+        self.mempool.confirm(batch, block['index'])
+        return block
@@ -0,0 +1,64 @@
+import hashlib
+
+EMPTY_ROOT = '0' * 64
+
+
+def _pair_hash(left, right):
+    return hashlib.sha256(bytes.fromhex(left) + bytes.fromhex(right)).hexdigest()
+
+
+def _next_level(level):
+    if len(level) % 2:
+        # Odd levels pair their last node with itself
+        level = level + [level[-1]]
+    return [_pair_hash(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+
+
+def merkle_root(leaves):
+    """
+    Computes the Merkle root of a list of leaf hashes
+    :param leaves: <list> Hex SHA-256 leaf hashes, in block order
+    :return: <str> Hex root hash
+    """
+    if not leaves:
+        return EMPTY_ROOT
+    level = list(leaves)
+    while len(level) > 1:
+        level = _next_level(level)
+    return level[0]
+
+
+def merkle_proof(leaves, position):
+    """
+    Builds an inclusion proof for one leaf
+    :param leaves: <list> Hex SHA-256 leaf hashes, in block order
+    :param position: <int> Position of the leaf to prove
+    :return: <list> of {'side': 'left'|'right', 'hash': <str>} sibling hashes, from the leaf up
+    """
+    proof = []
+    level = list(leaves)
+    while len(level) > 1:
+        if len(level) % 2:
+            level.append(level[-1])
+        sibling = position ^ 1
+        proof.append({'side': 'left' if sibling < position else 'right', 'hash': level[sibling]})
+        level = _next_level(level)
+        position //= 2
+    return proof
+
+
+def verify_merkle_proof(leaf, proof, root):
+    """
+    Checks that a leaf is included under a Merkle root
+    :param leaf: <str> Hex leaf hash
+    :param proof: <list> Proof from merkle_proof()
+    :param root: <str> Expected hex root hash
+    :return: <bool>
+    """
+    current = leaf
+    for step in proof:
+        if step['side'] == 'left':
+            current = _pair_hash(step['hash'], current)
+        else:
+            current = _pair_hash(current, step['hash'])
+    return current == root
@@ -0,0 +1,310 @@
+import cProfile
+import os
+import random
+import re
+import threading
+from bisect import bisect_left
+from time import perf_counter, strftime
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Request latency buckets in seconds, from static pages up to a long mining round
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Sampled profiling of slow requests, off unless PROFILE_SAMPLE_RATE is set
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_SLOW_SECONDS = float(os.environ.get('PROFILE_SLOW_SECONDS', 1.0))
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+class Metric:
+    """
+    A named metric with one time series per combination of label values.
+
+    Updates take a per-metric lock and touch a dict entry, so recording on
+    a hot path costs about as much as a dict lookup.
+    """
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """
+        :return: <list> of (<str> sample name, <str> formatted labels, value)
+        """
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _format_labels(self.labelnames, key), value) for key, value in sorted(values)]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.kind}']
+        lines.extend(f'{name}{labels} {_format_value(value)}' for name, labels, value in self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError('Counters can only go up')
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    A value that goes up and down. Pass `function` to read the value at
+    scrape time instead, e.g. the length of a queue.
+    """
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [(self.name, '', self.function())]
+        return super().samples()
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = perf_counter() - self.started
+        self.histogram.observe(self.elapsed, **self.labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        position = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(key)
+            if series is None:
+                # Per-bucket counts (the last one is +Inf), sum
+                series = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][position] += 1
+            series[1] += value
+
+    def time(self, **labels):
+        """
+        Context manager that observes the duration of its block
+        """
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        samples = []
+        for key, counts, total in sorted(values):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                samples.append((f'{self.name}_bucket', labels, cumulative))
+            labels = _format_labels(self.labelnames, key)
+            samples.append((f'{self.name}_sum', labels, total))
+            samples.append((f'{self.name}_count', labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Adds a metric, or returns the one already registered under its name
+        :param metric: <Metric>
+        :return: <Metric>
+        """
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric):
+                    raise ValueError(f"{metric.name} is already registered as a {existing.kind}")
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """
+        :return: <str> Every metric in the Prometheus text exposition format
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda metric: metric.name)
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+registry = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return registry.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=(), function=None):
+    metric = registry.register(Gauge(name, documentation, labelnames))
+    if function is not None:
+        metric.function = function
+    return metric
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return registry.register(Histogram(name, documentation, labelnames, buckets))
+
+
+REQUEST_SECONDS = histogram('http_request_duration_seconds', 'Time spent handling a request.',
+                            ('method', 'route', 'status'))
+PROFILES_WRITTEN = counter('profiles_written_total', 'Slow requests whose cProfile stats were written to disk.')
+
+
+class RequestProfiler:
+    """
+    Profiles a random sample of requests and keeps the stats of the slow ones.
+
+    Only one request is profiled at a time, since the interpreter allows a
+    single active profiler.
+    """
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, slow_seconds=PROFILE_SLOW_SECONDS, directory=PROFILE_DIR):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self._busy = threading.Lock()
+
+    def start(self):
+        """
+        :return: <cProfile.Profile> if this request was sampled, else None
+        """
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        if not self._busy.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Another profiler (e.g. a debugger) is already active
+            self._busy.release()
+            return None
+        return profile
+
+    def finish(self, profile, elapsed, name):
+        """
+        Stops the profiler and writes its stats if the request was slow
+        :return: <str> Path of the stats file, or None
+        """
+        profile.disable()
+        self._busy.release()
+        if elapsed < self.slow_seconds:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        safe_name = re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or 'request'
+        path = os.path.join(self.directory, f"{strftime('%Y%m%d-%H%M%S')}-{safe_name}-{int(elapsed * 1000)}ms.prof")
+        profile.dump_stats(path)
+        PROFILES_WRITTEN.inc()
+        return path
+
+
+def instrument(app, profiler=None):
+    """
+    Records the latency of every request of a Flask app, and profiles a sample of them
+    :param app: <Flask>
+    :param profiler: <RequestProfiler> (default: configured from the PROFILE_* environment variables)
+    """
+    from flask import g, request
+
+    profiler = profiler or RequestProfiler()
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = perf_counter()
+        g.metrics_profile = profiler.start()
+
+    @app.after_request
+    def _record_latency(response):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return response
+        elapsed = perf_counter() - started
+        # Label by the route pattern so /products/<product_id>/proof is one series
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        REQUEST_SECONDS.observe(elapsed, method=request.method, route=route, status=response.status_code)
+        profile = g.pop('metrics_profile', None)
+        if profile is not None:
+            profiler.finish(profile, elapsed, f'{request.method}-{route}')
+        return response
+
+    @app.teardown_request
+    def _stop_profile(exc):
+        # after_request does not run when a view raises
+        profile = g.pop('metrics_profile', None)
+        if profile is not None:
+            profiler.finish(profile, 0.0, 'failed')
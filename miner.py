@@ -0,0 +1,170 @@
+import atexit
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+import metrics
+
+DEFAULT_DIFFICULTY = 4
+CHUNK_SIZE = 20000
+# How many attempts a worker makes between checks for a proof found elsewhere
+CANCEL_CHECK_INTERVAL = 2048
+
+MINING_ATTEMPTS = metrics.counter('pow_attempts_total', 'Proof of work hashes computed.')
+MINING_SECONDS = metrics.histogram('pow_duration_seconds', 'Time spent searching for a proof of work.')
+MINING_HASHRATE = metrics.gauge('pow_hashrate', 'Hashes per second of the most recent proof of work search.')
+
+MiningResult = namedtuple('MiningResult', ['proof', 'attempts', 'elapsed', 'hashrate'])
+
+# Shared with pool workers: the lowest chunk id that produced a proof, or -1
+_found_chunk = None
+
+
+def _init_worker(found_chunk):
+    global _found_chunk
+    _found_chunk = found_chunk
+
+
+def valid_proof(last_proof, proof, difficulty=DEFAULT_DIFFICULTY):
+    """
+    :param last_proof: <int> Previous Proof
+    :param proof: <int> Current Proof
+    :param difficulty: <int> Number of leading zero hex digits required
+    :return: <bool> True if hash(last_proof, proof) starts with enough zeroes
+    """
+    guess_hash = hashlib.sha256(f'{last_proof}{proof}'.encode()).hexdigest()
+    return guess_hash[:difficulty] == '0' * difficulty
+
+
+def search_chunk(last_proof, chunk_id, chunk_size=CHUNK_SIZE, difficulty=DEFAULT_DIFFICULTY):
+    """
+    Searches proofs [chunk_id * chunk_size, (chunk_id + 1) * chunk_size) for the first valid one.
+
+    This accepts exactly the proofs valid_proof accepts, but hashes
+    the shared last_proof prefix once and compares raw digest bytes instead of
+    formatting a hex string for every attempt.
+    :param last_proof: <int> Previous Proof
+    :param chunk_id: <int> Which slice of the nonce space to search
+    :param chunk_size: <int> Number of proofs per chunk
+    :param difficulty: <int> Number of leading zero hex digits required
+    :return: <tuple> (proof or None, attempts made)
+    """
+    zero_bytes, half_byte = divmod(difficulty, 2)
+    zeroes = bytes(zero_bytes)
+    prefix = hashlib.sha256(str(last_proof).encode())
+    start = chunk_id * chunk_size
+    stop = start + chunk_size
+    found_chunk = _found_chunk
+
+    for proof in range(start, stop):
+        h = prefix.copy()
+        h.update(str(proof).encode())
+        digest = h.digest()
+        if digest[:zero_bytes] == zeroes and (not half_byte or digest[zero_bytes] < 0x10):
+            if found_chunk is not None:
+                with found_chunk.get_lock():
+                    if found_chunk.value < 0 or chunk_id < found_chunk.value:
+                        found_chunk.value = chunk_id
+            return proof, proof - start + 1
+        if found_chunk is not None and (proof - start) % CANCEL_CHECK_INTERVAL == 0:
+            # A lower chunk already holds a proof, so nothing here can win
+            if 0 <= found_chunk.value < chunk_id:
+                return None, proof - start + 1
+    return None, chunk_size
+
+
+class Miner:
+    """
+    Proof of Work search spread over a pool of worker processes.
+
+    The nonce space is cut into fixed-size chunks which are handed out in
+    order and collected in order, so the result is always the smallest valid
+    proof - the same one the sequential search finds. As soon as any worker
+    finds a proof, workers on higher chunks abandon their search.
+    """
+
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.last_result = None
+        self._pool = None
+        self._found_chunk = None
+        self._lock = threading.Lock()
+
+    def mine(self, last_proof, difficulty=DEFAULT_DIFFICULTY):
+        """
+        Finds the smallest proof for last_proof
+        :param last_proof: <int> Previous Proof
+        :param difficulty: <int> Number of leading zero hex digits required
+        :return: <MiningResult>
+        """
+        with self._lock:
+            started = perf_counter()
+            if self.workers <= 1:
+                proof, attempts = self._mine_sequential(last_proof, difficulty)
+            else:
+                proof, attempts = self._mine_parallel(last_proof, difficulty)
+            elapsed = perf_counter() - started
+            hashrate = attempts / elapsed if elapsed > 0 else 0.0
+            self.last_result = MiningResult(proof, attempts, elapsed, hashrate)
+            MINING_ATTEMPTS.inc(attempts)
+            MINING_SECONDS.observe(elapsed)
+            MINING_HASHRATE.set(hashrate)
+            return self.last_result
+
+    def _mine_sequential(self, last_proof, difficulty):
+        attempts = 0
+        chunk_id = 0
+        while True:
+            proof, tried = search_chunk(last_proof, chunk_id, self.chunk_size, difficulty)
+            attempts += tried
+            if proof is not None:
+                return proof, attempts
+            chunk_id += 1
+
+    def _mine_parallel(self, last_proof, difficulty):
+        pool = self._get_pool()
+        self._found_chunk.value = -1
+
+        futures = {}
+        next_chunk = 0
+        for _ in range(self.workers * 2):
+            futures[next_chunk] = pool.submit(search_chunk, last_proof, next_chunk, self.chunk_size, difficulty)
+            next_chunk += 1
+
+        attempts = 0
+        chunk_id = 0
+        while True:
+            proof, tried = futures.pop(chunk_id).result()
+            attempts += tried
+            if proof is not None:
+                break
+            futures[next_chunk] = pool.submit(search_chunk, last_proof, next_chunk, self.chunk_size, difficulty)
+            next_chunk += 1
+            chunk_id += 1
+
+        # Chunks above the winner stop early once they see the shared flag
+        self._found_chunk.value = chunk_id
+        for future in futures.values():
+            attempts += future.result()[1]
+        return proof, attempts
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._found_chunk = multiprocessing.Value('q', -1)
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                initializer=_init_worker,
+                initargs=(self._found_chunk,),
+            )
+            atexit.register(self.shutdown)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(cancel_futures=True)
+            self._pool = None
@@ -0,0 +1,124 @@
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+POSTINGS_DB = 'postings.db'
+# Blocks indexed per write transaction while catching up with the chain
+CATCH_UP_BLOCKS = 1000
+
+POSTINGS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS postings (
+    product_id TEXT NOT NULL,
+    block_index INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (product_id, block_index, position)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS blocks (
+    block_index INTEGER PRIMARY KEY,
+    hash TEXT NOT NULL
+);
+"""
+
+
+class ProductPostings:
+    """
+    Where each product's transactions are on the chain, in a SQLite file next to the block log.
+
+    The writer adds a block's postings as the block is appended and drops them
+    when blocks are truncated, so looking up a product's history costs one
+    index lookup however long the chain is, and never a scan of the chain.
+    The hash of every indexed block is kept as well, so catch_up() can tell
+    whether the postings still describe the chain they are opened with.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as db:
+            db.executescript(POSTINGS_SCHEMA)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            yield db
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        db.execute('COMMIT')
+
+    def height(self):
+        """
+        :return: <int> Index of the last block indexed, or 0
+        """
+        return self._connection().execute('SELECT COALESCE(MAX(block_index), 0) FROM blocks').fetchone()[0]
+
+    def positions(self, product_id, height):
+        """
+        :param product_id: <str> ID of the product
+        :param height: <int> Leave out blocks after this one, e.g. ones a reader has not followed yet
+        :return: <list> of (block index, position in block), oldest first
+        """
+        rows = self._connection().execute(
+            'SELECT block_index, position FROM postings WHERE product_id = ? AND block_index <= ? '
+            'ORDER BY block_index, position', (product_id, height))
+        return [tuple(row) for row in rows]
+
+    def add(self, blocks, hashes):
+        """
+        Indexes blocks appended to the chain
+        :param blocks: <list> Consecutive blocks, following the last one indexed
+        :param hashes: <list> Their hashes
+        """
+        with self._transaction() as db:
+            db.executemany('INSERT OR REPLACE INTO postings VALUES (?, ?, ?)', [
+                (tx['product_id'], block['index'], position)
+                for block in blocks
+                for position, tx in enumerate(block['transactions'])
+                if tx.get('product_id') is not None
+            ])
+            db.executemany('INSERT OR REPLACE INTO blocks VALUES (?, ?)',
+                           [(block['index'], block_hash) for block, block_hash in zip(blocks, hashes)])
+
+    def truncate(self, height):
+        """
+        Drops the postings of every block after `height`
+        :param height: <int> Number of blocks to keep
+        """
+        with self._transaction() as db:
+            db.execute('DELETE FROM postings WHERE block_index > ?', (height,))
+            db.execute('DELETE FROM blocks WHERE block_index > ?', (height,))
+
+    def catch_up(self, chain, block_hash):
+        """
+        Brings the postings in line with the chain: drops blocks that are no longer on it,
+        or everything if the chain was rewritten, and indexes the blocks missing at the end.
+        Only the writer may call this.
+        :param chain: <list> The chain
+        :param block_hash: <function> Index of a block on the chain -> its hash
+        :return: <int> Number of blocks indexed
+        """
+        height = min(self.height(), len(chain))
+        if height:
+            row = self._connection().execute('SELECT hash FROM blocks WHERE block_index = ?', (height,)).fetchone()
+            if row is None or row[0] != block_hash(height):
+                print(f"Product postings in {self.path} do not match the chain; rebuilding them")
+                height = 0
+        self.truncate(height)
+        if len(chain) > height:
+            print(f"Indexing product postings for blocks {height + 1} to {len(chain)}")
+        for start in range(height, len(chain), CATCH_UP_BLOCKS):
+            blocks = chain[start:start + CATCH_UP_BLOCKS]
+            self.add(blocks, [block_hash(block['index']) for block in blocks])
+        return len(chain) - height
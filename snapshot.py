@@ -0,0 +1,82 @@
+import json
+import os
+
+from ledger import to_json
+
+SNAPSHOT_PREFIX = 'snapshot-'
+SNAPSHOT_SUFFIX = '.json'
+SNAPSHOT_INTERVAL = 1000  # blocks between snapshots
+KEEP_SNAPSHOTS = 2
+
+
+def snapshot_path(directory, height):
+    return os.path.join(directory, f'{SNAPSHOT_PREFIX}{height:010d}{SNAPSHOT_SUFFIX}')
+
+
+def list_snapshots(directory):
+    """
+    :return: <list> of (<int> height, <str> path), newest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    snapshots = []
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and name.endswith(SNAPSHOT_SUFFIX):
+            try:
+                height = int(name[len(SNAPSHOT_PREFIX):-len(SNAPSHOT_SUFFIX)])
+            except ValueError:
+                continue
+            snapshots.append((height, os.path.join(directory, name)))
+    return sorted(snapshots, reverse=True)
+
+
+def save_snapshot(directory, height, block_hash, state):
+    """
+    Writes the world state as of a block, replacing all but the newest KEEP_SNAPSHOTS snapshots
+    :param directory: <str> Data directory of the chain
+    :param height: <int> Height the state was derived from
+    :param block_hash: <str> Hash of the block at that height
+    :param state: <dict> World state
+    """
+    path = snapshot_path(directory, height)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'height': height, 'hash': block_hash, 'state': state}, f, separators=(',', ':'), default=to_json)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+    for _, old in list_snapshots(directory)[KEEP_SNAPSHOTS:]:
+        os.remove(old)
+
+
+def load_snapshot(directory, height, block_hash):
+    """
+    Finds the newest snapshot of a block that is still on the chain
+    :param directory: <str> Data directory of the chain
+    :param height: <int> Current height of the chain
+    :param block_hash: <function> Returns the hash of the block at a given index
+    :return: <tuple> (<int> height, <dict> state), or (0, None) if there is no usable snapshot
+    """
+    for snapshot_height, path in list_snapshots(directory):
+        if snapshot_height > height:
+            continue
+        try:
+            with open(path, 'r') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            print(f"Could not read snapshot {path}; skipping it")
+            continue
+        if snapshot.get('hash') != block_hash(snapshot_height):
+            # Taken on a fork we have since left
+            continue
+        return snapshot_height, snapshot['state']
+    return 0, None
+
+
+def drop_snapshots(directory, above):
+    """
+    Deletes snapshots of blocks that are no longer on the chain
+    :param above: <int> Height of the last block that was kept
+    """
+    for height, path in list_snapshots(directory):
+        if height > above:
+            os.remove(path)
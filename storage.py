@@ -0,0 +1,660 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import zlib
+from collections import OrderedDict
+
+from ledger import to_json
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where a single process is assumed
+    fcntl = None
+
+# Every record is an 8 byte header (payload length, CRC32 of the payload)
+# followed by the compact JSON encoding of one block.
+RECORD_HEADER = struct.Struct('>II')
+
+SEGMENT_PREFIX = 'segment-'
+SEGMENT_SUFFIX = '.log'
+DEFAULT_SEGMENT_SIZE = 16 * 1024 * 1024
+
+# One fixed-size entry per block: (index of the first block in its segment, offset in the segment)
+INDEX_FILE = 'blocks.idx'
+INDEX_ENTRY = struct.Struct('>IQ')
+
+# Decoded blocks LazyChain keeps in memory
+BLOCK_CACHE_SIZE = 1024
+
+# Held by the one process allowed to append to the log
+WRITER_LOCK_FILE = 'writer.lock'
+# Bumped whenever blocks already in the log are rewritten, so readers know to reload
+EPOCH_FILE = 'log.epoch'
+
+# Durability policies
+DURABILITY_ALWAYS = 'always'  # fsync after every appended block
+DURABILITY_BATCH = 'batch'    # fsync every `sync_every` blocks and on close
+DURABILITY_NONE = 'none'      # leave flushing to the operating system
+DURABILITY_POLICIES = (DURABILITY_ALWAYS, DURABILITY_BATCH, DURABILITY_NONE)
+
+
+def encode_record(block):
+    """
+    Encodes a block as a length-prefixed, checksummed record
+    :param block: <dict> Block
+    :return: <bytes>
+    """
+    payload = json.dumps(block, separators=(',', ':'), default=to_json).encode()
+    return RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+
+
+def read_records(f):
+    """
+    Reads records from an open segment until the end of the file or the first torn record
+    :param f: Segment file opened in binary mode
+    :return: <generator> of (<int> offset, <dict> block); iteration stops at the first bad record
+    """
+    while True:
+        offset = f.tell()
+        header = f.read(RECORD_HEADER.size)
+        if len(header) < RECORD_HEADER.size:
+            return
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = f.read(length)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            return
+        try:
+            block = json.loads(payload)
+        except ValueError:
+            return
+        yield offset, block
+
+
+class OffsetIndex:
+    """
+    Where each block's record starts, in a memory-mapped file of fixed-size entries.
+
+    Looking up a block costs one entry read no matter how long the chain is,
+    and opening the index does not read it at all.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._map = None
+        self._mapped = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'a+b')
+        # A trailing partial entry is being written by the writer, or was cut short by a crash; see repair()
+        self.count = os.fstat(self._file.fileno()).st_size // INDEX_ENTRY.size
+
+    def repair(self):
+        """
+        Cuts off an entry a crash left half written. Only the writer may call this.
+        """
+        with self._lock:
+            if os.fstat(self._file.fileno()).st_size % INDEX_ENTRY.size:
+                self._file.truncate(self.count * INDEX_ENTRY.size)
+
+    def refresh(self):
+        """
+        Picks up the entries another process appended
+        :return: <int> Number of entries
+        """
+        with self._lock:
+            count = os.fstat(self._file.fileno()).st_size // INDEX_ENTRY.size
+            if count < self._mapped:
+                self._unmap()
+            self.count = count
+            return count
+
+    def reopen(self):
+        """
+        Opens the index file again, in case another process replaced it
+        """
+        with self._lock:
+            self._unmap()
+            self._file.close()
+            self._open()
+
+    def __len__(self):
+        return self.count
+
+    def get(self, position):
+        """
+        :param position: <int> Position of the block in the chain, from 0
+        :return: <tuple> (<int> first block index of its segment, <int> offset of its record)
+        """
+        if not 0 <= position < self.count:
+            raise IndexError(position)
+        with self._lock:
+            if position >= self._mapped:
+                self._remap()
+            return INDEX_ENTRY.unpack_from(self._map, position * INDEX_ENTRY.size)
+
+    def _remap(self):
+        self._file.flush()
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), self.count * INDEX_ENTRY.size, access=mmap.ACCESS_READ)
+        self._mapped = self.count
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+            self._mapped = 0
+
+    def append(self, segment, offset):
+        self._file.write(INDEX_ENTRY.pack(segment, offset))
+        self._file.flush()
+        self.count += 1
+
+    def truncate(self, count):
+        with self._lock:
+            self._unmap()
+            self._file.truncate(count * INDEX_ENTRY.size)
+            self.count = count
+
+    def replace(self, entries):
+        """
+        Rewrites the whole index; readers that still map the old file are unaffected
+        :param entries: <list> of (segment, offset)
+        """
+        with self._lock:
+            self._unmap()
+            self._file.close()
+            with open(self.path + '.tmp', 'wb') as f:
+                f.write(b''.join(INDEX_ENTRY.pack(segment, offset) for segment, offset in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(self.path + '.tmp', self.path)
+            self._open()
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._unmap()
+            self._file.close()
+
+
+class WriterLock:
+    """
+    Advisory lock on a data directory, held by the one process that may append to its block log.
+
+    Other processes only read the log. The operating system releases the lock
+    when the holder exits, however it exits, so a reader can take over.
+    """
+
+    def __init__(self, directory):
+        self.path = os.path.join(directory, WRITER_LOCK_FILE)
+        self._file = None
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def held(self):
+        return self._file is not None
+
+    def acquire(self):
+        """
+        Takes the lock if no other process holds it, without waiting
+        :return: <bool> True if this process holds the lock
+        """
+        if self._file is not None:
+            return True
+        f = open(self.path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                f.close()
+                return False
+        # For operators: which process is the writer
+        f.seek(0)
+        f.truncate()
+        f.write(f'{os.getpid()}\n')
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._file is None:
+            return
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class BlockLog:
+    """
+    Append-only block storage split over rotating segment files.
+
+    Segments are named after the index of the first block they hold, so
+    they sort in chain order. Appending a block writes a single record to
+    the newest segment, which keeps the cost of a write proportional to the
+    size of the block rather than the height of the chain. An offset index
+    next to the segments locates any block without reading the ones before it.
+    """
+
+    def __init__(self, directory, segment_size=DEFAULT_SEGMENT_SIZE, durability=DURABILITY_ALWAYS, sync_every=32):
+        if durability not in DURABILITY_POLICIES:
+            raise ValueError(f"Unknown durability policy: {durability}")
+        self.directory = directory
+        self.segment_size = segment_size
+        self.durability = durability
+        self.sync_every = sync_every
+        self.height = 0
+        self._file = None
+        self._segment = None
+        self._unsynced = 0
+        self._readers = {}
+        self._readers_lock = threading.Lock()
+        self.epoch = None  # as of the last attach() or follow()
+        os.makedirs(directory, exist_ok=True)
+        self.index = OffsetIndex(os.path.join(directory, INDEX_FILE))
+
+    def __len__(self):
+        return self.height
+
+    def segments(self):
+        """
+        :return: <list> Paths of all segment files in chain order
+        """
+        names = sorted(
+            name for name in os.listdir(self.directory)
+            if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX)
+        )
+        return [os.path.join(self.directory, name) for name in names]
+
+    def segment_path(self, first_index):
+        return os.path.join(self.directory, f'{SEGMENT_PREFIX}{first_index:010d}{SEGMENT_SUFFIX}')
+
+    @staticmethod
+    def _first_index(path):
+        return int(os.path.basename(path)[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)])
+
+    def attach(self):
+        """
+        Opens the log without reading it back: the offset index already knows where
+        every block is, so only records written after the index are scanned. Rebuilds
+        the index from the segments if it does not match them.
+        :return: <int> Height of the chain in the log
+        """
+        self.close()
+        self._close_readers()
+        self.index.reopen()
+        self.index.repair()
+        segments = self.segments()
+        if not len(self.index):
+            entries = self._scan(segments, 0, 0)
+            if entries:
+                self.index.replace(entries)
+                self._bump_epoch()
+        else:
+            segment, offset = self.index.get(len(self.index) - 1)
+            path = self.segment_path(segment)
+            end = self._record_end(path, offset) if path in segments else None
+            if end is None:
+                print(f"Offset index in {self.directory} does not match the block log; rebuilding it")
+                self.index.replace(self._scan(segments, 0, 0))
+                self._bump_epoch()
+            else:
+                for entry in self._scan(segments, segments.index(path), end):
+                    self.index.append(*entry)
+        self.height = len(self.index)
+        self.epoch = self._read_epoch()
+        return self.height
+
+    def follow(self):
+        """
+        Catches up with the blocks the writer appended since the last call, without writing anything
+        :return: <bool> False if blocks this process may already have read were rewritten since
+                 (a reorg or a rebuilt index), so everything derived from them must be reloaded
+        """
+        epoch = self._read_epoch()
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self._close_readers()
+            self.index.reopen()
+            self.height = len(self.index)
+            return False
+        count = self.index.refresh()
+        shrunk = count < self.height
+        self.height = count
+        if shrunk:
+            # Truncated, and the epoch not bumped yet
+            self._close_readers()
+            return False
+        return True
+
+    def _read_epoch(self):
+        try:
+            with open(os.path.join(self.directory, EPOCH_FILE), 'r') as f:
+                return int(f.read() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _bump_epoch(self):
+        path = os.path.join(self.directory, EPOCH_FILE)
+        epoch = self._read_epoch() + 1
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(epoch))
+        os.replace(path + '.tmp', path)
+        self.epoch = epoch
+
+    def recover(self, decode=None):
+        """
+        Reads every block back from disk, truncating a torn record at the tail of the last segment
+        :param decode: (Optional) <function> Applied to each block as it is read
+        :return: <list> Blocks in chain order
+        """
+        self.attach()
+        return [decode(block) if decode else block for block in self.read_range(1, self.height)]
+
+    def _scan(self, segments, start_segment, start_offset):
+        """
+        Finds the records from a point in the log to its end, cutting off a torn record at the tail
+        :return: <list> of (segment, offset) index entries
+        """
+        entries = []
+        for position in range(start_segment, len(segments)):
+            path = segments[position]
+            first_index = self._first_index(path)
+            with open(path, 'rb') as f:
+                f.seek(start_offset if position == start_segment else 0)
+                end = f.tell()
+                for offset, _ in read_records(f):
+                    entries.append((first_index, offset))
+                    end = f.tell()
+                size = os.fstat(f.fileno()).st_size
+            if end == size:
+                continue
+            if position != len(segments) - 1:
+                raise ValueError(f"Corrupt record in {path} at offset {end}; refusing to drop later segments")
+            # A crash during an append leaves a partial record behind; cut it off
+            print(f"Truncating torn record in {path} at offset {end} ({size - end} bytes)")
+            with open(path, 'r+b') as f:
+                f.truncate(end)
+                f.flush()
+                os.fsync(f.fileno())
+        return entries
+
+    def _record_end(self, path, offset):
+        """
+        :return: <int> Offset just past the intact record at `offset`, or None if there is none
+        """
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            for _ in read_records(f):
+                return f.tell()
+        return None
+
+    def _reader(self, segment):
+        with self._readers_lock:
+            fd = self._readers.get(segment)
+            if fd is None:
+                fd = self._readers[segment] = os.open(self.segment_path(segment), os.O_RDONLY)
+            return fd
+
+    def _close_readers(self):
+        with self._readers_lock:
+            for fd in self._readers.values():
+                os.close(fd)
+            self._readers.clear()
+
+    def read(self, index):
+        """
+        Reads one block through the offset index
+        :param index: <int> Index of the block, from 1
+        :return: <dict> Block
+        """
+        segment, offset = self.index.get(index - 1)
+        fd = self._reader(segment)
+        header = os.pread(fd, RECORD_HEADER.size, offset)
+        length, checksum = RECORD_HEADER.unpack(header)
+        payload = os.pread(fd, length, offset + RECORD_HEADER.size)
+        if len(payload) < length or zlib.crc32(payload) != checksum:
+            raise ValueError(f"Corrupt record for block {index} in segment {segment} at offset {offset}")
+        return json.loads(payload)
+
+    def read_range(self, first, last):
+        """
+        Reads consecutive blocks sequentially
+        :param first: <int> Index of the first block, from 1
+        :param last: <int> Index of the last block, inclusive
+        :return: <generator> of blocks
+        """
+        index = first
+        while index <= last:
+            segment, offset = self.index.get(index - 1)
+            start = index
+            with open(self.segment_path(segment), 'rb') as f:
+                f.seek(offset)
+                for _, block in read_records(f):
+                    yield block
+                    index += 1
+                    if index > last:
+                        return
+            if index == start:
+                raise ValueError(f"Corrupt record for block {index} in segment {segment} at offset {offset}")
+
+    def append(self, block):
+        """
+        Appends a block to the newest segment, rotating to a new segment when it is full
+        :param block: <dict> Block
+        :return: <int> Bytes written
+        """
+        record = encode_record(block)
+        if self._file is None or self._file.tell() + len(record) > self.segment_size and self._file.tell() > 0:
+            self._open_segment(self.height + 1)
+        offset = self._file.tell()
+        self._file.write(record)
+        self._file.flush()
+        self.index.append(self._segment, offset)
+        self.height += 1
+        self._unsynced += 1
+        if self.durability == DURABILITY_ALWAYS or (
+                self.durability == DURABILITY_BATCH and self._unsynced >= self.sync_every):
+            self.sync()
+        return len(record)
+
+    def truncate(self, height):
+        """
+        Drops every block after `height`, e.g. when switching to a peer's longer chain
+        :param height: <int> Number of blocks to keep
+        """
+        if height >= self.height:
+            return
+        self.close()
+        self._close_readers()
+        segment, offset = self.index.get(height)
+        for path in self.segments():
+            first_index = self._first_index(path)
+            if first_index > segment or (first_index == segment and offset == 0):
+                os.remove(path)
+            elif first_index == segment:
+                with open(path, 'r+b') as f:
+                    f.truncate(offset)
+                    f.flush()
+                    os.fsync(f.fileno())
+        self.index.truncate(height)
+        self.height = height
+        self._bump_epoch()
+        self._sync_directory()
+
+    def sync(self):
+        if self._file is not None and self._unsynced:
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+
+    def close(self):
+        if self._file is not None:
+            self.sync()
+            self._file.close()
+            self._file = None
+            # The index can be rebuilt from the segments, so it is only forced to disk here
+            self.index.sync()
+
+    def _open_segment(self, first_index):
+        existing = self.segments()
+        if self._file is None and existing:
+            # Continue the newest segment after a restart unless it is already full
+            path = existing[-1]
+            if os.path.getsize(path) < self.segment_size:
+                self._file = open(path, 'ab')
+                self._segment = self._first_index(path)
+                return
+        self.close()
+        self._file = open(self.segment_path(first_index), 'ab')
+        self._segment = first_index
+        self._sync_directory()
+
+    def _sync_directory(self):
+        if self.durability == DURABILITY_NONE or not hasattr(os, 'O_DIRECTORY'):
+            return
+        fd = os.open(self.directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def migrate_from_json(self, path):
+        """
+        One-time import of a legacy whole-file chain.json into the log
+        :param path: <str> Path of the legacy chain file
+        :return: <list> Imported blocks, or an empty list if the file could not be read
+        """
+        try:
+            with open(path, 'r') as f:
+                blocks = json.load(f)
+        except (ValueError, json.JSONDecodeError):
+            print(f"Could not read {path}; leaving it in place and starting a new chain")
+            return []
+        for block in blocks:
+            self.append(block)
+        self.sync()
+        os.replace(path, path + '.migrated')
+        print(f"Migrated {len(blocks)} blocks from {path} to {self.directory}")
+        return blocks
+
+
+class LazyChain:
+    """
+    The chain as a list-like sequence over a BlockLog.
+
+    Blocks are read from disk through the offset index when they are first
+    needed and the most recently used ones stay decoded in memory, so opening
+    a chain costs the same however long it is. Appended blocks are held until
+    flush() writes them to the log.
+    """
+
+    def __init__(self, log, decode=None, cache_size=BLOCK_CACHE_SIZE):
+        self.log = log
+        self.decode = decode
+        self.cache_size = cache_size
+        self._cache = OrderedDict()  # position -> decoded block
+        self._unsaved = []
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self.log) + len(self._unsaved)
+
+    def _block(self, position):
+        with self._lock:
+            saved = len(self.log)
+            if position >= saved:
+                return self._unsaved[position - saved]
+            block = self._cache.get(position)
+            if block is not None:
+                self._cache.move_to_end(position)
+                return block
+        block = self.log.read(position + 1)
+        if self.decode:
+            block = self.decode(block)
+        self._remember(position, block)
+        return block
+
+    def _remember(self, position, block):
+        with self._lock:
+            self._cache[position] = block
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def __getitem__(self, key):
+        length = len(self)
+        if isinstance(key, slice):
+            start, stop, step = key.indices(length)
+            if step != 1:
+                return [self._block(position) for position in range(start, stop, step)]
+            return list(self.iter_range(start, stop))
+        if key < 0:
+            key += length
+        if not 0 <= key < length:
+            raise IndexError('chain index out of range')
+        return self._block(key)
+
+    def iter_range(self, start, stop):
+        """
+        Yields the blocks at positions [start, stop), reading the log sequentially
+        """
+        saved = len(self.log)
+        if start < min(stop, saved):
+            for block in self.log.read_range(start + 1, min(stop, saved)):
+                yield self.decode(block) if self.decode else block
+        with self._lock:
+            unsaved = self._unsaved[max(start - saved, 0):max(stop - saved, 0)]
+        yield from unsaved
+
+    def __iter__(self):
+        return self.iter_range(0, len(self))
+
+    def forget(self):
+        """
+        Drops the decoded blocks, e.g. after another process rewrote the log
+        """
+        with self._lock:
+            self._cache.clear()
+
+    def append(self, block):
+        with self._lock:
+            self._unsaved.append(block)
+
+    def extend(self, blocks):
+        with self._lock:
+            self._unsaved.extend(blocks)
+
+    def __delitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1) or key.stop is not None:
+            raise TypeError('Only the tail of the chain can be removed, e.g. del chain[height:]')
+        with self._lock:
+            start = key.indices(len(self))[0]
+            saved = len(self.log)
+            if start >= saved:
+                del self._unsaved[start - saved:]
+                return
+            self._unsaved.clear()
+            self.log.truncate(start)
+            for position in [p for p in self._cache if p >= start]:
+                del self._cache[position]
+
+    def flush(self):
+        """
+        Writes the appended blocks to the log
+        :return: <int> Bytes written
+        """
+        written = 0
+        with self._lock:
+            while self._unsaved:
+                position = len(self.log)
+                written += self.log.append(self._unsaved[0])
+                self._remember(position, self._unsaved.pop(0))
+        return written
@@ -0,0 +1,177 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+
+import requests
+
+from consensus import chain_work
+from validator import check_segment
+
+SYNC_BATCH_BLOCKS = 500  # blocks per download request
+SYNC_WORKERS = 4         # concurrent downloads per peer
+
+SyncResult = namedtuple('SyncResult', ['node', 'replaced', 'ancestor', 'height', 'blocks', 'bytes', 'elapsed', 'error'])
+
+
+class HttpTransport:
+    """
+    Fetches pages of a peer's /chain over HTTP
+    """
+
+    def __init__(self, node, timeout=10):
+        self.node = node
+        self.base_url = node if '://' in node else f'http://{node}'
+        self.timeout = timeout
+        self.session = requests.Session()
+
+    def get_chain(self, **params):
+        """
+        :return: <tuple> (<dict> decoded /chain response, <int> response size in bytes)
+        """
+        response = self.session.get(f'{self.base_url}/chain', params=params, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json(), len(response.content)
+
+
+class FlaskClientTransport:
+    """
+    Fetches pages of /chain from a Flask test client, standing in for a remote node
+    """
+
+    def __init__(self, client, node='test-client'):
+        self.client = client
+        self.node = node
+
+    def get_chain(self, **params):
+        response = self.client.get('/chain', query_string=params)
+        if response.status_code != 200:
+            raise requests.HTTPError(f'{self.node} answered {response.status_code}')
+        return response.get_json(), len(response.data)
+
+
+class NodeSync:
+    """
+    Headers-first synchronization with a peer.
+
+    Finds the last block both chains share by comparing block hashes,
+    downloads only the peer's blocks after it in parallel batches, validates
+    them batch by batch in chain order, and switches over only if the peer's
+    blocks after the common ancestor hold more work than ours and every new
+    block is valid. Counting work rather than blocks means a longer chain of
+    cheaper blocks does not win.
+    """
+
+    def __init__(self, blockchain, batch_blocks=SYNC_BATCH_BLOCKS, workers=SYNC_WORKERS):
+        self.blockchain = blockchain
+        self.batch_blocks = batch_blocks
+        self.workers = workers
+
+    def peer_header(self, transport, index):
+        data, size = transport.get_chain(start=index, end=index, limit=1, headers_only=1)
+        self._bytes += size
+        return data['chain'][0] if data['chain'] else None, data['length']
+
+    def find_common_ancestor(self, transport, peer_height):
+        """
+        :return: <int> Height of the last block both chains share, 0 if even the genesis blocks differ
+        """
+        chain = self.blockchain.chain
+
+        def shared(index):
+            header, _ = self.peer_header(transport, index)
+            return header is not None and header['hash'] == self.blockchain.block_hash(index)
+
+        high = min(len(chain), peer_height)
+        if high and shared(high):
+            # The usual case: the peer simply has blocks we have not seen yet
+            return high
+        # Matching hashes form a prefix, so binary search for where they stop
+        low = 0
+        high -= 1
+        while low < high:
+            middle = (low + high + 1) // 2
+            if shared(middle):
+                low = middle
+            else:
+                high = middle - 1
+        return low
+
+    def download(self, transport, start, end, headers_only=False):
+        params = {'headers_only': 1} if headers_only else {}
+        data, size = transport.get_chain(start=start, end=end, limit=end - start + 1, **params)
+        self._bytes += size
+        return data['chain']
+
+    def our_work(self, ancestor):
+        """
+        :return: <int> Work of our blocks after the common ancestor
+        """
+        return chain_work(self.blockchain.chain[ancestor:])
+
+    def sync_with(self, transport):
+        """
+        Brings our chain up to date with one peer
+        :param transport: HttpTransport or FlaskClientTransport for the peer
+        :return: <SyncResult>
+        """
+        started = perf_counter()
+        self._bytes = 0
+        _, peer_height = self.peer_header(transport, 1)
+
+        def result(replaced, ancestor=None, blocks=0, error=None):
+            return SyncResult(transport.node, replaced, ancestor, len(self.blockchain.chain), blocks,
+                              self._bytes, perf_counter() - started, error)
+
+        ancestor = self.find_common_ancestor(transport, peer_height)
+        if ancestor == peer_height:
+            # The peer has no blocks we lack
+            return result(False, ancestor)
+        ranges = [
+            (first, min(first + self.batch_blocks - 1, peer_height))
+            for first in range(ancestor + 1, peer_height + 1, self.batch_blocks)
+        ]
+        if ancestor < len(self.blockchain.chain):
+            # Competing forks: skip downloading blocks that could not win anyway. The headers'
+            # difficulties are only claims, so the work is counted again on the validated blocks.
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                batches = pool.map(lambda r: self.download(transport, *r, headers_only=True), ranges)
+                headers = [header for batch in batches for header in batch]
+            if chain_work(headers) <= self.our_work(ancestor):
+                return result(False, ancestor)
+
+        new_blocks = []
+        previous = self.blockchain.chain[ancestor - 1] if ancestor else None
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            # map() yields batches in chain order while later ones are still downloading
+            for batch in pool.map(lambda r: self.download(transport, *r), ranges):
+                segment = [previous] + batch if previous else batch
+                if previous is None:
+                    # The peer's genesis block starts the segment instead of one of ours
+                    if batch[0]['index'] != 1 or batch[0]['previous_hash'] != '1':
+                        return result(False, ancestor, error='Peer has an invalid genesis block')
+                failure = check_segment(segment, consensus=self.blockchain.consensus)
+                if failure:
+                    return result(False, ancestor, error=f'Block {failure[0]}: {failure[1]}')
+                new_blocks.extend(batch)
+                previous = batch[-1]
+
+        with self.blockchain.lock:
+            if chain_work(new_blocks) <= self.our_work(ancestor):
+                # Our fork holds as much work, or we mined past the peer while downloading
+                return result(False, ancestor)
+            self.blockchain.replace_tail(ancestor, new_blocks)
+        return result(True, ancestor, len(new_blocks))
+
+    def resolve_conflicts(self, transports):
+        """
+        Consensus Algorithm: syncs with every peer in turn, so we end up on the valid chain with the most work
+        :param transports: <list> One transport per peer
+        :return: <list> of <SyncResult>
+        """
+        results = []
+        for transport in transports:
+            try:
+                results.append(self.sync_with(transport))
+            except (requests.RequestException, KeyError, ValueError) as e:
+                results.append(SyncResult(transport.node, False, None, len(self.blockchain.chain), 0, 0, 0.0, str(e)))
+        return results
@@ -0,0 +1,570 @@
+import hashlib
+import os
+import struct
+import threading
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from time import time
+
+import numpy as np
+
+import metrics
+from encoding import TRANSACTION_VERSION
+from merkle import merkle_root
+from storage import DURABILITY_ALWAYS, DURABILITY_BATCH
+from txindex import parse_time
+
+try:
+    import fcntl
+except ImportError:  # not on Windows, where a single process is assumed
+    fcntl = None
+
+TELEMETRY_DIR = 'telemetry'
+TELEMETRY_FILE = 'readings.log'
+
+# Every frame is an 8 byte header (payload length, CRC32 of the payload), like
+# the block log. The payload starts with the frame's product_id length, number
+# of readings and first and last timestamp, then the product_id, then the
+# zlib-compressed columns: millisecond timestamps delta-encoded as int64,
+# temperatures and humidities as float32 (NaN where missing).
+FRAME_HEADER = struct.Struct('>II')
+FRAME_META = struct.Struct('>HIdd')
+LEAF_SIZE = 32  # SHA-256 of a frame payload, the Merkle leaf that anchors it
+
+MAX_BATCH_READINGS = 10000  # readings accepted in one request
+# Readings are timestamped from the epoch up to the end of year 9999, the range ISO 8601 dates cover
+MAX_TIMESTAMP = 253402214400.0
+# Types a reading's timestamp may have in the request: ISO 8601 text or seconds since the epoch
+TIMESTAMP_TYPES = (str, int, float)
+# Largest frame a batch can encode to: meta, product_id and the columns, with room for zlib's overhead
+MAX_FRAME_BYTES = FRAME_HEADER.size + FRAME_META.size + 0xFFFF + 2 * 20 * MAX_BATCH_READINGS
+TELEMETRY_PAGE_SIZE = 500   # readings returned by a query
+
+# Every ANCHOR_INTERVAL seconds, the frames appended since the last anchor go
+# into the ledger as one transaction holding their Merkle root
+ANCHOR_INTERVAL = 60.0
+ANCHOR_PRODUCT_ID = 'telemetry'
+ANCHOR_PRODUCT_NAME = 'Telemetry anchor'
+
+INGESTED_READINGS = metrics.counter('telemetry_readings_total', 'Sensor readings appended to the telemetry log.')
+INGESTED_BYTES = metrics.counter('telemetry_bytes_total', 'Compressed bytes appended to the telemetry log.')
+
+
+class TelemetryLogError(ValueError):
+    """
+    Raised when a frame in the middle of the telemetry log is damaged, so appending could lose the frames after it
+    """
+
+
+def _number(value):
+    if value is None or value == '':
+        return float('nan')
+    return float(value)
+
+
+def parse_readings(readings):
+    """
+    :param readings: <list> of {'timestamp', 'storage_temperature', 'humidity'} dicts; timestamps as
+                     ISO 8601 or seconds since the epoch, readings may be missing
+    :return: <tuple> (<list> of (seconds, temperature, humidity), <list> of errors)
+    """
+    if not isinstance(readings, list) or not readings:
+        return [], ['readings must be a non-empty list']
+    if len(readings) > MAX_BATCH_READINGS:
+        return [], [f'At most {MAX_BATCH_READINGS} readings per batch']
+    parsed = []
+    errors = []
+    for position, reading in enumerate(readings):
+        if not isinstance(reading, dict):
+            errors.append(f'reading {position}: not an object')
+            continue
+        timestamp = reading.get('timestamp')
+        # parse_time is memoized, so only hashable values may reach it
+        seconds = parse_time(timestamp) if type(timestamp) in TIMESTAMP_TYPES and timestamp != '' else None
+        if seconds is None or not 0 <= seconds < MAX_TIMESTAMP:
+            errors.append(f'reading {position}: missing or invalid timestamp')
+            continue
+        try:
+            parsed.append((seconds, _number(reading.get('storage_temperature')), _number(reading.get('humidity'))))
+        except (TypeError, ValueError, OverflowError):
+            errors.append(f'reading {position}: storage_temperature and humidity must be numbers')
+    return parsed, errors
+
+
+def encode_frame(product_id, readings):
+    """
+    :param product_id: <str> Batch the readings belong to
+    :param readings: <list> of (seconds, temperature, humidity)
+    :return: <bytes> The frame payload
+    """
+    readings = sorted(readings)
+    milliseconds = np.array([round(seconds * 1000) for seconds, _, _ in readings], dtype='<i8')
+    columns = [
+        np.diff(milliseconds, prepend=0).astype('<i8').tobytes(),
+        np.array([temperature for _, temperature, _ in readings], dtype='<f4').tobytes(),
+        np.array([humidity for _, _, humidity in readings], dtype='<f4').tobytes(),
+    ]
+    name = product_id.encode('utf-8')
+    meta = FRAME_META.pack(len(name), len(readings), readings[0][0], readings[-1][0])
+    return meta + name + zlib.compress(b''.join(columns))
+
+
+def decode_frame(payload):
+    """
+    :param payload: <bytes> A frame payload
+    :return: <tuple> (<str> product_id, <np.ndarray> seconds, <np.ndarray> temperatures, <np.ndarray> humidities)
+    """
+    name_length, count, _, _ = FRAME_META.unpack_from(payload)
+    start = FRAME_META.size
+    product_id = payload[start:start + name_length].decode('utf-8')
+    columns = zlib.decompress(payload[start + name_length:])
+    milliseconds = np.cumsum(np.frombuffer(columns, dtype='<i8', count=count))
+    temperatures = np.frombuffer(columns, dtype='<f4', count=count, offset=count * 8)
+    humidities = np.frombuffer(columns, dtype='<f4', count=count, offset=count * 12)
+    return product_id, milliseconds / 1000.0, temperatures, humidities
+
+
+class TelemetryLog:
+    """
+    Append-only file of compressed sensor reading frames, one frame per ingested batch.
+
+    Any worker process may append: a frame is written with one write() while
+    holding an exclusive lock on the file, so frames never interleave, and
+    each process indexes the frames others appended when it next looks. The
+    in-memory index keeps the offset, time span and Merkle leaf of each frame
+    and the frames of each product, so a time range query only decompresses
+    the frames it overlaps.
+    """
+
+    def __init__(self, directory, durability=DURABILITY_BATCH):
+        """
+        :param directory: <str> Directory of the telemetry log, e.g. chain_data/telemetry
+        :param durability: <str> DURABILITY_ALWAYS fsyncs every frame; otherwise frames are
+                           forced to disk by sync(), before they are anchored
+        """
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, TELEMETRY_FILE)
+        self.durability = durability
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self._lock = threading.Lock()
+        self.end = 0                   # offset just past the last frame read
+        self.offsets = array('Q')      # frame -> offset of its payload
+        self.lengths = array('I')      # frame -> payload length
+        self.first_seen = array('d')   # frame -> first reading's timestamp
+        self.last_seen = array('d')    # frame -> last reading's timestamp
+        self.counts = array('I')       # frame -> number of readings
+        self.leaves = bytearray()      # frame -> SHA-256 of its payload, LEAF_SIZE bytes each
+        self.products = {}             # product_id -> ascending frames holding its readings
+        self.altered = set()           # frames whose checksum no longer matches
+        self._verified = {}            # (first, last) -> Merkle root of those frames
+        self.refresh()
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def reading_count(self):
+        return sum(self.counts)
+
+    def refresh(self):
+        """
+        Indexes the frames appended since the last call, by this or another process
+        :return: <int> Number of frames
+        """
+        with self._lock:
+            self._scan()
+            return len(self.offsets)
+
+    def _scan(self):
+        size = os.fstat(self._fd).st_size
+        while self.end + FRAME_HEADER.size <= size:
+            length, checksum = FRAME_HEADER.unpack(os.pread(self._fd, FRAME_HEADER.size, self.end))
+            start = self.end + FRAME_HEADER.size
+            if start + length > size:
+                # Still being written by another process, or cut short by a crash
+                return
+            payload = os.pread(self._fd, length, start)
+            if zlib.crc32(payload) != checksum:
+                if start + length == size:
+                    # A last frame written only in part before a crash
+                    return
+                # Changed after it was written; kept, so the anchor covering it no longer matches
+                self.altered.add(len(self.offsets))
+            self._index(start, payload)
+            self.end = start + length
+
+    def _torn_tail(self, size):
+        """
+        Tells a last frame a crash cut short from a damaged frame header in the middle of the log,
+        whose length runs past the end of the file just the same
+        :param size: <int> Size of the file
+        :return: <bool> True if no intact frame follows the last one read
+        """
+        if size - self.end > MAX_FRAME_BYTES:
+            # More than one append's worth of bytes, so more than one frame
+            return False
+        tail = memoryview(os.pread(self._fd, size - self.end, self.end))
+        for offset in range(1, len(tail) - FRAME_HEADER.size + 1):
+            length, checksum = FRAME_HEADER.unpack_from(tail, offset)
+            start = offset + FRAME_HEADER.size
+            if FRAME_META.size <= length <= len(tail) - start and zlib.crc32(tail[start:start + length]) == checksum:
+                return False
+        return True
+
+    def _index(self, offset, payload):
+        try:
+            name_length, count, first, last = FRAME_META.unpack_from(payload)
+            product_id = payload[FRAME_META.size:FRAME_META.size + name_length].decode('utf-8')
+        except (struct.error, UnicodeDecodeError):
+            # Too damaged to tell whose readings these are
+            self.altered.add(len(self.offsets))
+            name_length, count, first, last, product_id = 0, 0, float('nan'), float('nan'), None
+        frame = len(self.offsets)
+        self.offsets.append(offset)
+        self.lengths.append(len(payload))
+        self.first_seen.append(first)
+        self.last_seen.append(last)
+        self.counts.append(count)
+        self.leaves += hashlib.sha256(payload).digest()
+        if product_id is None:
+            return
+        frames = self.products.get(product_id)
+        if frames is None:
+            frames = self.products[product_id] = array('i')
+        frames.append(frame)
+
+    def append(self, product_id, readings):
+        """
+        Appends one batch of readings as a frame
+        :param product_id: <str> Batch the readings belong to
+        :param readings: <list> of (seconds, temperature, humidity), as from parse_readings()
+        :return: <int> The frame number
+        :raises TelemetryLogError: if a frame before the end of the log is damaged
+        """
+        payload = encode_frame(product_id, readings)
+        record = FRAME_HEADER.pack(len(payload), zlib.crc32(payload)) + payload
+        with self._lock:
+            if fcntl is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                self._scan()
+                size = os.fstat(self._fd).st_size
+                if size > self.end:
+                    if not self._torn_tail(size):
+                        raise TelemetryLogError(f"Corrupt frame in {self.path} at offset {self.end}; "
+                                                f"refusing to append after it")
+                    # Nobody else is writing while we hold the lock, so this is a frame a crash cut short
+                    os.ftruncate(self._fd, self.end)
+                os.write(self._fd, record)
+                if self.durability == DURABILITY_ALWAYS:
+                    os.fsync(self._fd)
+                self._index(self.end + FRAME_HEADER.size, payload)
+                self.end += len(record)
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+        INGESTED_READINGS.inc(len(readings))
+        INGESTED_BYTES.inc(len(record))
+        return len(self.offsets) - 1
+
+    def sync(self):
+        os.fsync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
+
+    def leaf(self, frame):
+        return bytes(self.leaves[frame * LEAF_SIZE:(frame + 1) * LEAF_SIZE])
+
+    def read_frame(self, frame):
+        """
+        :return: <tuple> (<bool> True if the frame still hashes to the leaf it was indexed with,
+                 then the fields of decode_frame())
+        """
+        payload = os.pread(self._fd, self.lengths[frame], self.offsets[frame])
+        return (hashlib.sha256(payload).digest() == self.leaf(frame),) + decode_frame(payload)
+
+    def frames(self, product_id, since=None, until=None):
+        """
+        :return: <list> Frames of the product with readings between since and until, in seconds
+        """
+        return [
+            frame for frame in self.products.get(product_id, ())
+            if (since is None or self.last_seen[frame] >= since) and (until is None or self.first_seen[frame] <= until)
+        ]
+
+    def query(self, product_id, since=None, until=None, limit=TELEMETRY_PAGE_SIZE):
+        """
+        Reads a product's readings between since and until, oldest first
+        :param product_id: <str> Batch to read
+        :param since: (Optional) <float> Seconds since the epoch, inclusive
+        :param until: (Optional) <float> Seconds since the epoch, inclusive
+        :param limit: <int> Maximum number of readings returned; count and the extremes cover them all
+        :return: <dict> readings, count, min/max temperature and humidity, the frames read and
+                 any of them whose bytes changed since they were indexed
+        """
+        frames = self.frames(product_id, since, until)
+        altered = []
+        parts = []
+        for frame in frames:
+            try:
+                intact, _, seconds, temperatures, humidities = self.read_frame(frame)
+            except (zlib.error, ValueError, struct.error):
+                # Changed so much it no longer decodes
+                altered.append(frame)
+                continue
+            if not intact or frame in self.altered:
+                altered.append(frame)
+            parts.append((seconds, temperatures, humidities, frame))
+        if parts:
+            seconds = np.concatenate([part[0] for part in parts])
+            temperatures = np.concatenate([part[1] for part in parts])
+            humidities = np.concatenate([part[2] for part in parts])
+            sources = np.concatenate([np.full(len(part[0]), part[3], dtype='i4') for part in parts])
+        else:
+            seconds = temperatures = humidities = sources = np.empty(0)
+        wanted = np.ones(len(seconds), dtype=bool)
+        if since is not None:
+            wanted &= seconds >= since
+        if until is not None:
+            wanted &= seconds <= until
+        order = np.flatnonzero(wanted)
+        order = order[np.argsort(seconds[order], kind='stable')]
+
+        def extreme(function, values):
+            values = values[order]
+            values = values[~np.isnan(values)]
+            return round(float(function(values)), 2) if len(values) else None
+
+        return {
+            'product_id': product_id,
+            'count': len(order),
+            'min_temperature': extreme(np.min, temperatures),
+            'max_temperature': extreme(np.max, temperatures),
+            'min_humidity': extreme(np.min, humidities),
+            'max_humidity': extreme(np.max, humidities),
+            'readings': [
+                {
+                    'timestamp': datetime.fromtimestamp(seconds[i]).isoformat(timespec='milliseconds'),
+                    'storage_temperature': None if np.isnan(temperatures[i]) else round(float(temperatures[i]), 2),
+                    'humidity': None if np.isnan(humidities[i]) else round(float(humidities[i]), 2),
+                    'frame': int(sources[i]),
+                }
+                for i in order[:limit]
+            ],
+            'frames': frames,
+            'altered_frames': altered,
+        }
+
+    def root(self, first, last):
+        """
+        :return: <str> Hex Merkle root of frames first..last, inclusive
+        """
+        return merkle_root([self.leaf(frame).hex() for frame in range(first, last + 1)])
+
+    def verify(self, anchor):
+        """
+        Checks that the frames an anchor transaction covers are unchanged
+        :param anchor: <dict> Anchor transaction, as from anchor_fields()
+        :return: <bool> True if the frames hash to the anchored Merkle root
+        """
+        first, last = anchor['first_frame'], anchor['last_frame']
+        if not 0 <= first <= last < len(self):
+            return False
+        # Frames never change once written, so each range is hashed once
+        root = self._verified.get((first, last))
+        if root is None:
+            root = self._verified[(first, last)] = self.root(first, last)
+        return root == anchor['telemetry_root'] and sum(self.counts[first:last + 1]) == anchor['quantity']
+
+
+def anchor_fields(log, first, last):
+    """
+    The transaction anchoring frames first..last into the ledger
+    :return: <dict> Fields for Mempool.submit
+    """
+    return {
+        'sender': '0',
+        'recipient': '0',
+        'product_id': ANCHOR_PRODUCT_ID,
+        'product_name': ANCHOR_PRODUCT_NAME,
+        'quantity': sum(log.counts[first:last + 1]),
+        'timestamp': datetime.fromtimestamp(time()).isoformat(timespec='seconds'),
+        'telemetry_root': log.root(first, last),
+        'first_frame': first,
+        'last_frame': last,
+        'window_start': datetime.fromtimestamp(min(log.first_seen[first:last + 1])).isoformat(timespec='seconds'),
+        'window_end': datetime.fromtimestamp(max(log.last_seen[first:last + 1])).isoformat(timespec='seconds'),
+        'version': TRANSACTION_VERSION,
+    }
+
+
+def is_anchor(tx):
+    """
+    Anyone can send a transaction for the anchor product id; anchors are the ones shaped like one
+    :param tx: <dict> Transaction
+    :return: <bool>
+    """
+    return tx.get('product_id') == ANCHOR_PRODUCT_ID and tx.get('sender') == '0' \
+        and type(tx.get('first_frame')) is int and type(tx.get('last_frame')) is int \
+        and tx['first_frame'] <= tx['last_frame'] and isinstance(tx.get('telemetry_root'), str)
+
+
+class AnchorIndex:
+    """
+    The telemetry anchors on the chain, ordered by first frame.
+
+    Blockchain adds anchors as it indexes blocks and keeps them in its world
+    state snapshots, so the telemetry views and the anchorer look them up
+    here instead of reading the chain. Besides each anchor's first frame, the
+    index keeps the highest last frame of it and every anchor before it, so
+    the anchors covering a range of frames are found with one bisect and a
+    short walk back, even when windows overlap.
+    """
+
+    def __init__(self, anchors=()):
+        """
+        :param anchors: <list> Anchor transactions with their block_index, in chain order
+        """
+        anchors = list(anchors)
+        # (first frames ascending, reach, anchors); replaced whole when an anchor goes in the middle
+        self._lists = self._build(sorted(anchors, key=lambda anchor: anchor['first_frame']))
+        self.newest = anchors[-1] if anchors else None  # the anchor in the newest block
+
+    @staticmethod
+    def _build(anchors):
+        starts, reach, highest = [], [], -1
+        for anchor in anchors:
+            highest = max(highest, anchor['last_frame'])
+            starts.append(anchor['first_frame'])
+            reach.append(highest)
+        return starts, reach, list(anchors)
+
+    def __len__(self):
+        return len(self._lists[2])
+
+    def add(self, anchor):
+        """
+        :param anchor: <dict> Anchor transaction with its block_index, newer than every anchor added so far
+        """
+        starts, reach, anchors = self._lists
+        if not starts or anchor['first_frame'] >= starts[-1]:
+            # The usual case: a window after the last one. Readers bisect starts, so it grows last
+            reach.append(max(reach[-1] if reach else -1, anchor['last_frame']))
+            anchors.append(anchor)
+            starts.append(anchor['first_frame'])
+        else:
+            position = bisect_right(starts, anchor['first_frame'])
+            self._lists = self._build(anchors[:position] + [anchor] + anchors[position:])
+        self.newest = anchor
+
+    def covering(self, first, last):
+        """
+        :param first: <int> First frame of the range
+        :param last: <int> Last frame of the range
+        :return: <list> Every anchor covering a frame in first..last, ordered by first frame
+        """
+        starts, reach, anchors = self._lists
+        position = bisect_right(starts, last)
+        found = []
+        while position > 0 and reach[position - 1] >= first:
+            position -= 1
+            if anchors[position]['last_frame'] >= first:
+                found.append(anchors[position])
+        return found[::-1]
+
+    def state(self):
+        """
+        :return: <list> The anchors in chain order, for a world state snapshot
+        """
+        return sorted(self._lists[2], key=lambda anchor: anchor['block_index'])
+
+
+def anchor_windows(log, index, frames):
+    """
+    Lists the anchors covering any of the frames and checks each against the log
+    :param index: <AnchorIndex> The anchors on the chain
+    :param frames: <list> Frame numbers, e.g. from TelemetryLog.query
+    :return: <tuple> (<list> one entry per anchor: block_index, window, frames, root and verified,
+             <int> frames not covered by any anchor yet)
+    """
+    frames = sorted(set(frames))
+    if not frames:
+        return [], 0
+    windows = []
+    covered = set()
+    for anchor in index.covering(frames[0], frames[-1]):
+        inside = frames[bisect_left(frames, anchor['first_frame']):bisect_right(frames, anchor['last_frame'])]
+        if not inside:
+            continue
+        covered.update(inside)
+        windows.append({
+            'block_index': anchor['block_index'],
+            'window_start': anchor['window_start'],
+            'window_end': anchor['window_end'],
+            'first_frame': anchor['first_frame'],
+            'last_frame': anchor['last_frame'],
+            'telemetry_root': anchor['telemetry_root'],
+            'verified': log.verify(anchor),
+        })
+    return windows, len(frames) - len(covered)
+
+
+class TelemetryAnchorer(threading.Thread):
+    """
+    Daemon thread that anchors the frames appended since the last anchor into
+    the ledger, through the mempool, every `interval` seconds. Only the
+    process that writes blocks does so; the next window starts after the last
+    frame of the newest anchor on the chain, so a window whose anchor is lost
+    to a crash or reorg is covered by the next one. Frames are never anchored
+    twice: if frames were altered after their anchor, a new anchor over them
+    would make the altered readings look verified.
+    """
+
+    def __init__(self, blockchain, mempool, log, interval=ANCHOR_INTERVAL):
+        super().__init__(name='telemetry-anchorer', daemon=True)
+        self.blockchain = blockchain
+        self.mempool = mempool
+        self.log = log
+        self.interval = interval
+        self._stop_event = threading.Event()
+
+    def ensure_started(self):
+        if not self.is_alive() and not self._stop_event.is_set():
+            try:
+                self.start()
+            except RuntimeError:
+                # Another request started it first
+                pass
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            if not self.blockchain.writer or not self.blockchain.consensus.can_seal():
+                continue
+            try:
+                self.anchor_once()
+            except OSError as e:
+                print(f"Could not anchor telemetry: {e}")
+
+    def anchor_once(self):
+        """
+        Submits an anchor for the frames not covered by the newest anchor on the chain
+        :return: <str> Transaction id, or None if there was nothing to anchor or
+                 the previous anchor is still pending
+        """
+        self.log.refresh()
+        newest = self.blockchain.telemetry_anchors.newest
+        # Whether or not it still verifies; one that does not is reported on the telemetry views
+        first = newest['last_frame'] + 1 if newest else 0
+        last = len(self.log) - 1
+        if last < first:
+            return None
+        # Anchored frames must survive a crash, or the anchor could not be checked
+        self.log.sync()
+        tx_id, _ = self.mempool.submit(**anchor_fields(self.log, first, last))
+        return tx_id
@@ -0,0 +1,137 @@
+import shutil
+
+import pytest
+
+from blockchain import Blockchain
+from consensus import ProofOfWork
+from sync import FlaskClientTransport, NodeSync
+
+
+@pytest.fixture(scope='module')
+def app_module(tmp_path_factory):
+    # app.py sets up its own ledger and user store on import; keep them out of the working directory
+    work = tmp_path_factory.mktemp('app')
+    patch = pytest.MonkeyPatch()
+    patch.setenv('CHAIN_DATA_DIR', str(work / 'chain_data'))
+    patch.setenv('USERS_DB', str(work / 'users.db'))
+    patch.setenv('KEY_POOL_SIZE', '1')
+    import app
+    yield app
+    patch.undo()
+
+
+@pytest.fixture
+def serve(app_module, monkeypatch):
+    """
+    Serves a Blockchain's /chain through the app's Flask test client
+    """
+    def transport(blockchain, node='peer'):
+        monkeypatch.setattr(app_module, 'blockchain', blockchain)
+        return FlaskClientTransport(app_module.app.test_client(), node=node)
+    return transport
+
+
+def open_chain(directory, difficulty=1, min_difficulty=None):
+    return Blockchain(data_dir=str(directory), mining_workers=1,
+                      consensus=ProofOfWork(difficulty=difficulty, min_difficulty=min_difficulty))
+
+
+def mine(blockchain, blocks, product_prefix='p'):
+    for n in range(blocks):
+        blockchain.new_transaction('0', 'owner', f'{product_prefix}{n}', 'Milk', 1)
+        blockchain.mine_pending()
+
+
+def fork(blockchain, directory, **kwargs):
+    """
+    Opens a copy of a ledger, so both share every block mined so far
+    """
+    shutil.copytree(blockchain.data_dir, directory)
+    return open_chain(directory, **kwargs)
+
+
+def test_sync_downloads_only_blocks_after_common_ancestor(tmp_path, serve):
+    ours = open_chain(tmp_path / 'ours')
+    mine(ours, 2)
+    peer = fork(ours, tmp_path / 'peer')
+    mine(peer, 3, product_prefix='peer')
+
+    result = NodeSync(ours, batch_blocks=2).sync_with(serve(peer))
+
+    assert result.error is None
+    assert result.replaced
+    assert result.ancestor == 3
+    assert result.blocks == 3
+    assert len(ours.chain) == 6
+    assert ours.block_hash(6) == peer.block_hash(6)
+    assert ours.latest_transaction('peer2')['recipient'] == 'owner'
+
+
+def test_sync_reorganizes_onto_longer_fork(tmp_path, serve):
+    ours = open_chain(tmp_path / 'ours')
+    mine(ours, 2)
+    peer = fork(ours, tmp_path / 'peer')
+    mine(ours, 1, product_prefix='ours')
+    mine(peer, 3, product_prefix='peer')
+    assert ours.block_hash(4) != peer.block_hash(4)
+
+    result = NodeSync(ours).sync_with(serve(peer))
+
+    assert result.replaced
+    assert result.ancestor == 3
+    assert [ours.block_hash(i) for i in range(1, 7)] == [peer.block_hash(i) for i in range(1, 7)]
+    # The block only we had is gone, along with everything indexed from it
+    assert ours.latest_transaction('ours0') is None
+    assert ours.latest_transaction('peer0') is not None
+
+
+def test_sync_keeps_our_chain_when_peer_sends_invalid_block(tmp_path, serve):
+    ours = open_chain(tmp_path / 'ours', difficulty=2, min_difficulty=2)
+    mine(ours, 2)
+    # The peer mines at a difficulty we do not accept
+    peer = fork(ours, tmp_path / 'peer', difficulty=1, min_difficulty=1)
+    mine(peer, 3, product_prefix='peer')
+    tip = ours.block_hash(3)
+
+    result = NodeSync(ours).sync_with(serve(peer))
+
+    assert not result.replaced
+    assert result.ancestor == 3
+    assert result.error.startswith('Block 4:')
+    assert len(ours.chain) == 3
+    assert ours.block_hash(3) == tip
+    assert ours.latest_transaction('peer0') is None
+
+
+def test_default_engine_rejects_blocks_below_its_difficulty(tmp_path, serve):
+    # No explicit minimum: the configured difficulty is the floor
+    ours = Blockchain(data_dir=str(tmp_path / 'ours'), mining_workers=1, consensus=ProofOfWork(difficulty=2))
+    mine(ours, 2)
+    peer = fork(ours, tmp_path / 'peer', difficulty=1, min_difficulty=1)
+    mine(peer, 3, product_prefix='peer')
+
+    result = NodeSync(ours).sync_with(serve(peer))
+
+    assert not result.replaced
+    assert result.error == 'Block 4: Proof of work difficulty is below the minimum'
+    assert len(ours.chain) == 3
+
+
+def test_sync_keeps_fork_with_more_work_over_longer_one(tmp_path, serve):
+    ours = open_chain(tmp_path / 'ours', difficulty=2, min_difficulty=1)
+    mine(ours, 2)
+    peer = fork(ours, tmp_path / 'peer', difficulty=1, min_difficulty=1)
+    mine(ours, 1, product_prefix='ours')
+    # Three blocks at difficulty 1 are 48 hashes' worth of work, one at difficulty 2 is 256
+    mine(peer, 3, product_prefix='peer')
+    tip = ours.block_hash(4)
+
+    result = NodeSync(ours).sync_with(serve(peer))
+
+    assert result.error is None
+    assert not result.replaced
+    assert result.ancestor == 3
+    assert result.blocks == 0
+    assert len(ours.chain) == 4
+    assert ours.block_hash(4) == tip
+    assert ours.latest_transaction('peer0') is None
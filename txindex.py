@@ -0,0 +1,251 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+from functools import lru_cache
+
+# Fields looked up by exact value, e.g. every transaction at a location
+EQUALITY_FIELDS = ('sender', 'recipient', 'location', 'product_id')
+# Numeric fields looked up by range, e.g. every reading above 8°C
+RANGE_FIELDS = ('timestamp', 'storage_temperature', 'humidity', 'quantity')
+
+QUERY_PAGE_SIZE = 50
+
+NAN = float('nan')
+
+
+def numeric_value(field, value):
+    """
+    :return: <float> The field as a number (timestamps as seconds since the epoch), or NaN
+    """
+    if value is None or value == '':
+        return NAN
+    if field == 'timestamp':
+        value = parse_time(value)
+        return NAN if value is None else value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return NAN
+
+
+@lru_cache(maxsize=4096)  # transfers copy the timestamp of the transaction before them
+def parse_time(value):
+    """
+    :param value: <str> ISO 8601 date or time, e.g. 2024-05-01 or 2024-05-01T10:00, or seconds since the epoch
+    :return: <float> Seconds since the epoch, or None if it cannot be parsed
+    """
+    if isinstance(value, (int, float)):
+        try:
+            return float(value)
+        except OverflowError:  # an integer too large for a float
+            return None
+    try:
+        return datetime.fromisoformat(str(value)).timestamp()
+    except ValueError:
+        pass
+    try:
+        return float(value)
+    except ValueError:
+        return None
+
+
+class SortedRuns:
+    """
+    (value, row) pairs kept as a few runs sorted by value, for range lookups with bisect.
+
+    Inserting into one big sorted array moves half of it per row, so new rows
+    form a run of their own and runs of similar size are merged, the way a
+    binary counter carries. There are at most log2(n) runs and each row is
+    merged O(log n) times.
+    """
+
+    def __init__(self):
+        self.runs = []  # (array('d') values, array('i') rows), largest first
+
+    def __len__(self):
+        return sum(len(values) for values, _ in self.runs)
+
+    def add(self, values, first_row):
+        """
+        :param values: <array> Values of consecutive rows; NaNs are left out
+        :param first_row: <int> Row of the first value
+        """
+        order = sorted((position for position, value in enumerate(values) if value == value), key=values.__getitem__)
+        if not order:
+            return
+        self.runs.append((array('d', [values[i] for i in order]), array('i', [first_row + i for i in order])))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            newer_values, newer_rows = self.runs.pop()
+            older_values, older_rows = self.runs.pop()
+            self.runs.append(_merge(older_values + newer_values, older_rows + newer_rows))
+
+    def _bounds(self, values, low, high):
+        start = 0 if low is None else bisect_left(values, low)
+        stop = len(values) if high is None else bisect_right(values, high)
+        return start, stop
+
+    def count(self, low=None, high=None):
+        """
+        :return: <int> Number of rows with low <= value <= high
+        """
+        total = 0
+        for values, _ in self.runs:
+            start, stop = self._bounds(values, low, high)
+            total += max(stop - start, 0)
+        return total
+
+    def rows(self, low=None, high=None):
+        """
+        :return: <list> Rows with low <= value <= high, in ascending order
+        """
+        found = []
+        for values, rows in self.runs:
+            start, stop = self._bounds(values, low, high)
+            found.extend(rows[start:stop])
+        found.sort()
+        return found
+
+
+def _merge(values, rows):
+    # Both halves are sorted already, which Timsort finds and merges in linear time
+    order = sorted(range(len(values)), key=values.__getitem__)
+    return array('d', [values[i] for i in order]), array('i', [rows[i] for i in order])
+
+
+class TransactionIndex:
+    """
+    Secondary indexes over every transaction on the chain.
+
+    Each transaction gets a row number in chain order. Equality fields map
+    each value to the ascending list of rows holding it; range fields keep
+    one number per row plus SortedRuns for bisecting. Like the aggregates in
+    analytics, the index is extended only by blocks added since it last
+    caught up, and Blockchain feeds it new blocks while it is current.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.height = 0
+        self.blocks = array('i')      # row -> block index
+        self.positions = array('i')   # row -> position in the block
+        self.postings = {field: {} for field in EQUALITY_FIELDS}
+        self.values = {field: array('d') for field in RANGE_FIELDS}
+        self.ranges = {field: SortedRuns() for field in RANGE_FIELDS}
+        self._sorted_rows = 0  # rows already in the sorted runs
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def sync(self, chain):
+        """
+        Indexes the blocks added since the last call
+        :param chain: <list> The full chain
+        """
+        if len(chain) < self.height:
+            self.reset()
+        for position in range(self.height, len(chain)):
+            self.add_block(chain[position])
+
+    def follow(self, block):
+        """
+        Indexes a block just appended to the chain, if the index is up to date with the one before it.
+        Otherwise the block is picked up by the next sync.
+        """
+        if self.height == block['index'] - 1:
+            self.add_block(block)
+
+    def add_block(self, block):
+        first = len(self.blocks)
+        transactions = block['transactions']
+        for position, tx in enumerate(transactions):
+            row = first + position
+            self.blocks.append(block['index'])
+            self.positions.append(position)
+            for field in EQUALITY_FIELDS:
+                value = tx.get(field)
+                if value is not None and value != '':
+                    rows = self.postings[field].get(value)
+                    if rows is None:
+                        rows = self.postings[field][value] = array('i')
+                    rows.append(row)
+        for field in RANGE_FIELDS:
+            self.values[field].extend([numeric_value(field, tx.get(field)) for tx in transactions])
+        self.height = block['index']
+
+    def _sort_new_rows(self):
+        # Rows added since the last query become one sorted run, so a
+        # catch-up over many blocks is sorted once rather than block by block
+        if self._sorted_rows == len(self):
+            return
+        for field in RANGE_FIELDS:
+            self.ranges[field].add(self.values[field][self._sorted_rows:], self._sorted_rows)
+        self._sorted_rows = len(self)
+
+    def locate(self, row):
+        """
+        :return: <tuple> (<int> block index, <int> position in the block)
+        """
+        return self.blocks[row], self.positions[row]
+
+    def query(self, equals=None, ranges=None, cursor=0, limit=QUERY_PAGE_SIZE):
+        """
+        Finds the transactions matching every filter, in chain order.
+
+        The most selective filter is read from its index and the others are
+        checked row by row, so the cost follows the smallest matching set
+        rather than the length of the chain.
+        :param equals: <dict> Field -> value it must equal
+        :param ranges: <dict> Field -> (low, high), inclusive; either bound may be None
+        :param cursor: <int> First row to consider, the next_cursor of a previous page
+        :param limit: <int> Maximum number of rows to return
+        :return: <tuple> (<list> matching rows, <int> next_cursor or None)
+        """
+        equals = equals or {}
+        ranges = ranges or {}
+        for field in equals:
+            if field not in self.postings:
+                raise ValueError(f"{field} is not indexed by value; use one of {', '.join(EQUALITY_FIELDS)}")
+        for field in ranges:
+            if field not in self.ranges:
+                raise ValueError(f"{field} is not indexed by range; use one of {', '.join(RANGE_FIELDS)}")
+
+        self._sort_new_rows()
+        empty = array('i')
+        plans = [(len(self.postings[field].get(value, empty)), 'equals', field) for field, value in equals.items()]
+        plans += [(self.ranges[field].count(*bounds), 'range', field) for field, bounds in ranges.items()]
+        if plans:
+            _, kind, field = min(plans)
+            if kind == 'equals':
+                rows = self.postings[field].get(equals[field], empty)
+                candidates = rows[bisect_left(rows, cursor):]
+            else:
+                rows = self.ranges[field].rows(*ranges[field])
+                candidates = rows[bisect_left(rows, cursor):]
+        else:
+            field = None
+            candidates = range(max(cursor, 0), len(self))
+
+        checks = [(self.postings[name].get(value, empty), None) for name, value in equals.items() if name != field]
+        checks += [(self.values[name], bounds) for name, bounds in ranges.items() if name != field]
+
+        matches = []
+        for row in candidates:
+            if all(_matches(index, bounds, row) for index, bounds in checks):
+                matches.append(row)
+                if len(matches) > limit:
+                    break
+        next_cursor = matches[limit] if len(matches) > limit else None
+        return matches[:limit], next_cursor
+
+
+def _matches(index, bounds, row):
+    if bounds is None:
+        # Ascending rows holding the wanted value
+        position = bisect_left(index, row)
+        return position < len(index) and index[position] == row
+    low, high = bounds
+    value = index[row]
+    # NaN fails both comparisons
+    return (low is None or value >= low) and (high is None or value <= high)
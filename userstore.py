@@ -0,0 +1,151 @@
+import json
+import os
+import sqlite3
+import threading
+
+from wallet import key_fingerprint
+
+USERS_DB = 'users.db'
+LEGACY_USERS_FILE = 'users.json'
+
+# Keys looked up per query; SQLite allows as few as 999 bound variables per statement
+LOOKUP_CHUNK = 500
+
+USER_FIELDS = ('fullname', 'password_hash', 'role', 'phone', 'public_key', 'private_key')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    email TEXT PRIMARY KEY,
+    fullname TEXT NOT NULL,
+    password_hash TEXT NOT NULL,
+    role TEXT NOT NULL,
+    phone TEXT,
+    public_key TEXT NOT NULL,
+    private_key TEXT NOT NULL,
+    key_fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS users_key_fingerprint ON users (key_fingerprint);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UserStore:
+    """
+    User accounts in an embedded SQLite database.
+
+    Lookups go through the primary key on email or the index on the public
+    key fingerprint, and each registration is a single-row insert. WAL mode
+    lets several worker processes read while one writes.
+    """
+
+    def __init__(self, path=USERS_DB, legacy_file=LEGACY_USERS_FILE):
+        self.path = path
+        self._local = threading.local()
+        with self._connection() as db:
+            db.executescript(SCHEMA)
+        if legacy_file:
+            self.import_json(legacy_file)
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads, so keep one per thread
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._local.db = db
+        return db
+
+    def import_json(self, path):
+        """
+        One-time import of the legacy users.json file
+        :param path: <str> Path of the legacy users file
+        :return: <int> Number of users imported
+        """
+        if not os.path.exists(path):
+            return 0
+        db = self._connection()
+        with db:
+            if db.execute("SELECT 1 FROM meta WHERE key = 'imported_users_json'").fetchone():
+                return 0
+            with open(path, 'r') as f:
+                legacy_users = json.load(f)
+            for email, user in legacy_users.items():
+                self._insert(db, email, user, ignore_existing=True)
+            db.execute("INSERT INTO meta (key, value) VALUES ('imported_users_json', ?)", (str(len(legacy_users)),))
+        print(f"Imported {len(legacy_users)} users from {path} into {self.path}")
+        return len(legacy_users)
+
+    def _insert(self, db, email, user, ignore_existing=False):
+        verb = 'INSERT OR IGNORE' if ignore_existing else 'INSERT'
+        db.execute(
+            f"{verb} INTO users (email, fullname, password_hash, role, phone, public_key, private_key, key_fingerprint) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (email, *(user.get(field) for field in USER_FIELDS), key_fingerprint(user['public_key'])),
+        )
+
+    def add(self, email, user):
+        """
+        Registers a new user
+        :param email: <str> Email address, the user's unique id
+        :param user: <dict> fullname, password_hash, role, phone, public_key, private_key
+        :return: <bool> True if added, False if the email is already registered
+        """
+        db = self._connection()
+        try:
+            with db:
+                self._insert(db, email, user)
+        except sqlite3.IntegrityError:
+            return False
+        return True
+
+    def get(self, email):
+        """
+        :param email: <str> Email address
+        :return: <dict> The user, or None
+        """
+        row = self._connection().execute(
+            'SELECT * FROM users WHERE email = ?', (email,)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def __contains__(self, email):
+        return self._connection().execute(
+            'SELECT 1 FROM users WHERE email = ?', (email,)
+        ).fetchone() is not None
+
+    def __len__(self):
+        return self._connection().execute('SELECT COUNT(*) FROM users').fetchone()[0]
+
+    def get_by_public_key(self, public_key):
+        """
+        :param public_key: <str> PEM encoded public key
+        :return: <dict> The user owning the key, or None
+        """
+        row = self._connection().execute(
+            'SELECT * FROM users WHERE key_fingerprint = ?', (key_fingerprint(public_key),)
+        ).fetchone()
+        return dict(row) if row else None
+
+    def display_names(self, public_keys):
+        """
+        Maps public keys to the full names of their owners, e.g. for ownership columns
+        :param public_keys: <iterable> PEM encoded public keys, or other recipient strings
+        :return: <dict> public key -> fullname, for the keys that belong to a registered user
+        """
+        fingerprints = {key_fingerprint(key): key for key in set(public_keys) if key}
+        names = {}
+        pending = list(fingerprints)
+        for start in range(0, len(pending), LOOKUP_CHUNK):
+            chunk = pending[start:start + LOOKUP_CHUNK]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self._connection().execute(
+                f'SELECT key_fingerprint, fullname FROM users WHERE key_fingerprint IN ({placeholders})',
+                chunk,
+            ).fetchall()
+            names.update((fingerprints[row['key_fingerprint']], row['fullname']) for row in rows)
+        return names
@@ -0,0 +1,221 @@
+import argparse
+import json
+import os
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from time import perf_counter
+
+from consensus import ProofOfWork, from_env as consensus_from_env
+from encoding import transaction_hash
+from merkle import merkle_root
+
+CHECKPOINT_FILE = 'checkpoint.json'
+SEGMENT_BLOCKS = 500  # blocks handed to a worker at a time
+
+ValidationResult = namedtuple('ValidationResult', ['valid', 'height', 'error', 'checked', 'elapsed'])
+
+
+def signature_item(transaction):
+    """
+    Prepares a transaction for Wallet.verify_many
+    :param transaction: <dict> Transaction as stored in a block
+    :return: <tuple> (unsigned transaction, signature bytes, public key), or None if it cannot be valid
+    """
+    signature = transaction.get('signature')
+    if not signature:
+        return None
+    # The signature covers the transaction as it was before the signature was added
+    unsigned = {k: v for k, v in transaction.items() if k != 'signature'}
+    try:
+        return unsigned, bytes.fromhex(signature), transaction['sender']
+    except ValueError:
+        return None
+
+
+def check_signatures(blocks):
+    """
+    Verifies every signed transaction in the blocks as one batch
+    :return: <int> Index of the first block holding a bad signature, or None
+    """
+    from wallet import Wallet
+    owners = []
+    items = []
+    for block in blocks:
+        for transaction in block['transactions']:
+            if transaction.get('sender') == '0':
+                continue
+            item = signature_item(transaction)
+            if item is None:
+                return block['index']
+            owners.append(block['index'])
+            items.append(item)
+    # Segments already run in parallel, so verify this batch in-process
+    for index, ok in zip(owners, Wallet.verify_many(items, workers=1)):
+        if not ok:
+            return index
+    return None
+
+
+def check_segment(blocks, verify_signatures=True, consensus=None):
+    """
+    Checks the links, seals and signatures of blocks[1:], using blocks[0] as their predecessor
+    :param blocks: <list> Consecutive blocks, starting with the last already-trusted one
+    :param verify_signatures: <bool> Whether to check transaction signatures as well
+    :param consensus: (Optional) Engine whose seals the blocks must carry, by default ProofOfWork()
+    :return: <tuple> (index of the first bad block, reason), or None if all are valid
+    """
+    from blockchain import Blockchain
+    consensus = consensus or ProofOfWork()
+    failure = None
+    checked = []
+    previous = blocks[0]
+    for block in blocks[1:]:
+        if block['index'] != previous['index'] + 1:
+            failure = block['index'], 'Block index is out of sequence'
+        elif block['previous_hash'] != Blockchain.hash(previous):
+            failure = block['index'], 'Previous hash does not match'
+        elif block.get('version', 1) >= 2:
+            leaves = [transaction_hash(tx) for tx in block['transactions']]
+            # Odd Merkle levels repeat their last node, so [a, b, c] and [a, b, c, c] share a root
+            if len(set(leaves)) != len(leaves):
+                failure = block['index'], 'Block holds the same transaction twice'
+            elif block.get('merkle_root') != merkle_root(leaves):
+                failure = block['index'], 'Merkle root does not match the transactions'
+        if not failure:
+            reason = consensus.check_seal(previous, block)
+            if reason:
+                failure = block['index'], reason
+        if failure:
+            break
+        checked.append(block)
+        previous = block
+    if verify_signatures:
+        # Only blocks before a broken link can hold an earlier failure
+        bad_index = check_signatures(checked)
+        if bad_index is not None:
+            return bad_index, 'Invalid transaction signature'
+    return failure
+
+
+class ChainValidator:
+    """
+    Validates a chain by checking consecutive segments on a pool of worker processes.
+
+    Segments overlap by one block so every hash link is checked exactly once,
+    and the first failure in chain order is reported.
+    """
+
+    def __init__(self, workers=None, segment_blocks=SEGMENT_BLOCKS, verify_signatures=True, consensus=None):
+        self.workers = workers or os.cpu_count() or 1
+        self.segment_blocks = segment_blocks
+        self.verify_signatures = verify_signatures
+        self.consensus = consensus or ProofOfWork()
+
+    def validate(self, chain, start=1):
+        """
+        Validates chain[start - 1:], trusting the blocks before it
+        :param chain: <list> The full chain
+        :param start: <int> Index of the first block to check; 1 checks the whole chain
+        :return: <ValidationResult>
+        """
+        started = perf_counter()
+        if not chain:
+            return ValidationResult(True, 0, None, 0, 0.0)
+        if start <= 1:
+            genesis = chain[0]
+            if genesis['index'] != 1 or genesis['previous_hash'] != '1':
+                return ValidationResult(False, 0, 'Invalid genesis block', 1, perf_counter() - started)
+            start = 2
+
+        segments = [
+            chain[first - 2:min(first - 1 + self.segment_blocks, len(chain))]
+            for first in range(start, len(chain) + 1, self.segment_blocks)
+        ]
+        if self.workers <= 1 or len(segments) <= 1:
+            failures = (check_segment(segment, self.verify_signatures, self.consensus) for segment in segments)
+            failure = next((f for f in failures if f), None)
+        else:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                results = pool.map(check_segment, segments, [self.verify_signatures] * len(segments),
+                                   [self.consensus] * len(segments))
+                failure = next((f for f in results if f), None)
+
+        elapsed = perf_counter() - started
+        checked = max(len(chain) - start + 1, 0)
+        if failure:
+            bad_index, reason = failure
+            return ValidationResult(False, bad_index - 1, f'Block {bad_index}: {reason}', checked, elapsed)
+        return ValidationResult(True, len(chain), None, checked, elapsed)
+
+
+def load_checkpoint(directory):
+    """
+    :param directory: <str> Block log directory
+    :return: <dict> {'height': <int>, 'hash': <str>}, or None if there is no checkpoint
+    """
+    try:
+        with open(os.path.join(directory, CHECKPOINT_FILE), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(directory, height, block_hash):
+    path = os.path.join(directory, CHECKPOINT_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump({'height': height, 'hash': block_hash}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def checkpoint_start(chain, checkpoint):
+    """
+    :return: <int> Index of the first block the checkpoint does not cover
+    """
+    from blockchain import Blockchain
+    if not checkpoint:
+        return 1
+    height = checkpoint.get('height', 0)
+    if height < 1 or height > len(chain) or Blockchain.hash(chain[height - 1]) != checkpoint.get('hash'):
+        # The chain no longer contains the checkpointed block; verify everything
+        return 1
+    return height + 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Audit a blockchain file or block log directory.')
+    parser.add_argument('path', nargs='?', default='chain_data',
+                        help='chain.json file or block log directory (default: chain_data)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: all cores)')
+    parser.add_argument('--no-signatures', action='store_true', help='skip transaction signature checks')
+    parser.add_argument('--use-checkpoint', action='store_true', help='only verify blocks beyond the checkpoint')
+    args = parser.parse_args()
+
+    started = perf_counter()
+    if os.path.isdir(args.path):
+        from storage import BlockLog
+        chain = BlockLog(args.path, durability='none').recover()
+    else:
+        with open(args.path, 'r') as f:
+            chain = json.load(f)
+    load_time = perf_counter() - started
+
+    start = checkpoint_start(chain, load_checkpoint(args.path)) if args.use_checkpoint and os.path.isdir(args.path) else 1
+    # The same CONSENSUS and POW_/POA_ variables the node runs with
+    validator = ChainValidator(workers=args.workers, verify_signatures=not args.no_signatures,
+                               consensus=consensus_from_env())
+    result = validator.validate(chain, start=start)
+
+    rate = result.checked / result.elapsed if result.elapsed > 0 else float('inf')
+    print(f"Loaded {len(chain)} blocks in {load_time:.2f}s")
+    print(f"Checked {result.checked} blocks in {result.elapsed:.2f}s ({rate:.1f} blocks/s, {validator.workers} workers)")
+    if result.valid:
+        print(f"Chain is valid up to height {result.height}")
+    else:
+        print(f"Chain is INVALID: {result.error} (valid up to height {result.height})")
+    raise SystemExit(0 if result.valid else 1)
+
+
+if __name__ == '__main__':
+    main()
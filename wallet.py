@@ -1,36 +1,242 @@
 import hashlib
 import json
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
 from time import time
 from uuid import uuid4
 
-from Crypto.PublicKey import RSA
-from Crypto.Signature import pkcs1_15
+from Crypto.PublicKey import ECC, RSA
+from Crypto.Signature import eddsa, pkcs1_15
 from Crypto.Hash import SHA256
 
+from encoding import signing_bytes
+
+try:
+    from cryptography.exceptions import InvalidSignature
+    from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PublicKey
+except ImportError:  # optional, PyCryptodome verifies Ed25519 several times slower
+    Ed25519PublicKey = None
+
+# Signature schemes. RSA public keys are PEM strings; Ed25519 public keys are
+# tagged with their algorithm, e.g. 'ed25519:<64 hex digits>', which keeps them
+# an order of magnitude smaller than a PEM key in every transaction.
+ALGORITHM_RSA = 'rsa'
+ALGORITHM_ED25519 = 'ed25519'
+ALGORITHMS = (ALGORITHM_RSA, ALGORITHM_ED25519)
+# PyCryptodome's Ed25519 takes about 3.5x as long as RSA to verify, and every
+# node verifies every signature while signing happens once, so new accounts
+# only get Ed25519 keys when the faster `cryptography` backend is installed
+DEFAULT_ALGORITHM = ALGORITHM_ED25519 if Ed25519PublicKey is not None else ALGORITHM_RSA
+
+MAX_CACHED_KEYS = 1024
+# Below this many signatures verify_many() does not bother with a pool
+MIN_PARALLEL_BATCH = 64
+
+
+def key_algorithm(public_key):
+    """
+    :param public_key: <str> Public key as stored in transactions
+    :return: <str> The signature scheme the key belongs to
+    """
+    if public_key.startswith(ALGORITHM_ED25519 + ':'):
+        return ALGORITHM_ED25519
+    return ALGORITHM_RSA
+
+
+def key_fingerprint(public_key):
+    """
+    :param public_key: <str> PEM encoded public key
+    :return: <str> SHA-256 fingerprint of the key
+    """
+    return hashlib.sha256(public_key.encode('utf-8')).hexdigest()
+
+
+class FastEd25519Verifier:
+    """
+    Ed25519 verifier backed by `cryptography`, with the same verify(message, signature)
+    interface as PyCryptodome's
+    """
+
+    def __init__(self, raw_key):
+        self.key = Ed25519PublicKey.from_public_bytes(raw_key)
+
+    def verify(self, message, signature):
+        try:
+            self.key.verify(signature, message)
+        except InvalidSignature:
+            raise ValueError('The signature is not authentic')
+
+
+class KeyCache:
+    """
+    Bounded LRU cache of parsed public keys and their verifiers, keyed by fingerprint.
+    Entries are (algorithm, verifier) pairs.
+    """
+
+    def __init__(self, max_size=MAX_CACHED_KEYS):
+        self.max_size = max_size
+        self._verifiers = OrderedDict()
+        self._lock = threading.Lock()
+
+    def verifier(self, public_key):
+        fingerprint = key_fingerprint(public_key)
+        with self._lock:
+            verifier = self._verifiers.get(fingerprint)
+            if verifier is not None:
+                self._verifiers.move_to_end(fingerprint)
+                return verifier
+
+        if key_algorithm(public_key) == ALGORITHM_ED25519:
+            raw_key = bytes.fromhex(public_key[len(ALGORITHM_ED25519) + 1:])
+            if Ed25519PublicKey is not None:
+                verifier = (ALGORITHM_ED25519, FastEd25519Verifier(raw_key))
+            else:
+                verifier = (ALGORITHM_ED25519, eddsa.new(eddsa.import_public_key(raw_key), 'rfc8032'))
+        else:
+            verifier = (ALGORITHM_RSA, pkcs1_15.new(RSA.import_key(public_key)))
+        with self._lock:
+            self._verifiers[fingerprint] = verifier
+            while len(self._verifiers) > self.max_size:
+                self._verifiers.popitem(last=False)
+        return verifier
+
+    def clear(self):
+        with self._lock:
+            self._verifiers.clear()
+
+
+key_cache = KeyCache()
+
+
+def _verify_item(item):
+    transaction, signature, public_key = item
+    return Wallet.verify_signature(transaction, signature, public_key)
+
+
 class Wallet:
-    def __init__(self, private_key=None):
+    def __init__(self, private_key=None, algorithm=DEFAULT_ALGORITHM):
         if private_key:
-            self.key_pair = RSA.import_key(private_key)
+            # The algorithm of an existing key is whatever the PEM holds
+            try:
+                self.key_pair = RSA.import_key(private_key)
+                self.algorithm = ALGORITHM_RSA
+            except ValueError:
+                self.key_pair = ECC.import_key(private_key)
+                self.algorithm = ALGORITHM_ED25519
             self.private_key = private_key
-            self.public_key = self.key_pair.publickey().export_key().decode('utf-8')
         else:
-            self.key_pair = RSA.generate(2048)
+            if algorithm not in ALGORITHMS:
+                raise ValueError(f"Unknown signature algorithm: {algorithm}")
+            self.algorithm = algorithm
+            if algorithm == ALGORITHM_ED25519:
+                self.key_pair = ECC.generate(curve='ed25519')
+                self.private_key = self.key_pair.export_key(format='PEM')
+            else:
+                self.key_pair = RSA.generate(2048)
+                self.private_key = self.key_pair.export_key().decode('utf-8')
+
+        if self.algorithm == ALGORITHM_ED25519:
+            raw_key = self.key_pair.public_key().export_key(format='raw')
+            self.public_key = f'{ALGORITHM_ED25519}:{raw_key.hex()}'
+            self.signer = eddsa.new(self.key_pair, 'rfc8032')
+        else:
             self.public_key = self.key_pair.publickey().export_key().decode('utf-8')
-            self.private_key = self.key_pair.export_key().decode('utf-8')
+            self.signer = pkcs1_15.new(self.key_pair)
 
     def sign_transaction(self, transaction):
-        private_key = RSA.import_key(self.private_key)
-        signer = pkcs1_15.new(private_key)
-        h = SHA256.new(str(transaction).encode('utf-8'))
-        return signer.sign(h)
+        message = signing_bytes(transaction)
+        if self.algorithm == ALGORITHM_ED25519:
+            return self.signer.sign(message)
+        return self.signer.sign(SHA256.new(message))
 
     @staticmethod
     def verify_signature(transaction, signature, public_key):
-        public_key = RSA.import_key(public_key)
-        verifier = pkcs1_15.new(public_key)
-        h = SHA256.new(str(transaction).encode('utf-8'))
         try:
-            verifier.verify(h, signature)
+            algorithm, verifier = key_cache.verifier(public_key)
+        except (ValueError, IndexError, TypeError):
+            return False
+        message = signing_bytes(transaction)
+        try:
+            if algorithm == ALGORITHM_ED25519:
+                verifier.verify(message, signature)
+            else:
+                verifier.verify(SHA256.new(message), signature)
             return True
         except (ValueError, TypeError):
             return False
+
+    @staticmethod
+    def verify_many(items, workers=None, use_processes=True):
+        """
+        Verifies a batch of signatures, e.g. every transaction in a block or chain segment
+        :param items: <list> of (transaction, signature bytes, public key PEM) tuples
+        :param workers: <int> Pool size; None uses every core, 1 verifies in this thread
+        :param use_processes: <bool> Use a process pool rather than a thread pool
+        :return: <list> of <bool>, one per item
+        """
+        items = list(items)
+        workers = workers or os.cpu_count() or 1
+        if workers <= 1 or len(items) < MIN_PARALLEL_BATCH:
+            return [_verify_item(item) for item in items]
+
+        executor = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        # Large chunks keep items signed by the same key in one worker's key cache
+        chunksize = max(1, len(items) // (workers * 4))
+        with executor(max_workers=workers) as pool:
+            return list(pool.map(_verify_item, items, chunksize=chunksize))
+
+
+@lru_cache(maxsize=256)
+def load_wallet(private_key):
+    """
+    Returns a Wallet for a private key, parsing each key only once
+    :param private_key: <str> PEM encoded private key
+    :return: <Wallet>
+    """
+    return Wallet(private_key)
+
+
+class KeyPool:
+    """
+    Keeps a few freshly generated wallets ready so that sign-up never waits on key generation.
+    A daemon thread refills the pool in the background after each take().
+    """
+
+    def __init__(self, size=8, algorithm=DEFAULT_ALGORITHM):
+        self.size = size
+        self.algorithm = algorithm
+        self._wallets = queue.Queue(maxsize=max(size, 1))
+        self._refill = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def take(self):
+        """
+        :return: <Wallet> A new wallet, generated on the spot if the pool is empty
+        """
+        self._ensure_started()
+        try:
+            wallet = self._wallets.get_nowait()
+        except queue.Empty:
+            wallet = Wallet(algorithm=self.algorithm)
+        self._refill.set()
+        return wallet
+
+    def _ensure_started(self):
+        if self.size <= 0 or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='key-pool', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            while not self._wallets.full():
+                self._wallets.put(Wallet(algorithm=self.algorithm))
+            self._refill.wait()
+            self._refill.clear()